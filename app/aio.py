@@ -0,0 +1,47 @@
+import asyncio
+import threading
+from typing import Any, Callable, Coroutine, TypeVar
+
+T = TypeVar("T")
+
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+
+def _get_sync_loop() -> asyncio.AbstractEventLoop:
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(target=_sync_loop.run_forever, name="sync-bridge", daemon=True).start()
+        return _sync_loop
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """
+    Run a coroutine from synchronous code and wait for its result.
+
+    Coroutines run on one long-lived background loop rather than a fresh
+    asyncio.run() loop per call, so loop-bound pools (asyncpg, httpx) stay
+    valid between calls.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_sync_loop()).result()
+
+
+def loop_local(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Wrap a factory so each running event loop gets its own instance.
+    Async engines and HTTP clients cannot be shared across loops.
+    """
+    instances = {}
+    lock = threading.Lock()
+
+    def get() -> T:
+        loop = asyncio.get_running_loop()
+        with lock:
+            instance = instances.get(loop)
+            if instance is None:
+                instance = instances[loop] = factory()
+            return instance
+
+    return get
@@ -0,0 +1,425 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from sqlalchemy.sql import text
+
+from app.db import engine, get_connection
+from app.metrics import event
+from app.vector_search import SIMILARITY_THRESHOLD, TOP_K
+
+# pgvector only uses an index whose operator class matches the ORDER BY operator
+OPCLASSES = {"<#>": "vector_ip_ops", "<=>": "vector_cosine_ops", "<->": "vector_l2_ops"}
+
+ANN_METHOD = os.getenv("ANN_METHOD", "hnsw").lower()
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+# pgvector defaults to 40; 100 brought recall@5 from 0.80 to 0.97 in benchmark()
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "100"))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", "10"))
+# hnsw.ef_search / ivfflat.probes never go above this, however selective the filter
+ANN_MAX_SEARCH = int(os.getenv("ANN_MAX_SEARCH", "1000"))
+# destinations up to this many rows are ranked exactly after the destination filter
+ANN_EXACT_MAX_ROWS = int(os.getenv("ANN_EXACT_MAX_ROWS", "10000"))
+# larger destinations below this share of the table get their own partial index
+ANN_PARTIAL_MAX_FRACTION = float(os.getenv("ANN_PARTIAL_MAX_FRACTION", "0.25"))
+ANN_STATS_SECONDS = float(os.getenv("ANN_STATS_SECONDS", "300"))
+ANN_AUTO_CREATE = os.getenv("ANN_AUTO_CREATE", "false").lower() in ("1", "true", "yes")
+
+QUERY_VECTOR = "CAST(CAST(:query_vector AS text) AS vector)"
+
+
+class Plan(NamedTuple):
+    strategy: str            # exact | partial | global
+    index: Optional[str]     # the ANN index the plan should use
+    settings: List[str]      # SET LOCAL statements run before the query
+    sql: str
+
+
+def ivfflat_lists(rows: int) -> int:
+    """pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) above."""
+    return max(1, rows // 1000 if rows <= 1_000_000 else int(math.sqrt(rows)))
+
+
+class AnnIndex:
+    """
+    Managed pgvector index for one embedding column, filtered by one
+    foreign key (must_travel_activity.embedding by destination_id).
+
+    Every query orders by `embedding <#> q`, the form an index built with
+    the matching operator class can serve. The filter decides the plan:
+    - exact: the destination has at most ANN_EXACT_MAX_ROWS rows. The
+      destination_id btree narrows the rows and all of them are ranked;
+      the ORDER BY is written so the ANN index cannot be chosen.
+    - partial: the destination has its own partial ANN index (built for
+      large destinations that are a small share of the table). The id is
+      inlined so the planner can match the index predicate.
+    - global: the table-wide ANN index, with ef_search/probes raised in
+      proportion to how few rows pass the filter, since filtering happens
+      after the index returns its candidates.
+    Settings are SET LOCAL, so they only apply to the query's transaction.
+    """
+
+    def __init__(
+        self,
+        table: str = "must_travel_activity",
+        column: str = "embedding",
+        filter_column: str = "destination_id",
+        operator: str = "<#>",
+        method: str = ANN_METHOD,
+        connection_factory=get_connection,
+        sync_engine=engine,
+    ):
+        if method not in ("hnsw", "ivfflat"):
+            raise ValueError(f"unknown ANN method {method!r}")
+        self.table = table
+        self.column = column
+        self.filter_column = filter_column
+        self.operator = operator
+        self.opclass = OPCLASSES[operator]
+        self.method = method
+        self.connection_factory = connection_factory
+        self.sync_engine = sync_engine
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+        self.partial: Set[int] = set()
+        self.has_global = False
+        self.stats_at = None
+        self._stats_lock = threading.Lock()
+
+    # ------------------------------------------------------------ DDL
+
+    def index_name(self, filter_value: Optional[int] = None) -> str:
+        name = f"{self.table}_{self.column}_{self.method}_{self.opclass.split('_')[1]}"
+        return name if filter_value is None else f"{name}_{self.filter_column}_{filter_value}"
+
+    def _create_sql(self, rows: int, filter_value: Optional[int] = None) -> str:
+        if self.method == "hnsw":
+            options = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+        else:
+            options = f"lists = {ivfflat_lists(rows)}"
+        sql = (
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.index_name(filter_value)} "
+            f"ON {self.table} USING {self.method} ({self.column} {self.opclass}) WITH ({options})"
+        )
+        if filter_value is not None:
+            sql += f" WHERE {self.filter_column} = {int(filter_value)}"
+        return sql
+
+    def ensure_indexes(self, partial: bool = True) -> List[str]:
+        """
+        Create the btree on the filter column, the table-wide ANN index and,
+        with `partial`, one partial ANN index per large, selective filter
+        value. Builds run CONCURRENTLY, so writes continue meanwhile.
+        Returns the statements that were run.
+        """
+        self.refresh_stats()
+        statements = [
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.table}_{self.filter_column}_idx ON {self.table} ({self.filter_column})",
+            self._create_sql(self.total),
+        ]
+        if partial:
+            statements += [self._create_sql(count, value) for value, count in sorted(self.counts.items()) if self._wants_partial(count)]
+
+        with self.connection_factory() as conn:
+            # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+            conn.rollback()
+            conn.set_session(autocommit=True)
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"SET maintenance_work_mem = '{os.getenv('ANN_MAINTENANCE_WORK_MEM', '512MB')}'")
+                for statement in statements:
+                    start = time.perf_counter()
+                    cursor.execute(statement)
+                    event("ann_index_built", statement=statement, seconds=time.perf_counter() - start)
+            finally:
+                cursor.close()
+                conn.set_session(autocommit=False)
+        self.refresh_stats()
+        return statements
+
+    def _wants_partial(self, count: int) -> bool:
+        return count > ANN_EXACT_MAX_ROWS and count <= ANN_PARTIAL_MAX_FRACTION * self.total
+
+    # ------------------------------------------------------------ stats
+
+    def refresh_stats(self):
+        """Row counts per filter value and the ANN indexes that exist."""
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"SELECT {self.filter_column}, count(*) FROM {self.table} WHERE {self.column} IS NOT NULL GROUP BY 1"
+            )
+            counts = {row[0]: row[1] for row in cursor.fetchall()}
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", (self.table,))
+            names = {row[0] for row in cursor.fetchall()}
+            cursor.close()
+        prefix = self.index_name() + f"_{self.filter_column}_"
+        self.counts = counts
+        self.total = sum(counts.values())
+        self.has_global = self.index_name() in names
+        self.partial = {int(name[len(prefix):]) for name in names if name.startswith(prefix) and name[len(prefix):].isdigit()}
+        self.stats_at = time.monotonic()
+
+    def ensure_stats(self):
+        if self.stats_at is None or time.monotonic() - self.stats_at > ANN_STATS_SECONDS:
+            with self._stats_lock:
+                if self.stats_at is None or time.monotonic() - self.stats_at > ANN_STATS_SECONDS:
+                    self.refresh_stats()
+
+    # ------------------------------------------------------------ queries
+
+    def _search_setting(self, candidates: int) -> str:
+        if self.method == "hnsw":
+            return f"SET LOCAL hnsw.ef_search = {min(ANN_MAX_SEARCH, max(HNSW_EF_SEARCH, candidates))}"
+        return f"SET LOCAL ivfflat.probes = {min(ANN_MAX_SEARCH, max(IVFFLAT_PROBES, candidates))}"
+
+    def plan(self, filter_value: int, k: int = TOP_K, strategy: Optional[str] = None) -> Plan:
+        """Pick exact, partial or global for this filter value (or force `strategy`)."""
+        count = self.counts.get(filter_value, 0)
+        if strategy is None:
+            if count <= ANN_EXACT_MAX_ROWS or not (self.has_global or filter_value in self.partial):
+                strategy = "exact"
+            elif filter_value in self.partial:
+                strategy = "partial"
+            else:
+                strategy = "global"
+
+        distance = f"{self.column} {self.operator} {QUERY_VECTOR}"
+        where = f"{self.filter_column} = :filter_value"
+        settings: List[str] = []
+        index = None
+        if strategy == "exact":
+            # "+ 0" keeps the ANN index from being used for the ORDER BY
+            order = f"({distance}) + 0"
+        elif strategy == "partial":
+            where = f"{self.filter_column} = {int(filter_value)}"
+            order = distance
+            index = self.index_name(filter_value)
+            settings.append(self._search_setting(HNSW_EF_SEARCH if self.method == "hnsw" else IVFFLAT_PROBES))
+        else:
+            order = distance
+            index = self.index_name()
+            # the index filters after collecting candidates, so scale the search
+            # until about as many candidates pass the filter as an unfiltered query sees
+            fraction = max(count, 1) / max(self.total, 1)
+            base = HNSW_EF_SEARCH if self.method == "hnsw" else IVFFLAT_PROBES
+            settings.append(self._search_setting(max(k, math.ceil(base / fraction))))
+
+        sql = f"""
+            SELECT id, name, description, similarity FROM (
+                SELECT id, name, description, -({distance}) AS similarity
+                FROM {self.table}
+                WHERE {where}
+                ORDER BY {order}
+                LIMIT :k
+            ) AS ranked
+            WHERE similarity > :threshold
+            ORDER BY similarity DESC
+        """
+        return Plan(strategy, index, settings, sql)
+
+    @staticmethod
+    def _params(query_vector: str, filter_value: int, k: int, threshold: float) -> dict:
+        return {"query_vector": query_vector, "filter_value": filter_value, "k": k, "threshold": threshold}
+
+    async def search(self, conn, query_vector: str, filter_value: int, k: int = TOP_K, threshold: float = SIMILARITY_THRESHOLD, strategy: Optional[str] = None):
+        """
+        Top-k (id, name, description, similarity) on an async connection.
+        `query_vector` is the pgvector text form '[...]'.
+        """
+        await asyncio.to_thread(self.ensure_stats)
+        plan = self.plan(filter_value, k, strategy)
+        for setting in plan.settings:
+            await conn.execute(text(setting))
+        result = await conn.execute(text(plan.sql), self._params(query_vector, filter_value, k, threshold))
+        return result.fetchall()
+
+    def search_sync(self, conn, query_vector: str, filter_value: int, k: int = TOP_K, threshold: float = SIMILARITY_THRESHOLD, strategy: Optional[str] = None):
+        """search() on a sync SQLAlchemy connection; the caller ends the transaction."""
+        self.ensure_stats()
+        plan = self.plan(filter_value, k, strategy)
+        for setting in plan.settings:
+            conn.execute(text(setting))
+        return conn.execute(text(plan.sql), self._params(query_vector, filter_value, k, threshold)).fetchall()
+
+    # ------------------------------------------------------------ EXPLAIN
+
+    def explain(self, filter_value: int, query_vector: Optional[str] = None, k: int = TOP_K, strategy: Optional[str] = None, analyze: bool = False) -> dict:
+        """
+        EXPLAIN the planned query and report which indexes it scans, and
+        whether that matches the plan (ok=False means the planner ignored
+        the ANN index, or used it when ranking was meant to be exact).
+        """
+        self.ensure_stats()
+        plan = self.plan(filter_value, k, strategy)
+        with self.sync_engine.connect() as conn:
+            if query_vector is None:
+                dims = conn.execute(text(
+                    f"SELECT vector_dims({self.column}) FROM {self.table} WHERE {self.column} IS NOT NULL LIMIT 1"
+                )).scalar() or 1
+                query_vector = "[" + ",".join(["0.1"] * dims) + "]"
+            for setting in plan.settings:
+                conn.execute(text(setting))
+            options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+            raw = conn.execute(
+                text(f"EXPLAIN ({options}) {plan.sql}"), self._params(query_vector, filter_value, k, SIMILARITY_THRESHOLD)
+            ).scalar()
+            conn.rollback()
+
+        root = (json.loads(raw) if isinstance(raw, str) else raw)[0]
+        nodes, indexes = [], []
+
+        def walk(node):
+            nodes.append(node["Node Type"])
+            if "Index Name" in node:
+                indexes.append(node["Index Name"])
+            for child in node.get("Plans", []):
+                walk(child)
+
+        walk(root["Plan"])
+        ann_used = [name for name in indexes if name.startswith(self.index_name())]
+        ok = ann_used == [plan.index] if plan.index else not ann_used
+        result = {
+            "strategy": plan.strategy,
+            "expected_index": plan.index,
+            "indexes": indexes,
+            "nodes": nodes,
+            "settings": plan.settings,
+            "ok": ok,
+        }
+        if analyze:
+            result["execution_ms"] = root.get("Execution Time")
+        if not ok:
+            event("ann_plan_mismatch", level=logging.WARNING, table=self.table, filter_value=filter_value, **result)
+        return result
+
+    def check(self) -> List[dict]:
+        """EXPLAIN one filter value per strategy in use; see explain()."""
+        self.ensure_stats()
+        seen = {}
+        for value, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+            seen.setdefault(self.plan(value).strategy, value)
+        return [{"filter_value": value, **self.explain(value)} for value in seen.values()]
+
+
+ann_index = AnnIndex()
+
+
+# ---------------------------------------------------------------- benchmark
+
+def benchmark(sizes=(10_000, 100_000), dims: int = 128, destinations: int = 50, queries: int = 30, table: str = "ann_bench_activity"):
+    """
+    Build synthetic catalogs in `table` (hierarchically clustered unit vectors, Zipf-sized
+    destinations) and compare, per destination size: sequential scan,
+    each planned strategy and a few ef_search values, by latency and
+    recall@5 against exact ranking.
+    """
+    import io
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    for rows in sizes:
+        weights = 1.0 / np.arange(1, destinations + 1)
+        destination_ids = rng.choice(np.arange(1, destinations + 1), size=rows, p=weights / weights.sum())
+        # topics, sub-topics, then row noise: neighbours share a sub-topic, as in real catalogs
+        topics = rng.standard_normal((100, dims)).astype(np.float32)
+        subtopics = topics[rng.integers(len(topics), size=rows // 20 + 1)] + 0.5 * rng.standard_normal((rows // 20 + 1, dims)).astype(np.float32)
+        vectors = subtopics[rng.integers(len(subtopics), size=rows)] + 0.3 * rng.standard_normal((rows, dims)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            cursor.execute(
+                f"CREATE TABLE {table} (id serial PRIMARY KEY, name text, description text, destination_id integer, embedding vector({dims}))"
+            )
+            buffer = io.StringIO()
+            for i in range(rows):
+                buffer.write(f"act {i}\t\t{destination_ids[i]}\t[{','.join(f'{x:.6f}' for x in vectors[i])}]\n")
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY {table} (name, description, destination_id, embedding) FROM STDIN", buffer)
+            conn.commit()
+            cursor.execute(f"ANALYZE {table}")
+            conn.commit()
+            cursor.close()
+
+        index = AnnIndex(table=table)
+        start = time.perf_counter()
+        index.ensure_indexes()
+        build_seconds = time.perf_counter() - start
+        print(f"\n{rows:,} rows x {dims} dims, {destinations} destinations: indexes built in {build_seconds:.1f}s, partial for {sorted(index.partial)}")
+
+        large, mid, small = 1, sorted(index.counts, key=index.counts.get)[len(index.counts) // 2], max(index.counts, key=lambda d: -index.counts[d])
+        for destination_id in dict.fromkeys((large, mid, small)):
+            members = np.flatnonzero(destination_ids == destination_id)
+            probes = vectors[rng.choice(members, size=queries)] + 0.1 * rng.standard_normal((queries, dims)).astype(np.float32)
+            truth = []
+            for probe in probes:
+                scores = vectors[members] @ probe
+                truth.append(set((members[np.argsort(-scores)[:5]] + 1).tolist()))
+
+            variants = [("seqscan", "exact", None)]
+            chosen = index.plan(int(destination_id)).strategy
+            variants.append((f"planned:{chosen}", chosen, None))
+            if index.has_global and chosen != "global":
+                variants.append(("global", "global", None))
+            for ef in (40, 100, 400) if index.method == "hnsw" else ():
+                variants.append((f"global ef={ef}", "global", ef))
+
+            print(f"  destination {destination_id} ({index.counts[destination_id]:,} rows, {index.counts[destination_id] / rows:.1%})")
+            for label, strategy, ef in variants:
+                timings, hits = [], 0
+                with engine.connect() as conn:
+                    for probe, expected in zip(probes, truth):
+                        vector = "[" + ",".join(f"{x:.6f}" for x in probe) + "]"
+                        if label == "seqscan":
+                            conn.execute(text("SET LOCAL enable_indexscan = off"))
+                            conn.execute(text("SET LOCAL enable_bitmapscan = off"))
+                        if ef is not None:
+                            plan = index.plan(int(destination_id), strategy="global")
+                            sql, settings = plan.sql, [f"SET LOCAL hnsw.ef_search = {ef}"]
+                        start = time.perf_counter()
+                        if ef is None:
+                            found = index.search_sync(conn, vector, int(destination_id), threshold=-1.0, strategy=strategy)
+                        else:
+                            for setting in settings:
+                                conn.execute(text(setting))
+                            found = conn.execute(text(sql), index._params(vector, int(destination_id), 5, -1.0)).fetchall()
+                        timings.append(time.perf_counter() - start)
+                        conn.rollback()
+                        hits += len(expected & {row[0] for row in found})
+                timings.sort()
+                print(f"    {label:18} p50 {timings[len(timings) // 2] * 1000:7.2f} ms  recall@5 {hits / (5 * queries):.3f}")
+
+        for row in index.check():
+            print("  explain:", row["filter_value"], row["strategy"], row["indexes"], "ok" if row["ok"] else "MISMATCH")
+
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.commit()
+            cursor.close()
+
+
+if __name__ == "__main__":
+    # python -m app.ann_index [create|check|bench]
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    command = sys.argv[1] if len(sys.argv) > 1 else "check"
+    if command == "create":
+        for statement in ann_index.ensure_indexes():
+            print(statement)
+    elif command == "bench":
+        benchmark(
+            sizes=[int(size) for size in os.getenv("ANN_BENCH_ROWS", "10000,100000").split(",")],
+            dims=int(os.getenv("ANN_BENCH_DIMS", "128")),
+        )
+    else:
+        for row in ann_index.check():
+            print(row)
@@ -0,0 +1,141 @@
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from app.db import Destination, Pair, Region, SessionLocal, TravelGroup, TravelTheme
+from app.metrics import event
+
+# table name -> (model, name column, optional code column)
+INDEXED_TABLES = {
+    "destination": (Destination, "name", "code"),
+    "region": (Region, "region", None),
+    "pair": (Pair, "destination_pair", None),
+    "travel_group": (TravelGroup, "name", "code"),
+    "travel_theme": (TravelTheme, "name", "code"),
+}
+
+
+def normalize_name(value: str) -> str:
+    """Case-, accent- and whitespace-insensitive form of a name."""
+    decomposed = unicodedata.normalize("NFKD", value)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+def trigrams(value: str) -> Set[str]:
+    padded = f"  {value} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _TableIndex:
+    def __init__(self):
+        self.exact: Dict[str, int] = {}
+        self.names: Dict[int, str] = {}
+        self.grams: Dict[str, Set[int]] = defaultdict(set)
+        self.gram_counts: Dict[int, int] = {}
+
+    def add(self, row_id: int, name: str, code: Optional[str]):
+        key = normalize_name(name)
+        self.names[row_id] = name
+        self.exact.setdefault(key, row_id)
+        if code:
+            self.exact.setdefault(normalize_name(code), row_id)
+        grams = trigrams(key)
+        self.gram_counts[row_id] = len(grams)
+        for gram in grams:
+            self.grams[gram].add(row_id)
+
+
+class CatalogIndex:
+    """
+    In-process lookup tables for the small dimension tables (destination,
+    region, pair, travel_group, travel_theme).
+
+    Exact lookups match on the normalized name or code. When that misses,
+    a trigram similarity search finds the closest name, which covers
+    typos and partial names. The index is rebuilt from the database at
+    startup and then on a timer. A rebuild replaces the whole index at
+    once, so readers never see a half-built one.
+    """
+
+    def __init__(self, session_factory=SessionLocal, min_similarity: float = 0.4):
+        self.session_factory = session_factory
+        self.min_similarity = min_similarity
+        self.loaded_at = None
+        self._tables: Dict[str, _TableIndex] = {}
+        self._load_lock = threading.Lock()
+        self._refresh_thread = None
+
+    def load(self):
+        tables = {}
+        db = self.session_factory()
+        try:
+            for table, (model, name_column, code_column) in INDEXED_TABLES.items():
+                columns = [model.id, getattr(model, name_column)]
+                if code_column:
+                    columns.append(getattr(model, code_column))
+                index = _TableIndex()
+                for row in db.query(*columns).all():
+                    index.add(row[0], row[1], row[2] if code_column else None)
+                tables[table] = index
+        finally:
+            db.close()
+        self._tables = tables
+        self.loaded_at = time.time()
+
+    def ensure_loaded(self):
+        if self.loaded_at is None:
+            with self._load_lock:
+                if self.loaded_at is None:
+                    self.load()
+
+    def lookup(self, table: str, name: str, fuzzy: bool = True) -> Optional[int]:
+        """Return the id for `name` in `table`, or None if nothing is close enough."""
+        index = self._tables.get(table)
+        if index is None or not name:
+            return None
+        key = normalize_name(name)
+        row_id = index.exact.get(key)
+        if row_id is not None or not fuzzy:
+            return row_id
+
+        query_grams = trigrams(key)
+        overlaps = defaultdict(int)
+        for gram in query_grams:
+            for candidate in index.grams.get(gram, ()):
+                overlaps[candidate] += 1
+
+        best_id, best_score = None, 0.0
+        for candidate, overlap in overlaps.items():
+            score = overlap / (len(query_grams) + index.gram_counts[candidate] - overlap)
+            if score > best_score:
+                best_id, best_score = candidate, score
+        return best_id if best_score >= self.min_similarity else None
+
+    def name(self, table: str, row_id: int) -> Optional[str]:
+        index = self._tables.get(table)
+        return index.names.get(row_id) if index else None
+
+    def start_refresh(self, interval_seconds: float):
+        """Reload the index every `interval_seconds` in a daemon thread."""
+        if self._refresh_thread is not None:
+            return
+
+        def refresh():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    self.load()
+                except Exception as e:
+                    event("catalog_refresh_failed", level=logging.WARNING, error=str(e))
+
+        self._refresh_thread = threading.Thread(target=refresh, name="catalog-refresh", daemon=True)
+        self._refresh_thread.start()
+
+
+catalog_index = CatalogIndex()
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "300"))
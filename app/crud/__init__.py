@@ -0,0 +1,238 @@
+"""
+Repository helpers over the ORM models in app.db.
+
+The model relationships load lazily, so walking destination -> locations
+-> hotels one object at a time costs a query per object. The helpers here
+choose their loading strategy explicitly: joinedload for many-to-one
+parents (one JOIN, no extra round trip) and selectinload for collections
+(one `IN (...)` query per level, whatever the number of rows). Listings
+use keyset pagination on the primary key and can return selected columns
+as plain rows instead of ORM objects.
+"""
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import bindparam, cast, column, event, insert, select, update, values
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+from app.db import Destination, Hotel, Location, engine
+
+PAGE_SIZE = int(os.getenv("CRUD_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = 500
+# rows per UPDATE ... FROM (VALUES ...) statement
+BULK_CHUNK_ROWS = int(os.getenv("CRUD_BULK_CHUNK_ROWS", "1000"))
+
+# many-to-one parents are joined in; collections cost one IN query per level
+DESTINATION_TREE = (
+    joinedload(Destination.region),
+    joinedload(Destination.pair),
+    selectinload(Destination.locations).selectinload(Location.hotels),
+)
+LOCATION_WITH_HOTELS = (selectinload(Location.hotels),)
+
+
+class Page(NamedTuple):
+    items: list
+    # pass as `after` to get the next page; None on the last page
+    next_after: Optional[int]
+
+
+def _columns(model, names: Iterable[str]) -> list:
+    table_columns = model.__table__.c
+    unknown = [name for name in names if name not in table_columns]
+    if unknown:
+        raise ValueError(f"unknown {model.__tablename__} columns: {', '.join(unknown)}")
+    return [getattr(model, name) for name in names]
+
+
+def paginate(
+    db: Session,
+    model,
+    *criteria,
+    after: Optional[int] = None,
+    limit: int = PAGE_SIZE,
+    columns: Optional[Sequence[str]] = None,
+    options: Sequence = (),
+) -> Page:
+    """
+    One page ordered by id: `WHERE id > after ORDER BY id LIMIT n`, so a
+    deep page costs the same as the first (no OFFSET scan). With `columns`
+    the items are rows of just those columns (id always first) and
+    `options` are ignored.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if columns:
+        stmt = select(*_columns(model, ["id", *[name for name in columns if name != "id"]]))
+    else:
+        stmt = select(model).options(*options)
+    stmt = stmt.where(*criteria)
+    if after is not None:
+        stmt = stmt.where(model.id > after)
+    result = db.execute(stmt.order_by(model.id).limit(limit + 1))
+    items = result.all() if columns else result.scalars().unique().all()
+    if len(items) > limit:
+        return Page(items[:limit], items[limit - 1].id)
+    return Page(items, None)
+
+
+# ---------------------------------------------------------------- reads
+
+def get_destination(db: Session, destination_id: int, tree: bool = False) -> Optional[Destination]:
+    """A destination; with `tree`, its region, pair, locations and hotels are loaded too (three queries)."""
+    return db.get(Destination, destination_id, options=DESTINATION_TREE if tree else ())
+
+
+def list_destinations(
+    db: Session,
+    region_id: Optional[int] = None,
+    pair_id: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = PAGE_SIZE,
+    columns: Optional[Sequence[str]] = None,
+    tree: bool = False,
+) -> Page:
+    criteria = []
+    if region_id is not None:
+        criteria.append(Destination.region_id == region_id)
+    if pair_id is not None:
+        criteria.append(Destination.pair_id == pair_id)
+    return paginate(
+        db, Destination, *criteria, after=after, limit=limit, columns=columns, options=DESTINATION_TREE if tree else ()
+    )
+
+
+def list_locations(
+    db: Session,
+    destination_id: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = PAGE_SIZE,
+    columns: Optional[Sequence[str]] = None,
+    with_hotels: bool = False,
+) -> Page:
+    criteria = [] if destination_id is None else [Location.destination_id == destination_id]
+    return paginate(
+        db, Location, *criteria, after=after, limit=limit, columns=columns,
+        options=LOCATION_WITH_HOTELS if with_hotels else (),
+    )
+
+
+def list_hotels(
+    db: Session,
+    destination_id: Optional[int] = None,
+    location_id: Optional[int] = None,
+    min_rating: Optional[float] = None,
+    after: Optional[int] = None,
+    limit: int = PAGE_SIZE,
+    columns: Optional[Sequence[str]] = None,
+) -> Page:
+    criteria = []
+    if destination_id is not None:
+        criteria.append(Hotel.location_id.in_(select(Location.id).where(Location.destination_id == destination_id)))
+    if location_id is not None:
+        criteria.append(Hotel.location_id == location_id)
+    if min_rating is not None:
+        criteria.append(Hotel.rating >= min_rating)
+    return paginate(db, Hotel, *criteria, after=after, limit=limit, columns=columns)
+
+
+def hotels_by_location(db: Session, location_ids: Iterable[int], columns: Optional[Sequence[str]] = None) -> Dict[int, list]:
+    """Hotels grouped by location in one query, for callers holding location ids rather than objects."""
+    location_ids = list(location_ids)
+    grouped: Dict[int, list] = {location_id: [] for location_id in location_ids}
+    if not location_ids:
+        return grouped
+    if columns:
+        stmt = select(*_columns(Hotel, ["id", "location_id", *[c for c in columns if c not in ("id", "location_id")]]))
+        rows = db.execute(stmt.where(Hotel.location_id.in_(location_ids)).order_by(Hotel.id)).all()
+    else:
+        rows = db.scalars(select(Hotel).where(Hotel.location_id.in_(location_ids)).order_by(Hotel.id)).all()
+    for row in rows:
+        grouped[row.location_id].append(row)
+    return grouped
+
+
+# ---------------------------------------------------------------- bulk writes
+
+def bulk_insert(db: Session, model, rows: List[dict], returning: Sequence[str] = ("id",)) -> list:
+    """
+    Insert many rows in batched multi-row INSERT ... RETURNING statements
+    (SQLAlchemy's insertmanyvalues). Returned rows are in the order of
+    `rows`. The caller commits.
+    """
+    if not rows:
+        return []
+    stmt = insert(model).returning(*_columns(model, returning), sort_by_parameter_order=True)
+    return db.execute(stmt, rows).all()
+
+
+def bulk_update(db: Session, model, rows: List[dict], returning: Sequence[str] = ("id",)) -> list:
+    """
+    Update many rows by primary key. Every row needs "id" and the same
+    other keys. On PostgreSQL each chunk is a single
+    `UPDATE ... FROM (VALUES ...) RETURNING`; elsewhere the update is an
+    executemany followed by one SELECT of the `returning` columns. The
+    caller commits.
+    """
+    if not rows:
+        return []
+    table = model.__table__
+    names = [name for name in rows[0] if name != "id"]
+    _columns(model, ["id", *names, *returning])
+    if db.get_bind().dialect.name != "postgresql":
+        stmt = (
+            update(table)
+            .where(table.c.id == bindparam("_id"))
+            .values({name: bindparam(f"_{name}") for name in names})
+        )
+        db.execute(stmt, [{f"_{key}": value for key, value in row.items()} for row in rows])
+        ids = [row["id"] for row in rows]
+        return db.execute(select(*[table.c[name] for name in returning]).where(table.c.id.in_(ids))).all()
+
+    updated = []
+    for start in range(0, len(rows), BULK_CHUNK_ROWS):
+        chunk = rows[start:start + BULK_CHUNK_ROWS]
+        data = values(*[column(name, table.c[name].type) for name in ["id", *names]], name="changes").data(
+            [tuple(row[name] for name in ["id", *names]) for row in chunk]
+        )
+        stmt = (
+            update(table)
+            .where(table.c.id == data.c.id)
+            # VALUES columns holding only NULLs or strings come back untyped
+            .values({name: cast(data.c[name], table.c[name].type) for name in names})
+            .returning(*[table.c[name] for name in returning])
+        )
+        updated.extend(db.execute(stmt).all())
+    return updated
+
+
+# ---------------------------------------------------------------- query counting
+
+class QueryCounter:
+    def __init__(self):
+        self.statements: List[str] = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries(bind=engine):
+    """
+    Record the statements `bind` (an Engine) sends inside the block:
+
+        with count_queries(engine) as queries:
+            get_destination(db, 1, tree=True)
+        assert queries.count <= 3, queries.statements
+    """
+    counter = QueryCounter()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        counter.statements.append(statement)
+
+    event.listen(bind, "before_cursor_execute", record)
+    try:
+        yield counter
+    finally:
+        event.remove(bind, "before_cursor_execute", record)
@@ -6,21 +6,248 @@ from sqlalchemy import (
     Text,
     Float,
     Table,
-    create_engine
+    create_engine,
+    event
 )
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager, contextmanager
+import logging
 import os
+import select
+import threading
+import time
+from typing import Callable, Optional
+import psycopg2
 from dotenv import load_dotenv
+from app.aio import loop_local
+from app.metrics import db_query_seconds, event as trace_event, registry
 
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# One bounded pool shared by the ORM sessions and the raw psycopg2 call sites.
+# pool_pre_ping checks a connection before handing it out and pool_recycle
+# replaces connections older than the max lifetime (seconds).
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    pool_pre_ping=True,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+SLOW_QUERY_SECONDS = float(os.getenv("DB_SLOW_QUERY_SECONDS", "0.5"))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_start"].pop()
+    words = statement.split(None, 1)
+    db_query_seconds.observe(seconds, statement=words[0].upper() if words else "OTHER")
+    if seconds >= SLOW_QUERY_SECONDS:
+        trace_event("slow_query", level=logging.WARNING, seconds=seconds, statement=" ".join(statement.split())[:200])
+
+
+def instrument_engine(sync_engine):
+    """Time every statement run through SQLAlchemy on this engine."""
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+instrument_engine(engine)
+
+pool_metrics = {
+    "connects": 0,
+    "checkouts": 0,
+    "invalidations": 0,
+    "wait_count": 0,
+    "wait_total_seconds": 0.0,
+    "wait_max_seconds": 0.0,
+}
+_metrics_lock = threading.Lock()
+
+
+@event.listens_for(engine, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    with _metrics_lock:
+        pool_metrics["connects"] += 1
+
+
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    with _metrics_lock:
+        pool_metrics["checkouts"] += 1
+
+
+@event.listens_for(engine, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    with _metrics_lock:
+        pool_metrics["invalidations"] += 1
+
+
+def _record_wait(seconds: float):
+    with _metrics_lock:
+        pool_metrics["wait_count"] += 1
+        pool_metrics["wait_total_seconds"] += seconds
+        pool_metrics["wait_max_seconds"] = max(pool_metrics["wait_max_seconds"], seconds)
+
+
+@contextmanager
+def get_connection():
+    """
+    Borrow a raw psycopg2 connection from the shared engine pool.
+    The connection goes back to the pool (rolled back) when the block exits.
+    """
+    start = time.perf_counter()
+    conn = engine.raw_connection()
+    _record_wait(time.perf_counter() - start)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def listen_connection():
+    """A dedicated autocommit connection; LISTEN must not hold a pooled one."""
+    conn = psycopg2.connect(SQLALCHEMY_DATABASE_URL)
+    conn.autocommit = True
+    return conn
+
+
+class NotificationListener:
+    """
+    LISTEN on one channel in a daemon thread and pass each NOTIFY payload
+    to `handle`. Reconnects after errors; `on_reconnect` runs once the
+    connection is back, since notifications sent while disconnected are lost.
+    """
+
+    def __init__(
+        self,
+        channel: str,
+        handle: Callable[[str], None],
+        on_reconnect: Optional[Callable[[], None]] = None,
+        connect: Callable = listen_connection,
+        retry_seconds: float = 5.0,
+    ):
+        self.channel = channel
+        self.handle = handle
+        self.on_reconnect = on_reconnect
+        self.connect = connect
+        self.retry_seconds = retry_seconds
+        self.listening = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f"listen-{self.channel}", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        connected_before = False
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self.connect()
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {self.channel}")
+                self.listening = True
+                if connected_before and self.on_reconnect is not None:
+                    self.on_reconnect()
+                connected_before = True
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.handle(conn.notifies.pop(0).payload)
+            except Exception as e:
+                trace_event("listener_error", level=logging.WARNING, channel=self.channel, error=str(e))
+                self._stop.wait(self.retry_seconds)
+            finally:
+                self.listening = False
+                if conn is not None:
+                    conn.close()
+
+
+def _create_async_engine():
+    # asyncpg does not understand libpq's sslmode query parameter
+    url = make_url(SQLALCHEMY_DATABASE_URL)
+    query = dict(url.query)
+    sslmode = query.pop("sslmode", None)
+    async_engine = create_async_engine(
+        url.set(drivername="postgresql+asyncpg", query=query),
+        connect_args={"ssl": sslmode} if sslmode else {},
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=True,
+    )
+    instrument_engine(async_engine.sync_engine)
+    return async_engine
+
+
+# asyncpg connections are bound to the loop that opened them, so each event
+# loop gets its own async engine (and pool) built from the same settings.
+get_async_engine = loop_local(_create_async_engine)
+
+
+@asynccontextmanager
+async def get_async_connection():
+    """Borrow an async SQLAlchemy connection from the current loop's pool."""
+    start = time.perf_counter()
+    async with get_async_engine().connect() as conn:
+        _record_wait(time.perf_counter() - start)
+        yield conn
+
+
+def pool_stats() -> dict:
+    """Current pool occupancy plus the cumulative checkout/wait counters."""
+    pool = engine.pool
+    with _metrics_lock:
+        stats = dict(pool_metrics)
+    stats.update({
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+    })
+    return stats
+
+
+@registry.collector
+def _pool_samples():
+    stats = pool_stats()
+    return [
+        ("db_pool_connections", "gauge", "Connections in the shared pool by state.", [
+            # QueuePool reports overflow as negative until the pool has filled
+            ({"state": state}, max(0, stats[state])) for state in ("checked_in", "checked_out", "overflow")
+        ]),
+        ("db_pool_checkouts_total", "counter", "Connections handed out by the pool.", [({}, stats["checkouts"])]),
+        ("db_pool_connects_total", "counter", "New DBAPI connections opened.", [({}, stats["connects"])]),
+        ("db_pool_invalidations_total", "counter", "Connections discarded as broken.", [({}, stats["invalidations"])]),
+        ("db_pool_wait_seconds_total", "counter", "Time spent waiting to borrow a connection.", [({}, stats["wait_total_seconds"])]),
+        ("db_pool_wait_seconds_max", "gauge", "Longest wait to borrow a connection.", [({}, stats["wait_max_seconds"])]),
+    ]
+
 Base = declarative_base()
 
 def get_db():
@@ -64,6 +291,8 @@ class Location(Base):
     description = Column(Text, nullable=True)
     destination_id = Column(Integer, ForeignKey("destination.id"), nullable=False)
     destination = relationship("Destination", back_populates="locations")
+    # one-way: Hotel.location is the free-text location column
+    hotels = relationship("Hotel")
 
 
 class TravelGroup(Base):
@@ -140,3 +369,59 @@ class RecommendActivityGroupTheme(Base):
     travel_group_id = Column(Integer, ForeignKey("travel_group.id"), nullable=False)
     travel_theme_id = Column(Integer, ForeignKey("travel_theme.id"), nullable=False)
     rating = Column(Float, nullable=False)
+
+
+
+class SessionMessage(Base):
+    __tablename__ = "session_message"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_id = Column(String(128), nullable=False, index=True)
+    role = Column(String(32), nullable=False)
+    content = Column(Text, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+
+class SessionState(Base):
+    __tablename__ = "session_state"
+    session_id = Column(String(128), primary_key=True)
+    key = Column(String(64), primary_key=True)
+    value = Column(Text, nullable=False)
+
+
+# Benchmark: per-call latency of a fresh psycopg2 connection vs the pool.
+if __name__ == "__main__":
+    import psycopg2
+
+    iterations = int(os.getenv("BENCH_ITERATIONS", "50"))
+
+    def run(label, fn):
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(
+            f"{label}: mean={sum(timings) / len(timings) * 1000:.2f}ms "
+            f"p50={timings[len(timings) // 2] * 1000:.2f}ms "
+            f"p95={timings[int(len(timings) * 0.95) - 1] * 1000:.2f}ms"
+        )
+
+    def unpooled():
+        conn = psycopg2.connect(SQLALCHEMY_DATABASE_URL)
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        cursor.close()
+        conn.close()
+
+    def pooled():
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+
+    run("psycopg2.connect per call", unpooled)
+    run("shared pool", pooled)
+    print("pool stats:", pool_stats())
@@ -0,0 +1,239 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from app.metrics import registry
+
+load_dotenv()
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a query so trivially different spellings share a cache entry."""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.casefold().split())
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache for embeddings keyed by (model, normalized text).
+
+    The first tier is an in-process LRU with a TTL and an entry limit. The
+    optional second tier is a SQLite file holding the vectors as float32 blobs,
+    so entries survive restarts and are shared by processes on the same host.
+    Disk rows older than `disk_ttl_seconds` are ignored, and every
+    `prune_every` writes the expired rows and the oldest rows past
+    `disk_max_rows` are deleted. The async methods run the SQLite I/O in a
+    worker thread; it has its own lock, so memory hits never wait on disk.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 2048,
+        ttl_seconds: float = 24 * 3600,
+        disk_path: Optional[str] = None,
+        disk_ttl_seconds: float = 30 * 24 * 3600,
+        disk_max_rows: int = 100000,
+        prune_every: int = 256,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_ttl_seconds = disk_ttl_seconds
+        self.disk_max_rows = disk_max_rows
+        self.prune_every = prune_every
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._disk_writes = 0
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "disk_pruned": 0,
+        }
+
+        self._db = None
+        if disk_path:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (model, text)
+                )
+                """
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embedding_cache_created_at ON embedding_cache (created_at)")
+            self._db.commit()
+
+    def _count(self, kind: str, amount: int = 1):
+        with self._lock:
+            self.stats[kind] += amount
+
+    # ------------------------------------------------------------ memory tier
+
+    def _memory_get(self, key, now: float) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return vector
+                del self._entries[key]
+                self.stats["expirations"] += 1
+        return None
+
+    def _store(self, key, vector: np.ndarray, now: float):
+        with self._lock:
+            self._entries[key] = (vector, now + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    # ------------------------------------------------------------ disk tier
+
+    def _disk_get(self, key) -> Optional[np.ndarray]:
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT vector FROM embedding_cache WHERE model = ? AND text = ? AND created_at >= ?",
+                (*key, time.time() - self.disk_ttl_seconds),
+            ).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row is not None else None
+
+    def _disk_put(self, key, vector: np.ndarray):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO embedding_cache (model, text, vector, created_at) VALUES (?, ?, ?, ?)",
+                (key[0], key[1], vector.tobytes(), time.time()),
+            )
+            self._disk_writes += 1
+            if self._disk_writes % self.prune_every == 0:
+                self._prune()
+            self._db.commit()
+
+    def _prune(self):
+        # caller holds self._db_lock
+        expired = self._db.execute(
+            "DELETE FROM embedding_cache WHERE created_at < ?", (time.time() - self.disk_ttl_seconds,)
+        ).rowcount
+        overflow = self._db.execute(
+            """
+            DELETE FROM embedding_cache WHERE rowid IN (
+                SELECT rowid FROM embedding_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.disk_max_rows,),
+        ).rowcount
+        self._count("disk_pruned", expired + overflow)
+
+    # ------------------------------------------------------------ lookups
+
+    def get(self, text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> Optional[np.ndarray]:
+        key = (model, normalize_text(text))
+        now = time.monotonic()
+        vector = self._memory_get(key, now)
+        if vector is None and self._db is not None:
+            vector = self._disk_get(key)
+            if vector is not None:
+                self._store(key, vector, now)
+                self._count("disk_hits")
+                return vector
+        if vector is None:
+            self._count("misses")
+        return vector
+
+    async def aget(self, text: str, model: str = DEFAULT_EMBEDDING_MODEL) -> Optional[np.ndarray]:
+        """Like get(), with the SQLite read in a worker thread."""
+        key = (model, normalize_text(text))
+        now = time.monotonic()
+        vector = self._memory_get(key, now)
+        if vector is None and self._db is not None:
+            vector = await asyncio.to_thread(self._disk_get, key)
+            if vector is not None:
+                self._store(key, vector, now)
+                self._count("disk_hits")
+                return vector
+        if vector is None:
+            self._count("misses")
+        return vector
+
+    def put(self, text: str, vector, model: str = DEFAULT_EMBEDDING_MODEL) -> np.ndarray:
+        key = (model, normalize_text(text))
+        vector = np.asarray(vector, dtype=np.float32)
+        self._store(key, vector, time.monotonic())
+        if self._db is not None:
+            self._disk_put(key, vector)
+        return vector
+
+    async def aput(self, text: str, vector, model: str = DEFAULT_EMBEDDING_MODEL) -> np.ndarray:
+        """Like put(), with the SQLite write in a worker thread."""
+        key = (model, normalize_text(text))
+        vector = np.asarray(vector, dtype=np.float32)
+        self._store(key, vector, time.monotonic())
+        if self._db is not None:
+            await asyncio.to_thread(self._disk_put, key, vector)
+        return vector
+
+    def get_or_create(
+        self,
+        text: str,
+        fetch: Callable[[str], list],
+        model: str = DEFAULT_EMBEDDING_MODEL,
+    ) -> np.ndarray:
+        vector = self.get(text, model)
+        if vector is None:
+            vector = self.put(text, fetch(text), model)
+        return vector
+
+    def hit_rate(self) -> float:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "2048")),
+    ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL", str(24 * 3600))),
+    disk_path=os.getenv("EMBEDDING_CACHE_PATH"),
+    disk_ttl_seconds=float(os.getenv("EMBEDDING_CACHE_DISK_TTL", str(30 * 24 * 3600))),
+    disk_max_rows=int(os.getenv("EMBEDDING_CACHE_DISK_ROWS", "100000")),
+)
+
+
+@registry.collector
+def _embedding_cache_samples():
+    return [
+        ("embedding_cache_events_total", "counter", "Query embedding cache lookups and evictions.", [
+            ({"event": key}, value) for key, value in embedding_cache.stats.items()
+        ]),
+    ]
+
+
+async def aget_embedding(text: str, model: str = DEFAULT_EMBEDDING_MODEL, client=None) -> np.ndarray:
+    """Embed a single query string, going to OpenAI only on a cache miss; `client` is an app.llm.ResilientLLM."""
+    vector = await embedding_cache.aget(text, model)
+    if vector is None:
+        response = await client.aembed(input=[text], model=model)
+        vector = await embedding_cache.aput(text, response.data[0].embedding, model)
+    return vector
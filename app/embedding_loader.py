@@ -0,0 +1,176 @@
+import logging
+import uuid
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+from app.db import get_connection
+from app.metrics import event
+
+
+class EmbeddingMatrix(NamedTuple):
+    ids: np.ndarray
+    vectors: np.ndarray
+    labels: Optional[List[str]]
+
+
+def decode_vector_send(buffers: List[bytes]) -> np.ndarray:
+    """
+    Decode pgvector's binary form (vector_send: int16 dims, int16 unused,
+    then big-endian float4 values) for a whole chunk with one frombuffer.
+    The 4-byte header is exactly one float slot, so each row is dims + 1
+    slots and the first column is dropped.
+    """
+    raw = b"".join(buffers)
+    dims = int(np.frombuffer(raw[:2], dtype=">i2")[0]) if raw else 0
+    if not buffers or len(raw) != len(buffers) * (dims + 1) * 4:
+        raise ValueError(f"expected {len(buffers)} vectors of {dims} values")
+    headers = np.frombuffer(raw, dtype=">i2").reshape(len(buffers), 2 * (dims + 1))[:, 0]
+    if (headers != dims).any():
+        raise ValueError("vectors of different dimensions in one chunk")
+    return np.frombuffer(raw, dtype=">f4").reshape(len(buffers), dims + 1)[:, 1:].astype(np.float32)
+
+
+def decode_vectors(texts: List[str], dims: Optional[int] = None) -> np.ndarray:
+    """
+    Decode bracket-free vector texts ('0.1,0.2,...') into a float32 matrix
+    with one np.fromstring call for the whole chunk. For float[] and text
+    columns that have no binary codec.
+    """
+    flat = np.fromstring(",".join(texts), sep=",", dtype=np.float32)
+    dims = dims or (flat.size // len(texts) if texts else 0)
+    if not texts or flat.size != len(texts) * dims:
+        raise ValueError(f"expected {len(texts)} vectors of {dims} values, got {flat.size} values")
+    return flat.reshape(len(texts), dims)
+
+
+def column_type(conn, table_name, column):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            "SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s",
+            (table_name, column),
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        cursor.close()
+
+
+def iter_embeddings(
+    table_name,
+    embedding_column,
+    label_column=None,
+    id_column='id',
+    limit=None,
+    sample=None,
+    seed=42,
+    chunk_size=5000,
+    ids=None,
+    connection_factory=get_connection,
+):
+    """
+    Stream (ids, float32 vectors, labels) chunks through a server-side cursor.
+
+    pgvector columns are fetched in binary (vector_send) and decoded with
+    np.frombuffer. Array and text columns are fetched as text and decoded
+    with one np.fromstring call per chunk.
+    - limit: keep at most this many rows (lowest ids first)
+    - sample: a fraction in (0, 1]. Rows are drawn with TABLESAMPLE
+      BERNOULLI, and the same seed repeats the same sample.
+    - ids: only these rows
+    Rows whose embedding is NULL or malformed are skipped.
+    """
+    with connection_factory() as conn:
+        binary = (column_type(conn, table_name, embedding_column) or "").startswith("vector")
+        if binary:
+            select, decode = f"{id_column}, vector_send({embedding_column})", decode_vector_send
+        else:
+            select, decode = f"{id_column}, trim(both '[]{{}}' from {embedding_column}::text)", decode_vectors
+        if label_column:
+            select += f", {label_column}"
+        sql = f"SELECT {select} FROM {table_name}"
+        params = []
+        if sample is not None and sample < 1:
+            sql += " TABLESAMPLE BERNOULLI (%s) REPEATABLE (%s)"
+            params += [sample * 100, seed]
+        sql += f" WHERE {embedding_column} IS NOT NULL"
+        if ids is not None:
+            sql += f" AND {id_column} = ANY(%s)"
+            params.append([int(i) for i in ids])
+        sql += f" ORDER BY {id_column}"
+        if limit is not None:
+            sql += " LIMIT %s"
+            params.append(limit)
+
+        # a named cursor keeps the result set on the server; rows arrive chunk by chunk
+        cursor = conn.cursor(name=f"embedding_loader_{uuid.uuid4().hex[:8]}")
+        cursor.itersize = chunk_size
+        dims = None
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                values = [bytes(row[1]) if binary else row[1] for row in rows]
+                try:
+                    chunk = decode(values)
+                    if dims is not None and chunk.shape[1] != dims:
+                        raise ValueError(f"expected {dims} dimensions, got {chunk.shape[1]}")
+                    keep = rows
+                except ValueError:
+                    # a ragged chunk: decode row by row and drop the bad rows
+                    decoded, keep = [], []
+                    for row, value in zip(rows, values):
+                        try:
+                            vector = decode([value])[0]
+                        except ValueError:
+                            vector = None
+                        if vector is not None and vector.size and (dims is None or vector.size == dims):
+                            dims = dims or vector.size
+                            decoded.append(vector)
+                            keep.append(row)
+                        else:
+                            event("embedding_malformed", level=logging.WARNING, table=table_name, column=embedding_column, row_id=row[0])
+                    if not keep:
+                        continue
+                    chunk = np.vstack(decoded)
+
+                dims = chunk.shape[1]
+                chunk_ids = np.fromiter((row[0] for row in keep), dtype=np.int64, count=len(keep))
+                yield chunk_ids, chunk, [row[2] for row in keep] if label_column else None
+        finally:
+            cursor.close()
+
+
+def load_embeddings(table_name, embedding_column, label_column=None, limit=None, chunk_size=5000, **kwargs):
+    """
+    Load iter_embeddings() chunks into one preallocated float32 matrix
+    (grown geometrically when the row count is not known up front).
+    """
+    ids = np.empty(0, dtype=np.int64)
+    vectors = None
+    labels = [] if label_column else None
+    count = 0
+
+    for chunk_ids, chunk, chunk_labels in iter_embeddings(
+        table_name, embedding_column, label_column, limit=limit, chunk_size=chunk_size, **kwargs
+    ):
+        if vectors is None:
+            capacity = limit or max(chunk_size, len(chunk))
+            vectors = np.empty((capacity, chunk.shape[1]), dtype=np.float32)
+            ids = np.empty(capacity, dtype=np.int64)
+        if count + len(chunk) > len(vectors):
+            capacity = max(len(vectors) * 2, count + len(chunk))
+            vectors = np.resize(vectors, (capacity, vectors.shape[1]))
+            ids = np.resize(ids, capacity)
+        vectors[count:count + len(chunk)] = chunk
+        ids[count:count + len(chunk)] = chunk_ids
+        if labels is not None:
+            labels.extend(chunk_labels)
+        count += len(chunk)
+
+    if vectors is None:
+        return EmbeddingMatrix(ids, np.empty((0, 0), dtype=np.float32), labels)
+    return EmbeddingMatrix(ids[:count].copy(), vectors[:count].copy(), labels)
@@ -0,0 +1,387 @@
+import hashlib
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from openai import OpenAI
+
+from app.db import NotificationListener, get_connection, listen_connection
+from app.embeddings import EMBEDDING_MODEL, bulk_write, embed_batch
+from app.metrics import event, registry, span
+from app.vector_search import vector_index as default_vector_index
+
+EMBEDDING_DIMS = int(os.getenv("EMBEDDING_DIMS", "1536"))
+NOTIFY_CHANNEL = "embedding_changes"
+MAINTAINER_BATCH_SIZE = int(os.getenv("EMBEDDING_MAINTAINER_BATCH_SIZE", "200"))
+MAINTAINER_QUEUE_SIZE = int(os.getenv("EMBEDDING_MAINTAINER_QUEUE_SIZE", "10000"))
+MAINTAINER_POLL_SECONDS = float(os.getenv("EMBEDDING_MAINTAINER_POLL_SECONDS", "300"))
+MAINTAINER_DEBOUNCE_SECONDS = float(os.getenv("EMBEDDING_MAINTAINER_DEBOUNCE_SECONDS", "1"))
+EMBEDDING_MAINTAINER_ENABLED = os.getenv("EMBEDDING_MAINTAINER", "false").lower() in ("1", "true", "yes")
+
+
+class EmbeddedTable(NamedTuple):
+    """How the text embedded for one table is built, as SQL over alias `t`."""
+    text: str
+    joins: str = ""
+    # columns whose update fires the change trigger
+    watch: Tuple[str, ...] = ("name", "description")
+    # (parent table, foreign key on t) for parents whose columns appear in the text
+    parents: Tuple[Tuple[str, str], ...] = ()
+
+
+_IN_DESTINATION = dict(
+    text="concat(t.name, ', ', t.description, ' in ', d.name)",
+    joins="JOIN destination d ON d.id = t.destination_id",
+    watch=("name", "description", "destination_id"),
+    parents=(("destination", "destination_id"),),
+)
+
+# The activity text matches what app.embeddings.run_backfill has always embedded
+EMBEDDED_TABLES: Dict[str, EmbeddedTable] = {
+    "must_travel_activity": EmbeddedTable(**_IN_DESTINATION),
+    "recommended_activity": EmbeddedTable(**_IN_DESTINATION),
+    "location": EmbeddedTable(**_IN_DESTINATION),
+    "hotel": EmbeddedTable(
+        text="concat(t.name, ', ', t.star, '-star hotel in ', t.location, ', ', t.description)",
+        watch=("name", "description", "location", "star"),
+    ),
+    "destination": EmbeddedTable(text="concat(t.name, ', ', t.description)"),
+}
+
+TRIGGER_FUNCTION_SQL = f"""
+    CREATE OR REPLACE FUNCTION notify_embedding_change() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{NOTIFY_CHANNEL}', TG_TABLE_NAME || ':' || NEW.id);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+# Rows whose text (md5 of the built text) or model differs from what was last embedded
+STALE_SQL = """
+    SELECT id, content, md5(content) FROM (
+        SELECT t.id, t.embedding IS NULL AS missing, t.embedding_hash, t.embedding_model, {text} AS content
+        FROM {table} t {joins}
+        WHERE t.id > %(after)s {filter}
+    ) AS source
+    WHERE missing OR embedding_hash IS DISTINCT FROM md5(content) OR embedding_model IS DISTINCT FROM %(model)s
+    ORDER BY id
+    LIMIT %(limit)s
+"""
+
+maintained_rows = registry.counter("embedding_maintainer_rows_total", "Rows re-embedded by the maintainer, by table.")
+
+
+def install_schema(connection_factory=get_connection, tables: Dict[str, EmbeddedTable] = EMBEDDED_TABLES, dims: int = EMBEDDING_DIMS):
+    """
+    Add embedding, embedding_hash and embedding_model columns and a change
+    trigger to every maintained table. Safe to run repeatedly.
+    """
+    with connection_factory() as conn:
+        cursor = conn.cursor()
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        cursor.execute(TRIGGER_FUNCTION_SQL)
+        for table, spec in tables.items():
+            cursor.execute(
+                f"""
+                ALTER TABLE {table}
+                    ADD COLUMN IF NOT EXISTS embedding vector({dims}),
+                    ADD COLUMN IF NOT EXISTS embedding_hash text,
+                    ADD COLUMN IF NOT EXISTS embedding_model text
+                """
+            )
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_embedding_change ON {table}")
+            cursor.execute(
+                f"""
+                CREATE TRIGGER {table}_embedding_change
+                AFTER INSERT OR UPDATE OF {", ".join(spec.watch)} ON {table}
+                FOR EACH ROW EXECUTE FUNCTION notify_embedding_change()
+                """
+            )
+        conn.commit()
+        cursor.close()
+
+
+class StubEmbedder:
+    """
+    Offline stand-in for the OpenAI client: `embeddings.create` returns
+    deterministic unit vectors seeded by each text, so tests and local runs
+    need no API key and identical text always gets the identical vector.
+    """
+
+    def __init__(self, dims: int = EMBEDDING_DIMS):
+        self.dims = dims
+        self.embeddings = self
+        self.requests = 0
+        self.texts = 0
+        self._lock = threading.Lock()
+
+    def create(self, input, model, **kwargs):
+        vectors = []
+        for text in input:
+            seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dims).astype(np.float32)
+            vectors.append(vector / np.linalg.norm(vector))
+        with self._lock:
+            self.requests += 1
+            self.texts += len(input)
+        return SimpleNamespace(
+            model=model,
+            data=[SimpleNamespace(index=i, embedding=vector.tolist()) for i, vector in enumerate(vectors)],
+            usage=SimpleNamespace(prompt_tokens=sum(len(text) // 4 for text in input), completion_tokens=0),
+        )
+
+
+class EmbeddingMaintainer:
+    """
+    Keeps embeddings current as catalog rows change.
+
+    Each maintained row stores the md5 of the text it was embedded from and
+    the model that embedded it; a row is stale when either differs. Two
+    sources feed the worker:
+    - NOTIFY from the change triggers, which puts (table, id) on a bounded
+      queue and is handled within about `debounce` seconds;
+    - a periodic sweep every `poll_interval` seconds over whole tables,
+      which catches anything the triggers missed (the listener was down,
+      triggers not installed, a model change).
+    When the queue is full, notifications are dropped and a sweep is
+    scheduled instead, so a bulk import costs one sweep rather than
+    unbounded memory. Re-embedded rows are patched into the in-process
+    vector index when it is loaded.
+    """
+
+    def __init__(
+        self,
+        client=None,
+        tables: Dict[str, EmbeddedTable] = EMBEDDED_TABLES,
+        model: str = EMBEDDING_MODEL,
+        connection_factory=get_connection,
+        listen_connection_factory=listen_connection,
+        vector_index=default_vector_index,
+        batch_size: int = MAINTAINER_BATCH_SIZE,
+        queue_size: int = MAINTAINER_QUEUE_SIZE,
+        poll_interval: float = MAINTAINER_POLL_SECONDS,
+        debounce: float = MAINTAINER_DEBOUNCE_SECONDS,
+    ):
+        self.client = client
+        self.tables = dict(tables)
+        self.model = model
+        self.connection_factory = connection_factory
+        self.listen_connection_factory = listen_connection_factory
+        self.vector_index = vector_index
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.queue: "queue.Queue[Tuple[str, int]]" = queue.Queue(maxsize=queue_size)
+        self.stats = {"notifications": 0, "dropped": 0, "sweeps": 0, "rows": 0, "failures": 0}
+        # the worker, the LISTEN thread and callers of refresh() all count
+        self._stats_lock = threading.Lock()
+        self._sweep_requested = threading.Event()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._listener: Optional[NotificationListener] = None
+
+    # ------------------------------------------------------------ embedding
+
+    def refresh(self, table: str, ids: Optional[Iterable[int]] = None, column: str = "id") -> int:
+        """
+        Re-embed the stale rows of `table`, optionally only those whose
+        `column` is in `ids`. Returns the number of rows written.
+        """
+        spec = self.tables[table]
+        ids = None if ids is None else sorted(set(ids))
+        sql = STALE_SQL.format(
+            table=table,
+            text=spec.text,
+            joins=spec.joins,
+            filter=f"AND t.{column} = ANY(%(ids)s)" if ids is not None else "",
+        )
+        client = self.client
+        if client is None:
+            client = self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+        total, after = 0, 0
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            try:
+                while True:
+                    cursor.execute(sql, {"after": after, "ids": ids, "model": self.model, "limit": self.batch_size})
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    row_ids = [row[0] for row in rows]
+                    with span("maintainer_embed", table=table, rows=len(rows)):
+                        vectors = embed_batch(client, [row[1] for row in rows], self.model)
+                    with span("maintainer_write", table=table, rows=len(rows)):
+                        bulk_write(cursor, table, row_ids, vectors, hashes=[row[2] for row in rows], model=self.model)
+                        conn.commit()
+                    total += len(rows)
+                    self._count("rows", len(rows))
+                    maintained_rows.inc(len(rows), table=table)
+                    after = row_ids[-1]
+                    self._reindex(table, row_ids)
+                    if len(rows) < self.batch_size:
+                        break
+            finally:
+                cursor.close()
+
+        if total:
+            event("embeddings_refreshed", table=table, rows=total)
+        return total
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _reindex(self, table: str, ids: List[int]):
+        index = self.vector_index
+        if index is not None and index.loaded_at is not None and table in index.tables:
+            index.reload_rows(table, ids)
+
+    def apply(self, changes: Dict[str, Iterable[int]]) -> int:
+        """Re-embed changed rows, plus child rows whose text includes a changed parent."""
+        total = 0
+        for table, ids in changes.items():
+            ids = list(ids)
+            targets = [(table, "id")] if table in self.tables else []
+            targets += [
+                (child, foreign_key)
+                for child, spec in self.tables.items()
+                for parent, foreign_key in spec.parents
+                if parent == table
+            ]
+            for target, column in targets:
+                try:
+                    total += self.refresh(target, ids, column)
+                except Exception as e:
+                    # the next sweep retries these rows
+                    self._count("failures")
+                    event("embedding_refresh_failed", level=logging.WARNING, table=target, error=str(e))
+        return total
+
+    def sweep(self) -> int:
+        """Check every maintained table for stale rows."""
+        self._count("sweeps")
+        total = 0
+        for table in self.tables:
+            try:
+                total += self.refresh(table)
+            except Exception as e:
+                self._count("failures")
+                event("embedding_refresh_failed", level=logging.WARNING, table=table, error=str(e))
+        return total
+
+    # ------------------------------------------------------------ background
+
+    def start(self, listen: bool = True):
+        """Start the worker thread (and the LISTEN thread) as daemons."""
+        if self._worker is not None:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._work, name="embedding-maintainer", daemon=True)
+        self._worker.start()
+        if listen:
+            self._listener = NotificationListener(
+                NOTIFY_CHANNEL, self._enqueue, on_reconnect=self.request_sweep, connect=self.listen_connection_factory
+            )
+            self._listener.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._listener is not None:
+            self._listener.stop(timeout)
+            self._listener = None
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+
+    @property
+    def listening(self) -> bool:
+        return self._listener is not None and self._listener.listening
+
+    def request_sweep(self):
+        self._sweep_requested.set()
+
+    def _work(self):
+        # rows edited while nothing was listening are caught by the first sweep
+        next_sweep = time.monotonic()
+        while not self._stop.is_set():
+            if self._sweep_requested.is_set() or time.monotonic() >= next_sweep:
+                self._sweep_requested.clear()
+                self.sweep()
+                next_sweep = time.monotonic() + self.poll_interval
+                continue
+            try:
+                table, row_id = self.queue.get(timeout=min(1.0, max(0.0, next_sweep - time.monotonic())))
+            except queue.Empty:
+                continue
+
+            # collect a batch: whatever arrives within the debounce window
+            changes = defaultdict(set)
+            changes[table].add(row_id)
+            pending, deadline = 1, time.monotonic() + self.debounce
+            while pending < self.batch_size:
+                try:
+                    table, row_id = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                changes[table].add(row_id)
+                pending += 1
+            self.apply(changes)
+
+    def _enqueue(self, payload: str):
+        table, _, row_id = payload.partition(":")
+        if not row_id.isdigit():
+            return
+        self._count("notifications")
+        try:
+            self.queue.put_nowait((table, int(row_id)))
+        except queue.Full:
+            self._count("dropped")
+            self.request_sweep()
+
+    def status(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {**stats, "queued": self.queue.qsize(), "listening": self.listening, "model": self.model}
+
+
+embedding_maintainer = EmbeddingMaintainer()
+
+
+@registry.collector
+def _maintainer_samples():
+    stats = embedding_maintainer.status()
+    return [
+        ("embedding_maintainer_queue_depth", "gauge", "Row changes waiting to be re-embedded.", [({}, stats["queued"])]),
+        ("embedding_maintainer_listening", "gauge", "1 while the LISTEN connection is up.", [({}, float(stats["listening"]))]),
+        ("embedding_maintainer_dropped_total", "counter", "Notifications dropped on a full queue (covered by a sweep).", [({}, stats["dropped"])]),
+        ("embedding_maintainer_sweeps_total", "counter", "Full stale-row sweeps.", [({}, stats["sweeps"])]),
+    ]
+
+
+if __name__ == "__main__":
+    # python -m app.embedding_maintainer [install|sweep|run]; EMBEDDING_STUB=true embeds offline
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if os.getenv("EMBEDDING_STUB", "false").lower() in ("1", "true", "yes"):
+        embedding_maintainer.client = StubEmbedder()
+    if command == "install":
+        install_schema()
+    elif command == "sweep":
+        print(f"re-embedded {embedding_maintainer.sweep()} rows")
+    else:
+        embedding_maintainer.start()
+        try:
+            while True:
+                time.sleep(60)
+                print(embedding_maintainer.status())
+        except KeyboardInterrupt:
+            embedding_maintainer.stop()
@@ -1,52 +1,173 @@
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+
 from openai import OpenAI
-import psycopg2
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
+from app.db import get_connection
+from app.llm import ResilientLLM, get_async_client
+from app.metrics import event, span
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Set your OpenAI API key
-client =  OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+EMBEDDING_MODEL = "text-embedding-ada-002"
+BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "1000"))
+REQUEST_SIZE = int(os.getenv("EMBEDDING_REQUEST_SIZE", "250"))
+CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+CHECKPOINT_PATH = os.getenv("EMBEDDING_CHECKPOINT_PATH", ".embedding_backfill.json")
+
+# A long batch job can wait out rate limits that an interactive turn cannot.
+backfill_llm = ResilientLLM(
+    get_async_client,
+    timeout=float(os.getenv("EMBEDDING_TIMEOUT", "60")),
+    deadline=float(os.getenv("EMBEDDING_DEADLINE", "600")),
+    max_retries=MAX_RETRIES,
+    backoff_max=60.0,
+    failure_threshold=int(os.getenv("EMBEDDING_BREAKER_FAILURES", "20")),
+)
+
+FETCH_SQL = """
+    SELECT mta.id, mta.name, mta.description, d.name as destination_name
+    FROM must_travel_activity mta
+    JOIN destination d ON mta.destination_id = d.id
+    WHERE mta.id > %s
+    ORDER BY mta.id
+    LIMIT %s;
+"""
+
+
+def embed_texts(client, texts: Sequence[str], model: str = EMBEDDING_MODEL) -> List[List[float]]:
+    """
+    Embed many texts in a single API request. Retries, backoff and circuit
+    breaking come from app.llm, with a backfill-sized retry budget.
+    """
+    response = backfill_llm.embed(client, input=list(texts), model=model)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
 
-# Connect to PostgreSQL
-connection = psycopg2.connect(os.getenv("DATABASE_URL"))
 
-cursor = connection.cursor()
+def embed_batch(
+    client,
+    texts: Sequence[str],
+    model: str = EMBEDDING_MODEL,
+    request_size: int = REQUEST_SIZE,
+    concurrency: int = CONCURRENCY,
+) -> List[List[float]]:
+    """Split texts into multi-input requests and run a few of them concurrently."""
+    chunks = [texts[i:i + request_size] for i in range(0, len(texts), request_size)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = executor.map(lambda chunk: embed_texts(client, chunk, model), chunks)
+        return [vector for chunk_vectors in results for vector in chunk_vectors]
 
-# 1. Fetch all rows from your existing 'documents' table
-cursor.execute("SELECT mta.id, mta.name, mta.description, d.name as destination_name FROM must_travel_activity mta JOIN destination d ON mta.destination_id = d.id;")
-rows = cursor.fetchall()
 
-for row in rows:
-    doc_id = row[0]
-    name = row[1]
-    description = row[2]
-    destination_name = row[3]
+def to_vector_literal(vector) -> str:
+    return "[" + ",".join(str(x) for x in vector) + "]"
 
-    print("name: ", name)
-    print("description: ", description)
-    print("destination_name: ", destination_name)
 
-    # 2. Generate embedding for the content
-    response = client.embeddings.create(
-        input=[f"{name}, {description} in {destination_name}"],
-        model="text-embedding-ada-002"
+def bulk_write(
+    cursor,
+    table: str,
+    ids: Sequence[int],
+    vectors: Sequence[Sequence[float]],
+    hashes: Optional[Sequence[str]] = None,
+    model: Optional[str] = None,
+):
+    """
+    Stage (id, embedding) pairs in a temp table with one execute_values call,
+    then apply them with a single UPDATE ... FROM. With `hashes`, each row's
+    embedding_hash and embedding_model are recorded in the same UPDATE.
+    """
+    tracked = hashes is not None
+    cursor.execute(
+        "CREATE TEMP TABLE embedding_staging (id integer PRIMARY KEY, embedding text"
+        + (", content_hash text" if tracked else "")
+        + ") ON COMMIT DROP"
     )
+    literals = [to_vector_literal(vector) for vector in vectors]
+    execute_values(
+        cursor,
+        "INSERT INTO embedding_staging VALUES %s",
+        list(zip(ids, literals, hashes)) if tracked else list(zip(ids, literals)),
+        page_size=1000,
+    )
+    cursor.execute(
+        f"""
+        UPDATE {table} AS t
+        SET embedding = s.embedding::vector
+        {", embedding_hash = s.content_hash, embedding_model = %s" if tracked else ""}
+        FROM embedding_staging AS s
+        WHERE t.id = s.id
+        """,
+        (model,) if tracked else None,
+    )
+
 
-    embedding_vector = response.data[0].embedding  # This is a list of floats
+def load_checkpoint(path: str = CHECKPOINT_PATH) -> int:
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return json.load(f).get("last_id", 0)
 
-    # 3. Update the 'documents' table with the embedding
-    #    or insert into the dedicated 'document_embeddings' table
-    #    For example, if the embedding column is on the same table:
-    sql_update = """
-        UPDATE must_travel_activity
-        SET embedding = %s
-        WHERE id = %s
+
+def save_checkpoint(last_id: int, path: str = CHECKPOINT_PATH):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_id": last_id}, f)
+    os.replace(tmp_path, path)
+
+
+def run_backfill(
+    client,
+    batch_size: int = BATCH_SIZE,
+    checkpoint_path: Optional[str] = CHECKPOINT_PATH,
+    connection_factory=get_connection,
+    model: str = EMBEDDING_MODEL,
+) -> int:
     """
-    cursor.execute(sql_update, (embedding_vector, doc_id))
+    Embed every must_travel_activity row in id order, one committed batch at a
+    time. The id of the last committed row is checkpointed, so an interrupted
+    run picks up where it stopped.
+    """
+    last_id = load_checkpoint(checkpoint_path)
+    total = 0
+
+    with connection_factory() as connection:
+        cursor = connection.cursor()
+        while True:
+            with span("backfill_fetch"):
+                cursor.execute(FETCH_SQL, (last_id, batch_size))
+                rows = cursor.fetchall()
+            if not rows:
+                break
+
+            ids = [row[0] for row in rows]
+            texts = [f"{name}, {description} in {destination_name}" for _, name, description, destination_name in rows]
+            with span("backfill_embed", rows=len(texts)):
+                vectors = embed_batch(client, texts, model)
+
+            with span("backfill_write", rows=len(ids)):
+                bulk_write(cursor, "must_travel_activity", ids, vectors)
+                connection.commit()
+
+            last_id = ids[-1]
+            save_checkpoint(last_id, checkpoint_path)
+            total += len(ids)
+            event("backfill_progress", rows=total, last_id=last_id)
+
+        cursor.close()
+
+    return total
+
+
+if __name__ == "__main__":
+    import logging
 
-# Commit changes and close connection
-connection.commit()
-cursor.close()
-connection.close()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    # Set your OpenAI API key
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    run_backfill(client)
@@ -0,0 +1,285 @@
+import math
+import os
+import re
+import time
+from typing import Dict, List, NamedTuple
+
+# Example phrasings per tool. "chat" covers messages that need the model's
+# own reply (questions, summaries, small talk) rather than a tool.
+INTENT_EXAMPLES: Dict[str, List[str]] = {
+    "add_free_day": [
+        "add a free day",
+        "add free day for self exploration",
+        "add one more free day to the trip",
+        "i want an extra leisure day",
+        "give me another day off",
+        "include a free day",
+    ],
+    "remove_free_day": [
+        "remove free day",
+        "remove the free day from the itinerary",
+        "delete the free day",
+        "drop the leisure day",
+        "no free day please",
+        "cancel the free day",
+    ],
+    "replace_free_day": [
+        "replace free day with an activity",
+        "replace the free day with nusa penida tour",
+        "use the free day for a tour instead",
+    ],
+    "add_activity": [
+        "add a new activity snorkeling",
+        "add snorkeling at nusa dua",
+        "can you add a desert safari",
+        "include a cooking class",
+        "add an activity to the trip",
+    ],
+    "remove_activity": [
+        "remove activity ubud monkey forest",
+        "remove the desert safari",
+        "skip the city tour",
+        "delete the creek cruise",
+        "i dont want the burj khalifa visit",
+    ],
+    "reorder_activities": [
+        "move snorkeling to the first day",
+        "reorder the activities",
+        "swap day 2 and day 3 activities",
+        "do the desert safari on the last day",
+        "change the order of activities",
+    ],
+    "change_accommodation": [
+        "change accommodation to villa seminyak estate",
+        "change hotel",
+        "switch to a different hotel",
+        "stay somewhere else",
+    ],
+    "upgrade_accommodation": [
+        "upgrade hotel to four seasons",
+        "upgrade the accommodation",
+        "i want a luxury hotel",
+        "get a 5 star hotel",
+    ],
+    "downgrade_accommodation": [
+        "downgrade hotel",
+        "downgrade hotel to the kayon resort",
+        "cheaper hotel please",
+        "budget accommodation",
+    ],
+    "update_itinerary": [
+        "shorten the trip by one day",
+        "make the trip 3 nights",
+        "change the itinerary",
+        "update the itinerary with my changes",
+    ],
+    "chat": [
+        "show me the itinerary",
+        "what is included",
+        "summarize day 2",
+        "what are the exclusions",
+        "hi",
+        "hello",
+        "thanks",
+        "how much does it cost",
+        "looks good",
+        "what time is check in",
+    ],
+}
+
+# Tools that need no arguments can be dispatched without the large model.
+ARGUMENT_FREE_TOOLS = {"add_free_day", "remove_free_day"}
+
+_SYNONYMS = {
+    "delete": "remove", "drop": "remove", "cancel": "remove", "skip": "remove", "without": "remove",
+    "scrap": "remove", "rid": "remove", "eliminate": "remove", "ditch": "remove",
+    "extra": "add", "another": "add", "include": "add", "more": "add",
+    "leisure": "free", "off": "free", "rest": "free", "relax": "free",
+    "hotel": "accommodation", "stay": "accommodation", "resort": "accommodation", "villa": "accommodation",
+    "luxury": "upgrade", "better": "upgrade", "cheaper": "downgrade", "budget": "downgrade",
+    "switch": "change", "move": "reorder", "swap": "reorder", "order": "reorder",
+    "days": "day", "activities": "activity",
+    "thank": "thanks", "see": "show", "view": "show", "display": "show", "summary": "summarize", "overview": "summarize",
+}
+_STOPWORDS = {"a", "an", "the", "to", "of", "for", "please", "can", "you", "i", "me", "my", "want", "would", "like", "it", "from", "in", "on"}
+_NEGATIONS = {"not", "dont", "don't", "never", "no", "keep"}
+# Numbers, ordinals and day or position references are arguments the local
+# handlers would ignore ("add a free day on day 2"), so such messages go to the model.
+_ARGUMENTS = re.compile(
+    r"\d|\b(two|three|four|five|six|seven|eight|nine|ten|first|second|third|fourth|fifth|sixth|seventh|eighth|ninth|tenth"
+    r"|last|final|next|penultimate|before|after|between|instead|tomorrow|today|tonight"
+    r"|monday|tuesday|wednesday|thursday|friday|saturday|sunday|day one)\b"
+)
+# Words that may surround an intent phrase without adding an argument. Any
+# other word the matched tool's examples do not use ("add a free day in Abu
+# Dhabi", "... at the beach") is content the local handler would drop.
+_FILLER = {
+    "trip", "itinerary", "plan", "package", "holiday", "vacation", "tour",
+    "just", "also", "some", "somewhere", "could", "should", "shall", "will", "we", "us", "our",
+    "let", "let's", "need", "get", "put", "out", "take", "is", "be", "have", "that", "this", "there",
+    "ok", "okay", "and",
+}
+
+
+def _tokens(text: str) -> List[str]:
+    words = re.findall(r"[a-z0-9']+", text.lower())
+    return [_SYNONYMS.get(w, w) for w in words if w not in _STOPWORDS]
+
+
+def _features(text: str) -> Dict[str, float]:
+    tokens = _tokens(text)
+    features = {t: 1.0 for t in tokens}
+    for a, b in zip(tokens, tokens[1:]):
+        features[f"{a} {b}"] = 1.5
+    return features
+
+
+def _cosine(a: Dict[str, float], b: Dict[str, float]) -> float:
+    dot = sum(v * b[k] for k, v in a.items() if k in b)
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+class Intent(NamedTuple):
+    tool: str
+    confidence: float
+    margin: float
+    direct: bool
+
+
+class IntentRouter:
+    """
+    Cheap first-stage router in front of gpt-4o.
+
+    Messages are scored against the example phrasings of each tool with a
+    unigram+bigram cosine (plus a small synonym map). A confident match on
+    an argument-free tool is flagged `direct`, and the caller runs the local
+    handler. Every other message still goes to the large model, as does
+    any message with a negation, a question mark at the end, an argument
+    (a number, ordinal, day or position reference), or any word beyond
+    the matched tool's own vocabulary and a few filler words.
+    """
+
+    def __init__(self, examples: Dict[str, List[str]] = INTENT_EXAMPLES, threshold: float = 0.7, min_margin: float = 0.2):
+        self.threshold = threshold
+        self.min_margin = min_margin
+        self._examples = [(tool, _features(text)) for tool, texts in examples.items() for text in texts]
+        self._vocabulary = {tool: {token for text in texts for token in _tokens(text)} for tool, texts in examples.items()}
+
+    def classify(self, message: str) -> Intent:
+        query = _features(message)
+        best: Dict[str, float] = {}
+        for tool, example in self._examples:
+            best[tool] = max(best.get(tool, 0.0), _cosine(query, example))
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)
+        (tool, confidence), runner_up = ranked[0], ranked[1][1] if len(ranked) > 1 else 0.0
+        lowered = message.lower()
+        negated = bool(_NEGATIONS & set(re.findall(r"[a-z']+", lowered)))
+        has_arguments = bool(_ARGUMENTS.search(lowered)) or lowered.rstrip().endswith("?")
+        # e.g. a place ("in Abu Dhabi") left over once the intent phrase is matched
+        has_arguments = has_arguments or bool(set(_tokens(message)) - self._vocabulary.get(tool, set()) - _FILLER)
+        direct = (
+            tool in ARGUMENT_FREE_TOOLS
+            and confidence >= self.threshold
+            and confidence - runner_up >= self.min_margin
+            and not negated
+            and not has_arguments
+        )
+        return Intent(tool, confidence, confidence - runner_up, direct)
+
+
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER", "true").lower() in ("1", "true", "yes")
+intent_router = IntentRouter(
+    threshold=float(os.getenv("INTENT_ROUTER_THRESHOLD", "0.7")),
+    min_margin=float(os.getenv("INTENT_ROUTER_MARGIN", "0.2")),
+)
+
+# Labeled queries for the evaluation harness: (message, expected tool or
+# "chat", whether a direct dispatch is acceptable). They are held out from
+# INTENT_EXAMPLES: none repeats an example phrasing.
+LABELED_QUERIES = [
+    ("please add a free day to my trip", "add_free_day", True),
+    ("could you put in a free day", "add_free_day", True),
+    ("add one more day for relaxing", "add_free_day", True),
+    ("I need a rest day somewhere in the trip", "add_free_day", True),
+    ("can I get an extra leisure day?", "add_free_day", False),
+    ("add free day on day 2", "add_free_day", False),
+    ("add two free days", "add_free_day", False),
+    ("add a free day before departure", "add_free_day", False),
+    ("shall we add a free day?", "add_free_day", False),
+    ("add a free day in Abu Dhabi", "add_free_day", False),
+    ("add a free day at the beach", "add_free_day", False),
+    ("add a free day for shopping", "add_free_day", False),
+    ("add a free day to the itinerary", "add_free_day", True),
+    ("let's add a free day", "add_free_day", True),
+    ("take out the free day", "remove_free_day", True),
+    ("scrap the leisure day from the plan", "remove_free_day", True),
+    ("get rid of the day off", "remove_free_day", True),
+    ("I don't need the free day, drop it", "remove_free_day", False),
+    ("remove the free day on day 4", "remove_free_day", False),
+    ("remove the second free day", "remove_free_day", False),
+    ("remove the free day in Ubud", "remove_free_day", False),
+    ("delete the free day at the end of the trip", "remove_free_day", False),
+    ("can we ditch the free day", "remove_free_day", True),
+    ("don't remove the free day", "chat", False),
+    ("swap the free day for a Nusa Penida tour", "replace_free_day", False),
+    ("add snorkeling in Bali", "add_activity", False),
+    ("please include a jeep tour", "add_activity", False),
+    ("remove the Ubud monkey forest", "remove_activity", False),
+    ("I'd rather skip the water park", "remove_activity", False),
+    ("put the temple visit on day 1", "reorder_activities", False),
+    ("change my hotel to Villa Seminyak", "change_accommodation", False),
+    ("move my stay to a different hotel", "change_accommodation", False),
+    ("upgrade to Four Seasons Resort", "upgrade_accommodation", False),
+    ("find me a cheaper place to stay", "downgrade_accommodation", False),
+    ("make it a 3 night trip", "update_itinerary", False),
+    ("let me see the full itinerary", "chat", False),
+    ("what's included in the package?", "chat", False),
+    ("give me a summary of day 3", "chat", False),
+    ("good morning", "chat", False),
+    ("show me an overview of the trip", "chat", False),
+    ("thank you so much", "chat", False),
+    ("which meals are excluded", "chat", False),
+    ("is the free day really free?", "chat", False),
+]
+
+
+def evaluate(router: IntentRouter = intent_router, queries=LABELED_QUERIES, model_latency: float = 2.5) -> dict:
+    """
+    Score the router on labeled queries. Top-1 accuracy covers every
+    message. Direct precision is the share of locally dispatched messages
+    that really were that tool and carried no arguments; those are the
+    only decisions that skip the model. Latency saved assumes each skipped
+    gpt-4o call takes `model_latency` seconds.
+    """
+    seen = {tuple(_tokens(text)) for texts in INTENT_EXAMPLES.values() for text in texts}
+    leaked = [message for message, _, _ in queries if tuple(_tokens(message)) in seen]
+    if leaked:
+        raise ValueError(f"labeled queries repeat example phrasings: {leaked}")
+    correct = direct = direct_correct = 0
+    start = time.perf_counter()
+    for message, expected, direct_ok in queries:
+        intent = router.classify(message)
+        correct += intent.tool == expected
+        if intent.direct:
+            direct += 1
+            direct_correct += intent.tool == expected and direct_ok
+    classify_seconds = time.perf_counter() - start
+    return {
+        "queries": len(queries),
+        "top1_accuracy": correct / len(queries),
+        "direct_dispatches": direct,
+        "direct_precision": direct_correct / direct if direct else 1.0,
+        "escalated": len(queries) - direct,
+        "classifier_ms_per_query": classify_seconds / len(queries) * 1000,
+        "model_seconds_saved": direct_correct * model_latency - classify_seconds,
+    }
+
+
+if __name__ == "__main__":
+    for message, expected, direct_ok in LABELED_QUERIES:
+        intent = intent_router.classify(message)
+        flag = "direct" if intent.direct else "escalate"
+        mark = "ok " if intent.tool == expected and (direct_ok or not intent.direct) else "ERR"
+        print(f"{mark} {flag:8} {intent.tool:24} {intent.confidence:.2f} (+{intent.margin:.2f})  {message}")
+    print(evaluate(model_latency=float(os.getenv("ROUTER_MODEL_LATENCY", "2.5"))))
@@ -0,0 +1,459 @@
+import copy
+import json
+import re
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+
+
+class DayPlan(BaseModel):
+    day: int
+    title: str
+    description: str
+
+
+class Inclusions(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    airfare: Optional[str] = None
+    accommodation: Optional[str] = None
+    meals: Optional[str] = None
+    transportation: Dict[str, str] = {}
+    insurance: Optional[str] = None
+    taxes: Optional[str] = None
+
+
+class ContactDetails(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    phone: Optional[str] = None
+    email: Optional[str] = None
+    social: Optional[str] = None
+
+
+class Itinerary(BaseModel):
+    """Typed view of a travel package, shaped like the `itineary` dict in main."""
+
+    model_config = ConfigDict(populate_by_name=True, extra="allow")
+
+    package_name: str = Field(alias="packageName")
+    rating: Optional[float] = None
+    duration: str
+    inclusions: Inclusions
+    itinerary: List[DayPlan]
+    exclusions: List[str] = []
+    contact_details: Optional[ContactDetails] = Field(default=None, alias="contactDetails")
+
+    def to_dict(self) -> dict:
+        return self.model_dump(by_alias=True, exclude_none=True)
+
+
+class PatchError(ValueError):
+    pass
+
+
+def _parse_pointer(pointer: str) -> List[str]:
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise PatchError(f"Invalid JSON pointer: {pointer}")
+    return [part.replace("~1", "/").replace("~0", "~") for part in pointer[1:].split("/")]
+
+
+def _resolve(document, parts: List[str]):
+    target = document
+    for part in parts:
+        target = target[int(part)] if isinstance(target, list) else target[part]
+    return target
+
+
+def _add(parent, key: str, value):
+    if isinstance(parent, list):
+        parent.insert(len(parent) if key == "-" else int(key), value)
+    else:
+        parent[key] = value
+
+
+def _remove(parent, key: str):
+    if isinstance(parent, list):
+        return parent.pop(int(key))
+    return parent.pop(key)
+
+
+def apply_patch(document: dict, operations: List[dict]) -> dict:
+    """
+    Apply JSON Patch (RFC 6902) add/remove/replace/move/test operations to
+    `document` in place and return it.
+    """
+    try:
+        for op in operations:
+            parts = _parse_pointer(op["path"])
+            parent = _resolve(document, parts[:-1])
+            key = parts[-1]
+            if op["op"] == "add":
+                _add(parent, key, copy.deepcopy(op["value"]))
+            elif op["op"] == "remove":
+                _remove(parent, key)
+            elif op["op"] == "replace":
+                if isinstance(parent, list):
+                    parent[int(key)] = copy.deepcopy(op["value"])
+                else:
+                    parent[key] = copy.deepcopy(op["value"])
+            elif op["op"] == "move":
+                from_parts = _parse_pointer(op["from"])
+                value = _remove(_resolve(document, from_parts[:-1]), from_parts[-1])
+                _add(parent, key, value)
+            elif op["op"] == "test":
+                if _resolve(document, parts) != op["value"]:
+                    raise PatchError(f"Test failed at {op['path']}")
+            else:
+                raise PatchError(f"Unsupported operation: {op['op']}")
+    except (KeyError, IndexError, ValueError, TypeError) as e:
+        if isinstance(e, PatchError):
+            raise
+        raise PatchError(f"Could not apply {op}: {e}") from e
+    return document
+
+
+# --- local edit planners -----------------------------------------------------
+# Each returns a list of patch operations, or None when the request cannot be
+# resolved deterministically and should go to the LLM instead.
+
+_ORDINALS = {
+    "first": 1, "second": 2, "third": 3, "fourth": 4, "fifth": 5,
+    "sixth": 6, "seventh": 7, "eighth": 8, "ninth": 9, "tenth": 10,
+    "last": -1,
+}
+
+
+def _words(text: str) -> set:
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def _sentences(text: str) -> List[str]:
+    return [s for s in re.split(r"(?<=\.)\s+", text.strip()) if s]
+
+
+_FILLER = {"the", "a", "an", "at", "in", "to", "of", "with", "and", "for", "on", "tour", "visit"}
+_GENERIC = {"standard", "half", "full", "day", "top", "return", "shared", "private", "transfer", "transfers"}
+
+
+def _named(text: str) -> set:
+    # the activity a sentence names, without "(...)" notes and "with ... transfer" clauses
+    text = re.split(r"\bwith\b", re.sub(r"\([^)]*\)", " ", text), maxsplit=1, flags=re.I)[0]
+    return _words(text) - _FILLER - _GENERIC
+
+
+def _matches(activity: str, text: str) -> bool:
+    # both ways round, so "hotel" does not match "Buffet breakfast at the hotel."
+    wanted = _words(activity) - _FILLER - _GENERIC
+    named = _named(text)
+    if not wanted or not named:
+        return False
+    shared = len(wanted & named)
+    return shared / len(wanted) >= 0.6 and shared / len(named) > 0.5
+
+
+def _title_parts(title: str) -> List[str]:
+    return [part.strip() for part in re.split(r"\s+(?:and|&)\s+|,\s*", title) if part.strip()]
+
+
+def _title_without(title: str, activity: str) -> str:
+    parts = _title_parts(title)
+    kept = [part for part in parts if not _matches(activity, part)]
+    if len(kept) == len(parts):
+        return title
+    return " and ".join(kept) if kept else "Day at Leisure"
+
+
+def _duration_ops(document: dict, day_delta: int) -> List[dict]:
+    match = re.match(r"\s*(\d+)\s*Nights?\s*&\s*(\d+)\s*Days?", document.get("duration", ""), re.I)
+    if not match:
+        return []
+    nights, days = int(match.group(1)) + day_delta, int(match.group(2)) + day_delta
+    return [{"op": "replace", "path": "/duration", "value": f"{nights} Nights & {days} Days"}]
+
+
+def _renumber_ops(days: List[dict], start: int, offset: int) -> List[dict]:
+    return [
+        {"op": "replace", "path": f"/itinerary/{i}/day", "value": days[i]["day"] + offset}
+        for i in range(start, len(days))
+    ]
+
+
+def _parse_day(day: str, total_days: int) -> Optional[int]:
+    day = day.lower()
+    number = re.search(r"\d+", day)
+    if number:
+        value = int(number.group())
+    else:
+        value = next((v for word, v in _ORDINALS.items() if word in day), None)
+        if value is None:
+            return None
+    if value == -1:
+        value = total_days
+    return value if 1 <= value <= total_days else None
+
+
+def plan_add_free_day(document: dict) -> Optional[List[dict]]:
+    days = document["itinerary"]
+    # a free day goes in before the departure day
+    index = max(len(days) - 1, 0)
+    number = days[index]["day"] if days else 1
+    free_day = {
+        "day": number,
+        "title": "Free Day for Exploration",
+        "description": "Buffet breakfast at the hotel. The day is free for you to explore at your own pace. Overnight at the hotel.",
+    }
+    # renumber on the pre-insert indices, then insert
+    return _renumber_ops(days, index, 1) + [
+        {"op": "add", "path": f"/itinerary/{index}", "value": free_day},
+    ] + _duration_ops(document, 1)
+
+
+def plan_remove_free_day(document: dict) -> Optional[List[dict]]:
+    days = document["itinerary"]
+    for index in range(len(days) - 1, -1, -1):
+        if "free day" in days[index]["title"].lower():
+            return [{"op": "remove", "path": f"/itinerary/{index}"}] + [
+                {"op": "replace", "path": f"/itinerary/{i - 1}/day", "value": days[i]["day"] - 1}
+                for i in range(index + 1, len(days))
+            ] + _duration_ops(document, -1)
+    return None
+
+
+def plan_remove_activity(document: dict, activity: str) -> Optional[List[dict]]:
+    ops = []
+    edited_days = 0
+    for index, day in enumerate(document["itinerary"]):
+        sentences = _sentences(day["description"])
+        kept = [s for s in sentences if not _matches(activity, s)]
+        if len(kept) != len(sentences):
+            edited_days += 1
+            ops.append({"op": "replace", "path": f"/itinerary/{index}/description", "value": " ".join(kept)})
+            title = _title_without(day["title"], activity)
+            if title != day["title"]:
+                ops.append({"op": "replace", "path": f"/itinerary/{index}/title", "value": title})
+    if edited_days != 1:
+        # no day sentence names it (dropping only the inclusion would leave
+        # the day text describing it), or several days do: let the model decide
+        return None
+    for key, value in document.get("inclusions", {}).get("transportation", {}).items():
+        if _matches(activity, value):
+            ops.append({"op": "remove", "path": f"/inclusions/transportation/{key}"})
+    return ops
+
+
+def plan_reorder_activities(document: dict, activity: str, day: str) -> Optional[List[dict]]:
+    days = document["itinerary"]
+    target = _parse_day(day, len(days))
+    if target is None:
+        return None
+    target_index = next((i for i, d in enumerate(days) if d["day"] == target), None)
+
+    for index, current in enumerate(days):
+        moved = [s for s in _sentences(current["description"]) if _matches(activity, s)]
+        if not moved or target_index is None:
+            continue
+        if index == target_index:
+            # already there; the request means something else
+            return None
+        remaining = [s for s in _sentences(current["description"]) if s not in moved]
+        target_sentences = _sentences(days[target_index]["description"])
+        # keep "Overnight at the hotel." style closers last
+        insert_at = len(target_sentences) - 1 if target_sentences and target_sentences[-1].lower().startswith("overnight") else len(target_sentences)
+        target_sentences[insert_at:insert_at] = moved
+        ops = [
+            {"op": "replace", "path": f"/itinerary/{index}/description", "value": " ".join(remaining)},
+            {"op": "replace", "path": f"/itinerary/{target_index}/description", "value": " ".join(target_sentences)},
+        ]
+        # the activity's part of the source day's title moves with it
+        titled = [part for part in _title_parts(current["title"]) if _matches(activity, part)]
+        if titled:
+            ops += [
+                {"op": "replace", "path": f"/itinerary/{index}/title", "value": _title_without(current["title"], activity)},
+                {"op": "replace", "path": f"/itinerary/{target_index}/title", "value": " and ".join([days[target_index]["title"], *titled])},
+            ]
+        return ops
+    return None
+
+
+LOCAL_EDITS = {
+    "add_free_day": plan_add_free_day,
+    "remove_free_day": plan_remove_free_day,
+    "remove_activity": plan_remove_activity,
+    "reorder_activities": plan_reorder_activities,
+}
+
+
+def apply_edit(document: dict, operations: List[dict]) -> dict:
+    """Apply operations to a copy of `document` and validate the result."""
+    updated = apply_patch(copy.deepcopy(document), operations)
+    Itinerary.model_validate(updated)
+    return updated
+
+
+def parse_itinerary(text: str) -> Optional[dict]:
+    """Extract and validate an itinerary JSON object from LLM output."""
+    match = re.search(r"\{.*\}", text or "", re.S)
+    if not match:
+        return None
+    try:
+        document = json.loads(match.group())
+        Itinerary.model_validate(document)
+        return document
+    except (json.JSONDecodeError, ValidationError):
+        return None
+
+
+def _escape(key) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def diff(old, new, path: str = "") -> List[dict]:
+    """JSON Patch operations turning `old` into `new` (replace-granular, no moves)."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+            else:
+                ops.extend(diff(old[key], new[key], f"{path}/{_escape(key)}"))
+        for key in new:
+            if key not in old:
+                ops.append({"op": "add", "path": f"{path}/{_escape(key)}", "value": new[key]})
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        for i in range(min(len(old), len(new))):
+            ops.extend(diff(old[i], new[i], f"{path}/{i}"))
+        for i in range(len(old), len(new)):
+            ops.append({"op": "add", "path": f"{path}/{i}", "value": new[i]})
+        # remove from the end so earlier indices stay valid
+        for i in range(len(old) - 1, len(new) - 1, -1):
+            ops.append({"op": "remove", "path": f"{path}/{i}"})
+        return ops
+    if old != new:
+        return [{"op": "replace", "path": path, "value": new}]
+    return []
+
+
+def summarize_ops(operations: List[dict], limit: int = 8, width: int = 80) -> str:
+    lines = []
+    for op in operations[:limit]:
+        line = f"{op['op']} {op['path']}"
+        if "value" in op:
+            value = op["value"] if isinstance(op["value"], str) else json.dumps(op["value"])
+            line += f" = {value[:width]}{'...' if len(value) > width else ''}"
+        lines.append(line)
+    if len(operations) > limit:
+        lines.append(f"(+{len(operations) - limit} more)")
+    return "\n".join(lines)
+
+
+class ItineraryVersions:
+    """
+    The session's current itinerary plus compact diffs of its recent changes.
+
+    The prompt shows only the current version in full. Recent changes appear
+    as patch summaries, and older versions are dropped, so the context never
+    holds more than one full copy of the itinerary.
+    """
+
+    def __init__(self, current: dict, version: int = 1, changes: Optional[List[dict]] = None, keep: int = 3):
+        self.current = current
+        self.version = version
+        self.changes = list(changes or [])[-keep:]
+        self.keep = keep
+
+    @classmethod
+    def from_state(cls, state: dict) -> "ItineraryVersions":
+        return cls(state["current"], state["version"], state.get("changes"))
+
+    def to_state(self) -> dict:
+        return {"current": self.current, "version": self.version, "changes": self.changes}
+
+    def commit(self, updated: dict, source: str) -> List[dict]:
+        """Record `updated` as the next version and return the operations applied."""
+        operations = diff(self.current, updated)
+        if operations:
+            self.version += 1
+            self.current = updated
+            self.changes.append({"version": self.version, "source": source, "summary": summarize_ops(operations)})
+            self.changes = self.changes[-self.keep:]
+        return operations
+
+    def change_note(self, operations: List[dict]) -> str:
+        """Short conversation message describing a committed change."""
+        if not operations:
+            return "The itinerary is unchanged."
+        return f"Itinerary updated to version {self.version}:\n{summarize_ops(operations)}"
+
+    def prompt_view(self) -> str:
+        view = f"(version {self.version}) {json.dumps(self.current)}"
+        if self.changes:
+            recent = "\n".join(f"v{c['version']} ({c['source']}):\n{c['summary']}" for c in self.changes)
+            view += f"\n\nRecent changes:\n{recent}"
+        return view
+
+
+# Benchmark: prompt tokens per turn with full-itinerary messages vs versioned deltas.
+# Replays recorded conversations from a JSONL file given as the first argument
+# ({"turns": [{"user": ..., "assistant": ..., "itinerary": {...}}]} per line);
+# without one, a conversation is synthesized from the local edit planners.
+if __name__ == "__main__":
+    import sys
+
+    from app.main import ROUTER_PROMPT, itineary
+    from app.sessions import estimate_tokens
+
+    def synthesize() -> List[dict]:
+        document = copy.deepcopy(itineary)
+        turns = [{"user": "show me the itinerary", "assistant": "Here is a brief summary of your trip..."}]
+        edits = [
+            ("add a free day", plan_add_free_day, {}),
+            ("remove the desert safari", plan_remove_activity, {"activity": "Desert Safari"}),
+            ("move the creek cruise to the first day", plan_reorder_activities, {"activity": "Dubai Creek Cruise", "day": "first"}),
+            ("remove the free day", plan_remove_free_day, {}),
+            ("remove the burj khalifa visit", plan_remove_activity, {"activity": "Burj Khalifa"}),
+        ]
+        for user, planner, kwargs in edits:
+            document = apply_edit(document, planner(document, **kwargs) or [])
+            turns.append({"user": user, "itinerary": document})
+            turns.append({"user": "looks good, what's included?", "assistant": "The package includes airfare, hotel and breakfast."})
+        return [{"turns": turns}]
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            conversations = [json.loads(line) for line in f if line.strip()]
+    else:
+        conversations = synthesize()
+
+    def tokens(messages: List[dict]) -> int:
+        return sum(estimate_tokens(m) for m in messages)
+
+    for n, conversation in enumerate(conversations):
+        start = conversation.get("itinerary", itineary)
+        legacy_system = {"role": "system", "content": ROUTER_PROMPT.replace("[complete_itinerary]", json.dumps(start))}
+        legacy, compact = [], []
+        versions = ItineraryVersions(copy.deepcopy(start))
+        legacy_total = compact_total = 0
+
+        print(f"conversation {n}:")
+        for i, turn in enumerate(conversation["turns"]):
+            legacy.append({"role": "user", "content": turn["user"]})
+            compact.append({"role": "user", "content": turn["user"]})
+            system = {"role": "system", "content": ROUTER_PROMPT.replace("[complete_itinerary]", versions.prompt_view())}
+            before, after = tokens([legacy_system] + legacy), tokens([system] + compact)
+            legacy_total += before
+            compact_total += after
+            print(f"  turn {i + 1}: {before} -> {after} prompt tokens ({100 * (before - after) / before:.0f}% less)")
+
+            if "itinerary" in turn:
+                legacy.append({"role": "assistant", "content": json.dumps(turn["itinerary"])})
+                compact.append({"role": "assistant", "content": versions.change_note(versions.commit(turn["itinerary"], "replay"))})
+            else:
+                legacy.append({"role": "assistant", "content": turn.get("assistant", "")})
+                compact.append({"role": "assistant", "content": turn.get("assistant", "")})
+
+        print(f"  total: {legacy_total} -> {compact_total} ({100 * (legacy_total - compact_total) / legacy_total:.0f}% less)")
@@ -0,0 +1,410 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from openai import AsyncOpenAI, OpenAI
+from dotenv import load_dotenv
+
+from app.aio import loop_local
+from app.metrics import event, openai_request_seconds, record_usage, registry
+
+load_dotenv()
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the API while a circuit breaker is open."""
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError", "RateLimitError")
+
+
+def retry_after(exc: Exception) -> Optional[float]:
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive retryable failures and
+    rejects calls for `reset_seconds`. After that, one probe call is let
+    through (half-open). Its result closes the breaker or opens it again;
+    a probe with no recorded result after another `reset_seconds` is
+    given up on and a new one is let through.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.probe_at = now
+                return True
+            if self.state == "half_open" and now - self.probe_at >= self.reset_seconds:
+                self.probe_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_cancelled(self):
+        """A call was cancelled before it finished; a pending probe counts as failed."""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class LatencyWindow:
+    """Recent successful call latencies, for choosing the hedge delay."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class ResilientLLM:
+    """
+    Wraps OpenAI calls with a per-attempt timeout and an overall deadline,
+    jittered exponential retry on 429/5xx/timeouts (honouring Retry-After),
+    and one circuit breaker per kind of call ("chat", "embeddings"). With
+    `hedge_percentile` set, a non-streaming call that has not returned
+    within that percentile of recent latencies gets a second identical
+    request, and the first response wins.
+
+    The SDK clients should be built with max_retries=0 so that retries
+    happen only here.
+    """
+
+    def __init__(
+        self,
+        async_client_factory: Callable[[], AsyncOpenAI],
+        sync_client_factory: Optional[Callable[[], OpenAI]] = None,
+        timeout: float = 60.0,
+        deadline: float = 85.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        hedge_percentile: Optional[float] = None,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0,
+    ):
+        self.async_client = async_client_factory
+        self.sync_client = sync_client_factory
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.breakers = {kind: CircuitBreaker(failure_threshold, reset_seconds) for kind in ("chat", "embeddings")}
+        self.latency = {kind: LatencyWindow() for kind in ("chat", "embeddings")}
+        self.stats = {"calls": 0, "retries": 0, "timeouts": 0, "failures": 0, "rejected": 0, "hedges": 0, "hedge_wins": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _backoff(self, attempt: int, exc: Exception) -> float:
+        delay = retry_after(exc)
+        if delay is None:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.5)
+        return delay
+
+    def _admit(self, kind: str, last_error: Optional[Exception]):
+        if not self.breakers[kind].allow():
+            self._count("rejected")
+            raise CircuitOpenError(f"{kind} circuit open") from last_error
+
+    def _failed(self, kind: str, exc: Exception, attempt: int, give_up_at: float) -> Optional[float]:
+        """Record a failed attempt; return the delay before retrying, or None to give up."""
+        if isinstance(exc, (asyncio.TimeoutError, TimeoutError)) or type(exc).__name__ == "APITimeoutError":
+            self._count("timeouts")
+        if not is_retryable(exc):
+            # the service answered; a bad request says nothing about its health
+            self.breakers[kind].record_success()
+            self._count("failures")
+            return None
+        self.breakers[kind].record_failure()
+        delay = self._backoff(attempt, exc)
+        if attempt == self.max_retries or time.monotonic() + delay >= give_up_at:
+            self._count("failures")
+            return None
+        self._count("retries")
+        event("openai_retry", level=logging.WARNING, kind=kind, error=f"{type(exc).__name__}: {exc}", attempt=attempt + 1, delay=delay)
+        return delay
+
+    def _succeeded(self, kind: str, started: float):
+        seconds = time.monotonic() - started
+        self.breakers[kind].record_success()
+        self.latency[kind].add(seconds)
+        openai_request_seconds.observe(seconds, kind=kind)
+
+    async def _hedged(self, kind: str, request: Callable[[float], Awaitable], timeout: float):
+        hedge_after = self.latency[kind].percentile(self.hedge_percentile)
+        if hedge_after is None or hedge_after >= timeout:
+            return await asyncio.wait_for(request(timeout), timeout)
+
+        give_up_at = time.monotonic() + timeout
+        first = asyncio.ensure_future(request(timeout))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self._count("hedges")
+                tasks.append(asyncio.ensure_future(request(give_up_at - time.monotonic())))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=give_up_at - time.monotonic(), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def acall(self, kind: str, request: Callable[[float], Awaitable], hedge: bool = False):
+        """
+        Run `request(timeout)` under the retry, deadline and breaker policy.
+        `request` must start a fresh API call each time it is invoked.
+        """
+        self._count("calls")
+        give_up_at = time.monotonic() + self.deadline
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            self._admit(kind, last_error)
+            timeout = min(self.timeout, give_up_at - time.monotonic())
+            started = time.monotonic()
+            try:
+                if hedge and self.hedge_percentile is not None:
+                    result = await self._hedged(kind, request, timeout)
+                else:
+                    result = await asyncio.wait_for(request(timeout), timeout)
+            except Exception as exc:
+                last_error = exc
+                delay = self._failed(kind, exc, attempt, give_up_at)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # cancelled (a tool deadline, a client disconnect): never leave a probe pending
+                self.breakers[kind].record_cancelled()
+                raise
+            self._succeeded(kind, started)
+            return result
+
+    def call(self, kind: str, request: Callable[[float], object]):
+        """Blocking counterpart of acall for batch jobs; never hedges."""
+        self._count("calls")
+        give_up_at = time.monotonic() + self.deadline
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            self._admit(kind, last_error)
+            started = time.monotonic()
+            try:
+                result = request(min(self.timeout, give_up_at - time.monotonic()))
+            except Exception as exc:
+                last_error = exc
+                delay = self._failed(kind, exc, attempt, give_up_at)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.breakers[kind].record_cancelled()
+                raise
+            self._succeeded(kind, started)
+            return result
+
+    async def achat(self, **kwargs):
+        response = await self.acall(
+            "chat",
+            lambda timeout: self.async_client().chat.completions.create(timeout=timeout, **kwargs),
+            hedge=True,
+        )
+        record_usage(kwargs.get("model"), response.usage)
+        return response
+
+    async def astream_chat(self, **kwargs):
+        """
+        Open a streaming completion; only establishing the stream is retried.
+        The last chunk carries `usage`, which the consumer passes to
+        app.metrics.record_usage.
+        """
+        return await self.acall(
+            "chat",
+            lambda timeout: self.async_client().chat.completions.create(
+                timeout=timeout, stream=True, stream_options={"include_usage": True}, **kwargs
+            ),
+        )
+
+    async def aembed(self, **kwargs):
+        response = await self.acall(
+            "embeddings",
+            lambda timeout: self.async_client().embeddings.create(timeout=timeout, **kwargs),
+            hedge=True,
+        )
+        record_usage(kwargs.get("model"), response.usage)
+        return response
+
+    def embed(self, client=None, **kwargs):
+        client = client or self.sync_client()
+        response = self.call("embeddings", lambda timeout: client.embeddings.create(timeout=timeout, **kwargs))
+        record_usage(kwargs.get("model"), getattr(response, "usage", None))
+        return response
+
+    def summary(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["breakers"] = {kind: breaker.state for kind, breaker in self.breakers.items()}
+        return stats
+
+
+_hedge_percentile = os.getenv("LLM_HEDGE_PERCENTILE")
+
+# One async client per event loop; retries are handled by ResilientLLM
+get_async_client = loop_local(lambda: AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0))
+
+llm = ResilientLLM(
+    get_async_client,
+    lambda: OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0),
+    timeout=float(os.getenv("LLM_TIMEOUT", "60")),
+    deadline=float(os.getenv("LLM_DEADLINE", "85")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    hedge_percentile=float(_hedge_percentile) if _hedge_percentile else None,
+    failure_threshold=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+    reset_seconds=float(os.getenv("LLM_BREAKER_RESET", "30")),
+)
+
+
+@registry.collector
+def _llm_samples():
+    summary = llm.summary()
+    return [
+        ("openai_client_events_total", "counter", "Resilient client outcomes (calls, retries, timeouts, hedges...).", [
+            ({"event": key}, value) for key, value in summary.items() if key != "breakers"
+        ]),
+        ("openai_circuit_open", "gauge", "1 while the circuit breaker for a call kind is not closed.", [
+            ({"kind": kind}, float(state != "closed")) for kind, state in summary["breakers"].items()
+        ]),
+    ]
+
+
+# Fault test: drive the resilient client against the stub server with injected
+# errors and stalls, and compare with bare SDK calls.
+if __name__ == "__main__":
+    from app.stub_llm import app as stub_app, start_stub_server
+
+    port = int(os.getenv("STUB_LLM_PORT", "8765"))
+    start_stub_server(port)
+    base_url = f"http://127.0.0.1:{port}/v1"
+    calls = int(os.getenv("FAULT_CALLS", "100"))
+    stub_app.state.latency = 0.05
+    stub_app.state.error_rate = float(os.getenv("STUB_LLM_ERROR_RATE", "0.2"))
+    stub_app.state.stall_rate = float(os.getenv("STUB_LLM_STALL_RATE", "0.05"))
+    stub_app.state.stall_seconds = 5.0
+
+    client_factory = loop_local(lambda: AsyncOpenAI(api_key="stub", base_url=base_url, max_retries=0))
+    messages = [{"role": "user", "content": "hello"}]
+
+    async def bare():
+        ok = 0
+        for _ in range(calls):
+            try:
+                await client_factory().chat.completions.create(model="gpt-4o", messages=messages, timeout=1.0)
+                ok += 1
+            except Exception:
+                pass
+        return ok
+
+    async def resilient(client: ResilientLLM):
+        ok = 0
+        latencies = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            try:
+                await client.achat(model="gpt-4o", messages=messages)
+                ok += 1
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                pass
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0.0
+        return ok, p99
+
+    async def outage(client: ResilientLLM):
+        stub_app.state.error_rate = 1.0
+        start = time.perf_counter()
+        for _ in range(20):
+            try:
+                await client.achat(model="gpt-4o", messages=messages)
+            except Exception:
+                pass
+        return time.perf_counter() - start
+
+    from app.aio import run_sync
+
+    print(f"bare SDK:  {run_sync(bare())}/{calls} succeeded")
+    plain = ResilientLLM(client_factory, timeout=1.0, deadline=10.0, backoff_base=0.05)
+    ok, p99 = run_sync(resilient(plain))
+    print(f"resilient: {ok}/{calls} succeeded, p99 {p99:.2f}s, {plain.summary()}")
+    hedged = ResilientLLM(client_factory, timeout=1.0, deadline=10.0, backoff_base=0.05, hedge_percentile=95)
+    ok, p99 = run_sync(resilient(hedged))
+    print(f"hedged:    {ok}/{calls} succeeded, p99 {p99:.2f}s, {hedged.summary()}")
+    seconds = run_sync(outage(hedged))
+    print(f"full outage: 20 calls failed in {seconds:.2f}s, {hedged.summary()}")
@@ -1,20 +1,38 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, FastAPI, HTTPException
 from pydantic import BaseModel
-import openai
 import os
-# from app.db import SessionLocal
-from typing import Any, List, Tuple
+from app.aio import run_sync
+from app.ann_index import ANN_AUTO_CREATE, ann_index
+from app.catalog_index import CATALOG_REFRESH_SECONDS, catalog_index
+from app.db import get_async_connection
+from app.embedding_cache import aget_embedding
+from app.embedding_maintainer import EMBEDDING_MAINTAINER_ENABLED, embedding_maintainer
+from app.intent_router import INTENT_ROUTER_ENABLED, intent_router
+from app.itinerary import LOCAL_EDITS, ItineraryVersions, PatchError, apply_edit, parse_itinerary
+from app.llm import CircuitOpenError, llm
+from app.metrics import event, observe_stage, record_usage, router as metrics_router, span, stage_summary, start_trace
+from app.profiler import profiler, router as profiler_router
+from app.rankings import RANKING_LIVE, ranking_index, router as rankings_router
+from app.response_cache import RESPONSE_CACHE_ENABLED, response_cache
+from app.sessions import session_store, trim_to_budget
+from app.tools import tool_registry
+from app.vector_search import VECTOR_SEARCH_BACKEND, vector_index
+from typing import Any, AsyncIterator, List, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
+import asyncio
 import json
+import time
+import logging
+import weakref
 import gradio as gr
+import uvicorn
 from dotenv import load_dotenv
-import psycopg2
 
 load_dotenv()
 
-# Initialize OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# semantic matching in the response cache compares query embeddings
+response_cache.embed = lambda query: aget_embedding(query, "text-embedding-ada-002", llm)
 
 itineary = {
   "packageName": "Dubai Standard Package",
@@ -78,8 +96,9 @@ itineary = {
   }
 }
 
-conversations = {
-}
+# Token budget for the conversation part of each router request (the system
+# prompt with the itinerary comes on top of this).
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
 
 tools = [
         {
@@ -90,16 +109,12 @@ tools = [
                 "parameters": {
                     "type": "object",
                     "properties": {
-                        "itinerary": {
-                            "type": "string",
-                            "description": "The complete itinerary in JSON in str format",
-                        },
                         "updated_changes": {
                             "type": "string",
                             "description": "The updated changes from the user in str format",
                         }
                     },
-                    "required": ["itinerary", "updated_changes"],
+                    "required": ["updated_changes"],
                 },
             }
         },
@@ -257,9 +272,7 @@ tools = [
     ]
 
 
-def generate_user_intentions(natural_language_query: str, complete_itinerary: str, userId: str) -> List[str]:
-    """Router Agent"""
-    prompt = f""" You are a manager agent of travelling company. Your main task is to understand
+ROUTER_PROMPT = """ You are a manager agent of travelling company. Your main task is to understand
     customer query and based on that you should reply back to the customer. 
     You will be provided with complete_itinerary as well to understand the user query.
 
@@ -304,163 +317,353 @@ def generate_user_intentions(natural_language_query: str, complete_itinerary: st
     complete_itinerary: [complete_itinerary]
     """
 
-    if userId not in conversations:
-        conversations[userId] = [{
-            "role": "system",
-            "content": prompt.replace("[complete_itinerary]", complete_itinerary)
-        }]
-    
-    conversations[userId].append({
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+
+def latency_summary() -> dict:
+    # time-to-first-token is the headline number; every stage is on /metrics
+    return stage_summary("time_to_first_token", "turn_total")
+
+
+async def _itinerary_versions(userId: str, default: str = None) -> ItineraryVersions:
+    # each session edits its own copy, seeded from the package it started with
+    state = await session_store.aget_state(userId, "itinerary")
+    if state is None:
+        versions = ItineraryVersions(json.loads(default) if default else itineary)
+        await session_store.aset_state(userId, "itinerary", versions.to_state())
+        return versions
+    return ItineraryVersions.from_state(state)
+
+
+def _system_prompt(versions: ItineraryVersions) -> str:
+    return ROUTER_PROMPT.replace("[complete_itinerary]", versions.prompt_view())
+
+
+async def _commit_itinerary(userId: str, versions: ItineraryVersions, updated: dict, source: str) -> str:
+    previous_prompt = _system_prompt(versions)
+    operations = versions.commit(updated, source)
+    await session_store.aset_state(userId, "itinerary", versions.to_state())
+    # version 1 is the shared package; later versions belong to this session
+    # alone, so cached replies for the superseded prompt can go
+    if operations and versions.version > 2:
+        response_cache.invalidate(previous_prompt)
+    return versions.change_note(operations)
+
+
+async def _start_turn(natural_language_query: str, complete_itinerary: str, userId: str) -> List[dict]:
+    versions = await _itinerary_versions(userId, complete_itinerary)
+    await session_store.aappend(userId, {
         "role": "user",
         "content": f"{natural_language_query}."
     })
 
-    
-    response = openai.chat.completions.create(
+    # The system prompt is rebuilt per request; only the turns are stored,
+    # trimmed to the token budget so the prompt does not grow without bound.
+    return [{
+        "role": "system",
+        "content": _system_prompt(versions)
+    }] + trim_to_budget(await session_store.amessages(userId), HISTORY_TOKEN_BUDGET)
+
+
+async def _conversation_history(userId: str) -> List[Tuple[str, str]]:
+    # conversation in the format [("user", "query"), ("assistant", "response")]
+    return await session_store.ahistory(userId)
+
+
+# Itinerary edits in one response must apply in order, so they share a per-session lock.
+_itinerary_locks = weakref.WeakValueDictionary()
+
+
+def _itinerary_lock(userId: str) -> asyncio.Lock:
+    lock = _itinerary_locks.get(userId)
+    if lock is None:
+        lock = _itinerary_locks[userId] = asyncio.Lock()
+    return lock
+
+
+def _describe_itinerary(document: dict) -> str:
+    days = "\n".join(f"Day {d['day']}: {d['title']}" for d in document["itinerary"])
+    return f"{document['packageName']} ({document['duration']})\n{days}"
+
+
+async def _store_llm_itinerary(userId: str, versions: ItineraryVersions, updated_itinerary: str) -> str:
+    # keep the rewrite only if it parses into a valid itinerary, and put a
+    # compact diff (not another full copy) into the conversation
+    parsed = parse_itinerary(updated_itinerary)
+    if parsed is None:
+        event("invalid_itinerary", level=logging.WARNING, chars=len(updated_itinerary or ""))
+        return "The itinerary could not be updated; it is unchanged."
+    return await _commit_itinerary(userId, versions, parsed, "update_itinerary")
+
+
+@tool_registry.register("update_itinerary", timeout=90)
+async def _update_itinerary_tool(userId: str, updated_changes: str, itinerary: str = None) -> str:
+    async with _itinerary_lock(userId):
+        versions = await _itinerary_versions(userId, itinerary)
+        updated_itinerary = await aupdate_itinerary(json.dumps(versions.current), updated_changes)
+        return await _store_llm_itinerary(userId, versions, updated_itinerary)
+
+
+@tool_registry.register_stream("update_itinerary")
+async def _stream_update_itinerary_tool(userId: str, updated_changes: str, itinerary: str = None) -> AsyncIterator[str]:
+    # the rewrite is shown token by token; the last value is the note for the conversation
+    async with _itinerary_lock(userId):
+        versions = await _itinerary_versions(userId, itinerary)
+        updated_itinerary = ""
+        async for updated_itinerary in astream_update_itinerary(json.dumps(versions.current), updated_changes):
+            yield updated_itinerary
+        yield await _store_llm_itinerary(userId, versions, updated_itinerary)
+
+
+@tool_registry.register("add_activity", timeout=20)
+async def _add_activity_tool(userId: str, activity: str, destination: str) -> str:
+    activities = await aget_acitivities(activity, destination)
+    return json.dumps(activities)
+
+
+def _local_edit_tool(function_name: str):
+    """
+    Apply a structured edit as JSON-Patch operations on the session itinerary.
+    Requests the planner cannot resolve fall back to the LLM rewrite.
+    """
+    planner = LOCAL_EDITS[function_name]
+
+    async def handler(userId: str, **kwargs) -> str:
+        async with _itinerary_lock(userId):
+            versions = await _itinerary_versions(userId)
+            operations = planner(versions.current, **kwargs)
+            if operations is not None:
+                try:
+                    updated = apply_edit(versions.current, operations)
+                    note = await _commit_itinerary(userId, versions, updated, function_name)
+                    return f"Applied {function_name}. {note}\n{_describe_itinerary(updated)}"
+                except PatchError as e:
+                    event("local_edit_failed", level=logging.WARNING, tool=function_name, error=str(e))
+
+            changes = f"{function_name.replace('_', ' ')}: {json.dumps(kwargs)}"
+            updated_itinerary = await aupdate_itinerary(json.dumps(versions.current), changes)
+            return await _store_llm_itinerary(userId, versions, updated_itinerary)
+    return handler
+
+
+def _placeholder_tool(function_name: str):
+    async def handler(userId: str, **kwargs) -> str:
+        return f"calling {function_name}"
+    return handler
+
+
+for _name in LOCAL_EDITS:
+    tool_registry.register(_name, timeout=90)(_local_edit_tool(_name))
+
+for _name in (
+    "replace_free_day",
+    "change_accommodation",
+    "upgrade_accommodation",
+    "downgrade_accommodation",
+):
+    tool_registry.register(_name)(_placeholder_tool(_name))
+
+
+async def _run_tool_calls(userId: str, calls: List[Tuple[str, str]]):
+    # tools run concurrently; results are appended in the order the model issued them
+    results = await tool_registry.dispatch(userId, calls)
+    for result in results:
+        if result is not None:
+            await session_store.aappend(userId, {
+                "role": "assistant",
+                "content": result
+            })
+
+
+async def agenerate_user_intentions(natural_language_query: str, complete_itinerary: str, userId: str) -> List[str]:
+    """Router Agent"""
+    start = time.perf_counter()
+    start_trace(session=userId, mode="generate")
+    with span("start_turn"):
+        messages = await _start_turn(natural_language_query, complete_itinerary, userId)
+
+    # unambiguous argument-free commands skip the model entirely
+    with span("intent_router"):
+        intent = intent_router.classify(natural_language_query) if INTENT_ROUTER_ENABLED else None
+    if intent is not None and intent.direct:
+        await _run_tool_calls(userId, [(intent.tool, "{}")])
+        observe_stage("turn_total", time.perf_counter() - start, route="direct")
+        return await _conversation_history(userId)
+
+    with span("response_cache"):
+        cached = await response_cache.lookup(messages) if RESPONSE_CACHE_ENABLED else None
+    if cached is not None:
+        await session_store.aappend(userId, {
+            "role": "assistant",
+            "content": cached
+        })
+        observe_stage("turn_total", time.perf_counter() - start, route="cache")
+        return await _conversation_history(userId)
+
+    with span("router_completion"):
+        response = await llm.achat(
+            model='gpt-4o',
+            messages=messages,
+            max_tokens=2000,
+            temperature=0,
+            tools=tools,
+        )
+
+    response_message = response.choices[0].message
+    result = response_message.content
+
+    if response_message.tool_calls:
+        await _run_tool_calls(userId, [
+            (tool_call.function.name, tool_call.function.arguments)
+            for tool_call in response_message.tool_calls
+        ])
+    else:
+        await session_store.aappend(userId, {
+            "role": "assistant",
+            "content": result
+        })
+        if RESPONSE_CACHE_ENABLED:
+            await response_cache.store(messages, result, time.perf_counter() - start)
+
+    observe_stage("turn_total", time.perf_counter() - start, route="model")
+    return await _conversation_history(userId)
+
+async def astream_user_intentions(natural_language_query: str, complete_itinerary: str, userId: str) -> AsyncIterator[List[Tuple[str, str]]]:
+    """
+    Streaming Router Agent: yields the conversation history each time new
+    tokens arrive, then once per tool call while tools run.
+    """
+    start = time.perf_counter()
+    start_trace(session=userId, mode="stream")
+    with span("start_turn"):
+        messages = await _start_turn(natural_language_query, complete_itinerary, userId)
+    history = await _conversation_history(userId)
+    yield history
+
+    # unambiguous argument-free commands skip the model entirely
+    with span("intent_router"):
+        intent = intent_router.classify(natural_language_query) if INTENT_ROUTER_ENABLED else None
+    if intent is not None and intent.direct:
+        await _run_tool_calls(userId, [(intent.tool, "{}")])
+        observe_stage("time_to_first_token", time.perf_counter() - start)
+        observe_stage("turn_total", time.perf_counter() - start, route="direct")
+        yield await _conversation_history(userId)
+        return
+
+    with span("response_cache"):
+        cached = await response_cache.lookup(messages) if RESPONSE_CACHE_ENABLED else None
+    if cached is not None:
+        await session_store.aappend(userId, {
+            "role": "assistant",
+            "content": cached
+        })
+        observe_stage("time_to_first_token", time.perf_counter() - start)
+        observe_stage("turn_total", time.perf_counter() - start, route="cache")
+        yield await _conversation_history(userId)
+        return
+
+    completion_start = time.perf_counter()
+    stream = await llm.astream_chat(
         model='gpt-4o',
-        messages=conversations[userId],
+        messages=messages,
         max_tokens=2000,
         temperature=0,
         tools=tools,
     )
-    
-    response_message = response.choices[0].message
-    result = response_message.content
 
-    if response_message.tool_calls:
-        for tool_call in response_message.tool_calls:
-            function_name = tool_call.function.name
-            if function_name == "update_itinerary":
-                function_args = json.loads(tool_call.function.arguments)
-                updated_itinerary = update_itinerary(function_args["itinerary"], function_args["updated_changes"])
-                print("Updated Itinerary: ", updated_itinerary)
-
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": updated_itinerary
-                })
-            elif function_name == "add_free_day":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling add_free_day"
-                })
-            elif function_name == "replace_free_day":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling replace_free_day"
-                })
-            elif function_name == "remove_free_day":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling remove_free_day"
-                })
-            elif function_name == "add_activity":
-                print("calling add_activity")
-                function_args = json.loads(tool_call.function.arguments)
-                activities = get_acitivities(function_args["activity"], function_args["destination"])
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": json.dumps(activities)
-                })
-            elif function_name == "remove_activity":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling remove_activity"
-                })
-            elif function_name == "reorder_activities":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling reorder_activities"
-                })
-            elif function_name == "change_accommodation":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling change_accommodation"
-                })
-            elif function_name == "upgrade_accommodation":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling upgrade_accommodation"
-                })
-            elif function_name == "downgrade_accommodation":
-                conversations[userId].append({
-                    "role": "assistant",
-                    "content": "calling downgrade_accommodation"
-                })
-            
+    content = ""
+    tool_calls = {}
+    first_token = True
+    async for chunk in stream:
+        if chunk.usage:
+            record_usage('gpt-4o', chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if first_token and (delta.content or delta.tool_calls):
+            first_token = False
+            observe_stage("time_to_first_token", time.perf_counter() - start)
+
+        if delta.content:
+            content += delta.content
+            yield history + [("assistant", content)]
+
+        # tool call names and arguments arrive in fragments keyed by index
+        for tool_call in delta.tool_calls or []:
+            call = tool_calls.setdefault(tool_call.index, {"name": "", "arguments": ""})
+            if tool_call.function and tool_call.function.name:
+                call["name"] += tool_call.function.name
+            if tool_call.function and tool_call.function.arguments:
+                call["arguments"] += tool_call.function.arguments
+            yield history + [("assistant", f"Preparing {call['name'] or 'tool call'}...")]
+    observe_stage("router_completion", time.perf_counter() - completion_start)
+
+    calls = [(tool_calls[index]["name"], tool_calls[index]["arguments"]) for index in sorted(tool_calls)]
+    history = await _conversation_history(userId)
+    if len(calls) == 1 and tool_registry.streams(calls[0][0]):
+        # a lone streaming tool (the itinerary rewrite) is shown as it runs
+        yield history + [("assistant", f"Running {calls[0][0]}...")]
+        result = None
+        async for result in tool_registry.stream(userId, *calls[0]):
+            yield history + [("assistant", result)]
+        if result is not None:
+            await session_store.aappend(userId, {
+                "role": "assistant",
+                "content": result
+            })
+    elif calls:
+        yield history + [("assistant", "Running " + ", ".join(name for name, _ in calls) + "...")]
+        await _run_tool_calls(userId, calls)
     else:
-        print("No tool calls found in the response.")
-        conversations[userId].append({
+        await session_store.aappend(userId, {
             "role": "assistant",
-            "content": result
+            "content": content
         })
+        if RESPONSE_CACHE_ENABLED:
+            await response_cache.store(messages, content, time.perf_counter() - start)
 
-    # update conversation to this format [{"user": "query"}, {"assistant": "response"}]
-    conversation_history = [(c["role"], c["content"]) if c["role"] == "user" or c["role"] == "assistant" else () for c in conversations[userId]]
+    observe_stage("turn_total", time.perf_counter() - start, route="model")
+    yield await _conversation_history(userId)
 
-    # remove empty objects from the conversation
-    conversation_history = [c for c in conversation_history if c]
-    return conversation_history
+def generate_user_intentions(natural_language_query: str, complete_itinerary: str, userId: str) -> List[str]:
+    return run_sync(agenerate_user_intentions(natural_language_query, complete_itinerary, userId))
+
+async def aget_acitivities(acitivity: str, location: str) -> List[str]:
+        # resolve the destination from the in-memory catalog index
+        with span("catalog_lookup"):
+            await asyncio.to_thread(catalog_index.ensure_loaded)
+            location_id = catalog_index.lookup("destination", location)
+        if location_id is None:
+            event("unknown_destination", level=logging.WARNING, location=location)
+            return []
+
+        with span("embedding"):
+            query_embedding = await aget_embedding(
+                f"{acitivity} in {location}", "text-embedding-ada-002", llm
+            )
+
+        if VECTOR_SEARCH_BACKEND == "numpy":
+            with span("vector_query", backend="numpy"):
+                await asyncio.to_thread(vector_index.ensure_loaded)
+                # without the full matrix in memory the rerank reads Postgres
+                matches = await asyncio.to_thread(vector_index.search, "must_travel_activity", location_id, query_embedding)
+                rows = [(activity_id, activity_name, None, similarity) for activity_id, activity_name, similarity in matches]
+        else:
+            query_vector_str = "[" + ",".join(str(x) for x in query_embedding) + "]"
+
+            with span("vector_query", backend="pgvector"):
+                async with get_async_connection() as conn:
+                    # exact, partial-index or global-index plan depending on the destination's size
+                    rows = await ann_index.search(conn, query_vector_str, location_id)
+
+        activities = [row[1] for row in rows]
+        event("activities_found", level=logging.DEBUG, location_id=location_id, matches=[(row[1], row[3]) for row in rows])
 
-def get_acitivities(acitivity: str, location: str) -> List[str]:
-        conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-        cursor = conn.cursor()
-        cursor = conn.cursor()
-
-        print("location", location)
-        response = openai.embeddings.create(
-            input=[f"{acitivity} in {location}"],
-            model="text-embedding-ada-002"
-         )
-
-        query_embedding = response.data[0].embedding
-        query_vector_str = "[" + ",".join(str(x) for x in query_embedding) + "]"
-
-        # get location id
-        cursor.execute(f"SELECT id FROM destination WHERE name ILIKE '{location}'")
-        row = cursor.fetchone()
-        location_id = row[0]
-
-        print("location_id", location_id)
-
-        threshold = 0.5  # Set your desired threshold
-        sql = """
-            SELECT 
-                id, 
-                name, 
-                description,
-                -(embedding <#> %s::vector) as similarity
-            FROM must_travel_activity 
-            WHERE 
-                destination_id = %s 
-                AND -(embedding <#> %s::vector) > 0.85  -- Cosine similarity threshold
-            ORDER BY similarity DESC
-            LIMIT 5;
-        """
-
-        cursor.execute(sql, (
-            query_vector_str,
-            location_id,
-            query_vector_str
-        ))
-
-        rows = cursor.fetchall()
-        activities = []
-
-        for row in rows:
-            print(row)
-            activity_id = row[0]
-            activity_name = row[1]
-            activity_desc = row[2]
-            distance = row[3]
-            print(f"Activity: {activity_name}, Distance: {distance}")
-            activities.append(activity_name)
-
-        cursor.close()
-        conn.close()
         return activities
 
-def update_itinerary(itinerary: str, updated_response: str) -> str:
+def get_acitivities(acitivity: str, location: str) -> List[str]:
+    return run_sync(aget_acitivities(acitivity, location))
+
+def _update_itinerary_messages(itinerary: str, updated_response: str) -> List[dict]:
     prompt = f"""You are helpful AI assistant for a travel company. 
     Your main task is to understand the itinerary and changes that has been done in the itinerary as "updated_response".
     Update the itinerary based on the user response and provide the updated itinerary to the user.
@@ -470,29 +673,82 @@ def update_itinerary(itinerary: str, updated_response: str) -> str:
     
     updated_itinerary:
     """
+    return [{
+        "role": "system",
+        "content": prompt
+    }]
+
+async def aupdate_itinerary(itinerary: str, updated_response: str) -> str:
+    with span("update_itinerary"):
+        response = await llm.achat(
+            model='gpt-4o',
+            messages=_update_itinerary_messages(itinerary, updated_response),
+            max_tokens=1000,
+            temperature=0
+        )
 
-    response = openai.chat.completions.create(
+    return response.choices[0].message.content
+
+async def astream_update_itinerary(itinerary: str, updated_response: str) -> AsyncIterator[str]:
+    """Yields the updated itinerary text accumulated so far as tokens arrive."""
+    start = time.perf_counter()
+    stream = await llm.astream_chat(
         model='gpt-4o',
-        messages=[{
-            "role": "system",
-            "content": prompt
-        }],
+        messages=_update_itinerary_messages(itinerary, updated_response),
         max_tokens=1000,
-        temperature=0
+        temperature=0,
     )
+    content = ""
+    async for chunk in stream:
+        if chunk.usage:
+            record_usage('gpt-4o', chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            content += chunk.choices[0].delta.content
+            yield content
+    observe_stage("update_itinerary", time.perf_counter() - start)
 
-    return response.choices[0].message.content
+def update_itinerary(itinerary: str, updated_response: str) -> str:
+    return run_sync(aupdate_itinerary(itinerary, updated_response))
+
+def _session_id(request: gr.Request) -> str:
+    # Gradio assigns every browser session its own hash
+    return getattr(request, "session_hash", None) or "anonymous"
+
+async def _unavailable(userId: str) -> List[Tuple[str, str]]:
+    # the OpenAI circuit is open: answer at once instead of waiting on retries
+    await session_store.aappend(userId, {
+        "role": "assistant",
+        "content": "The assistant is temporarily unavailable. Please try again in a minute."
+    })
+    return await _conversation_history(userId)
 
-def chatbot_interface(user_input, chat_history):
+@profiler.profiled
+async def chatbot_interface(user_input, chat_history, request: gr.Request):
     # Get the response from the backend function
-    conversation_history = generate_user_intentions(user_input, json.dumps(itineary), "123")
-    print('conversation_history', conversation_history)
+    userId = _session_id(request)
+    try:
+        conversation_history = await agenerate_user_intentions(user_input, json.dumps(itineary), userId)
+    except CircuitOpenError:
+        conversation_history = await _unavailable(userId)
     # Update the chat history
     chat_history = conversation_history
     
     # Return updated chat history
     return chat_history, chat_history
 
+@profiler.profiled
+async def chatbot_stream(user_input, chat_history, request: gr.Request):
+    # Push partial responses to the Chatbot as they stream in
+    userId = _session_id(request)
+    try:
+        async for conversation_history in astream_user_intentions(user_input, json.dumps(itineary), userId):
+            yield conversation_history, conversation_history
+    except CircuitOpenError:
+        conversation_history = await _unavailable(userId)
+        yield conversation_history, conversation_history
+
+chat_handler = chatbot_stream if STREAM_RESPONSES else chatbot_interface
+
 
 custom_css = """
 .container {
@@ -553,12 +809,13 @@ with gr.Blocks(css=custom_css) as demo:
         chat_history = gr.State([])
         
         # Function to clear chat history
-        def clear_chat() -> Tuple[str, List[Tuple[str, str]]]:
+        def clear_chat(request: gr.Request) -> Tuple[str, List[Tuple[str, str]]]:
+            session_store.delete(_session_id(request))
             return "", []
         
         # Event handlers
         msg_submit = message.submit(
-            chatbot_interface,
+            chat_handler,
             inputs=[message, chat_history],
             outputs=[chatbot, chat_history],
         ).then(
@@ -568,7 +825,7 @@ with gr.Blocks(css=custom_css) as demo:
         )
         
         send_button.click(
-            chatbot_interface,
+            chat_handler,
             inputs=[message, chat_history],
             outputs=[chatbot, chat_history],
         ).then(
@@ -584,5 +841,35 @@ with gr.Blocks(css=custom_css) as demo:
         )
 
 # Launch the app
+# The Gradio UI is mounted on a FastAPI app that also serves /metrics
+# (Prometheus text format), /metrics.json (metrics plus recent traces) and
+# the /admin/profiler and /rankings routes.
+api = FastAPI()
+api.include_router(metrics_router)
+api.include_router(profiler_router)
+api.include_router(rankings_router)
+try:
+    # plotly and scikit-learn are only needed for the embedding plots
+    from app.visualization import router as visualization_router
+    api.include_router(visualization_router)
+except ImportError as e:
+    event("visualization_disabled", level=logging.WARNING, error=str(e))
+app = gr.mount_gradio_app(api, demo, path="/")
+
 if __name__ == "__main__":
-    demo.launch()
\ No newline at end of file
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper(), format="%(asctime)s %(name)s %(message)s")
+    catalog_index.load()
+    catalog_index.start_refresh(CATALOG_REFRESH_SECONDS)
+    if VECTOR_SEARCH_BACKEND == "numpy":
+        vector_index.load()
+    if ANN_AUTO_CREATE:
+        ann_index.ensure_indexes()
+    if EMBEDDING_MAINTAINER_ENABLED:
+        embedding_maintainer.start()
+    if RANKING_LIVE:
+        ranking_index.start()
+    uvicorn.run(
+        app,
+        host=os.getenv("GRADIO_SERVER_NAME", "127.0.0.1"),
+        port=int(os.getenv("GRADIO_SERVER_PORT", "7860")),
+    )
@@ -0,0 +1,275 @@
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from app.profiler import require_admin
+
+logger = logging.getLogger("app.trace")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", "200"))
+
+# (metric name, type, help, [(labels, value), ...]) produced on every scrape
+Sample = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+def _value_text(value: float) -> str:
+    # full precision: ":g" keeps 6 digits, which hides small increments of large counters from rate()
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_label_text(dict(key))} {_value_text(value)}" for key, value in sorted(values.items())]
+        return lines
+
+    def snapshot(self) -> list:
+        with self._lock:
+            return [{**dict(key), "value": value} for key, value in sorted(self._values.items())]
+
+
+class _Series:
+    __slots__ = ("counts", "total", "count", "recent")
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * (buckets + 1)
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=1000)
+
+
+class Histogram:
+    """Prometheus-style cumulative buckets, plus recent samples for percentiles."""
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series: Dict[tuple, _Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self.buckets))
+            series.counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.total += value
+            series.count += 1
+            series.recent.append(value)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{_label_text({**labels, 'le': le})} {cumulative}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {_value_text(series.total)}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {series.count}")
+        return lines
+
+    def snapshot(self) -> list:
+        result = []
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                ordered = sorted(series.recent)
+                result.append({
+                    **dict(key),
+                    "count": series.count,
+                    "sum": series.total,
+                    "p50": ordered[len(ordered) // 2] if ordered else None,
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+                })
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: "OrderedDict[str, object]" = OrderedDict()
+        self._collectors: List[Callable[[], List[Sample]]] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def collector(self, collect: Callable[[], List[Sample]]):
+        """Register a callback that reports gauges/counters owned by another module."""
+        self._collectors.append(collect)
+        return collect
+
+    def _collected(self) -> List[Sample]:
+        samples = []
+        for collect in self._collectors:
+            try:
+                samples.extend(collect())
+            except Exception as e:
+                logger.warning("metrics collector %s failed: %s", getattr(collect, "__name__", collect), e)
+        return samples
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        for name, kind, help, values in self._collected():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            lines += [f"{name}{_label_text(labels)} {_value_text(value)}" for labels, value in values]
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        result = {name: metric.snapshot() for name, metric in self._metrics.items()}
+        for name, _, _, values in self._collected():
+            result[name] = [{**labels, "value": value} for labels, value in values]
+        return result
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("agent_stage_seconds", "Time spent per stage of a chat turn.")
+openai_tokens = registry.counter("openai_tokens_total", "OpenAI tokens billed, by model and kind.")
+openai_request_seconds = registry.histogram("openai_request_seconds", "Successful OpenAI request latency, by call kind.")
+db_query_seconds = registry.histogram("db_query_seconds", "SQL statement execution time, by statement type.")
+
+
+# ---------------------------------------------------------------- tracing
+
+_trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+_traces: "OrderedDict[str, dict]" = OrderedDict()
+_traces_lock = threading.Lock()
+
+
+def start_trace(**fields) -> str:
+    """Begin a new trace (one chat turn) in the current context and return its id."""
+    trace_id = uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    with _traces_lock:
+        _traces[trace_id] = {"trace_id": trace_id, "started": time.time(), **fields, "spans": []}
+        while len(_traces) > TRACE_HISTORY:
+            _traces.popitem(last=False)
+    return trace_id
+
+
+def current_trace() -> Optional[str]:
+    return _trace_id.get()
+
+
+def event(name: str, level: int = logging.INFO, **fields):
+    """Structured log line tagged with the current trace id."""
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({"event": name, "trace_id": _trace_id.get(), **fields}, default=str))
+
+
+def observe_stage(stage: str, seconds: float, outcome: str = "ok", **fields):
+    """Record one stage of the current trace (e.g. a time to first token measured by hand)."""
+    stage_seconds.observe(seconds, stage=stage)
+    trace_id = _trace_id.get()
+    if trace_id is not None:
+        with _traces_lock:
+            trace = _traces.get(trace_id)
+            if trace is not None:
+                trace["spans"].append({"stage": stage, "seconds": round(seconds, 6), "outcome": outcome, **fields})
+    event("span", level=logging.DEBUG, stage=stage, seconds=seconds, outcome=outcome, **fields)
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """Time a block as one stage of the current trace."""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, outcome, **fields)
+
+
+def recent_traces(limit: int = 50) -> List[dict]:
+    with _traces_lock:
+        return [dict(trace, spans=list(trace["spans"])) for trace in list(_traces.values())[-limit:]]
+
+
+def record_usage(model: Optional[str], usage):
+    """Count prompt/completion tokens from an OpenAI `usage` object."""
+    if usage is None:
+        return
+    model = model or "unknown"
+    openai_tokens.inc(getattr(usage, "prompt_tokens", 0) or 0, model=model, kind="prompt")
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    if completion:
+        openai_tokens.inc(completion, model=model, kind="completion")
+
+
+def stage_summary(*stages: str) -> dict:
+    """p50/p95 per stage from recent samples, for benchmarks and quick checks."""
+    return {
+        row["stage"]: {"count": row["count"], "p50": row["p50"], "p95": row["p95"]}
+        for row in stage_seconds.snapshot()
+        if not stages or row["stage"] in stages
+    }
+
+
+# ---------------------------------------------------------------- endpoints
+
+# traces carry session ids, so the endpoints share the admin token guard
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/metrics.json")
+def metrics_json(traces: int = 20):
+    return {"metrics": registry.snapshot(), "traces": recent_traces(traces)}
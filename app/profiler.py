@@ -0,0 +1,288 @@
+import functools
+import hmac
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+# Leaf frames in these files mean the thread is parked waiting for I/O, not using CPU.
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for live sessions.
+
+    A daemon thread wakes every `interval` seconds and records the Python
+    stack of each thread being profiled. Identical stacks are aggregated
+    into counts. Two things switch sampling on:
+    - a profiled call, chosen with probability `sample_rate`, which samples
+      its own thread while it runs;
+    - start(seconds), which samples every thread for a fixed window.
+
+    The sampler thread only exists while one of these is active. When
+    disabled, a profiled call costs one wrapper frame and a rate check
+    (under a microsecond).
+
+    On the event-loop thread, other sessions' coroutines run between the
+    profiled call's awaits and are sampled too. Stacks parked in the
+    selector (waiting on OpenAI or the database) are dropped, so the
+    profile shows CPU time.
+    """
+
+    def __init__(self, interval: float = 0.005, sample_rate: float = 0.0, max_depth: int = 64):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.max_depth = max_depth
+        self._stacks: Counter = Counter()
+        self._labels: Dict[object, str] = {}
+        self._targets: Dict[int, int] = {}
+        self._window_until = 0.0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.samples = 0
+        self.invocations = 0
+
+    # ------------------------------------------------------------ control
+
+    def _ensure_sampler(self):
+        # caller holds self._lock
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+            self._thread.start()
+
+    def start(self, seconds: float):
+        """Sample every thread for the next `seconds`."""
+        with self._lock:
+            self._window_until = max(self._window_until, time.monotonic() + seconds)
+            self._ensure_sampler()
+
+    def stop(self):
+        with self._lock:
+            self._window_until = 0.0
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+            self.invocations = 0
+
+    def _enter(self) -> int:
+        ident = threading.get_ident()
+        with self._lock:
+            self._targets[ident] = self._targets.get(ident, 0) + 1
+            self.invocations += 1
+            self._ensure_sampler()
+        return ident
+
+    def _exit(self, ident: int):
+        with self._lock:
+            remaining = self._targets.get(ident, 1) - 1
+            if remaining:
+                self._targets[ident] = remaining
+            else:
+                self._targets.pop(ident, None)
+
+    def _chosen(self) -> bool:
+        rate = self.sample_rate
+        return rate > 0 and (rate >= 1 or random.random() < rate)
+
+    def profiled(self, fn):
+        """Decorator: profile a sampled fraction of calls to a sync, async or async-generator function."""
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not self._chosen():
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                    return
+                ident = self._enter()
+                try:
+                    async for item in fn(*args, **kwargs):
+                        yield item
+                finally:
+                    self._exit(ident)
+        elif inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not self._chosen():
+                    return await fn(*args, **kwargs)
+                ident = self._enter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self._exit(ident)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self._chosen():
+                    return fn(*args, **kwargs)
+                ident = self._enter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self._exit(ident)
+        return wrapper
+
+    # ------------------------------------------------------------ sampling
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _stack(self, frame, thread_name: str) -> Optional[Tuple[str, ...]]:
+        if os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+            return None
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(f"thread {thread_name}")
+        return tuple(reversed(labels))
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            with self._lock:
+                window = time.monotonic() < self._window_until
+                targets = set(self._targets)
+                if not window and not targets:
+                    self._thread = None
+                    return
+
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == me or not (window or ident in targets):
+                    continue
+                stack = self._stack(frame, names.get(ident, str(ident)))
+                if stack is not None:
+                    stacks.append(stack)
+            # drop frame references so finished coroutines can be collected
+            frames = frame = None
+
+            with self._lock:
+                self._stacks.update(stacks)
+                self.samples += len(stacks)
+            time.sleep(self.interval)
+
+    # ------------------------------------------------------------ export
+
+    def collapsed(self) -> str:
+        """Brendan Gregg's collapsed-stack format, for flamegraph.pl, speedscope or inferno."""
+        with self._lock:
+            stacks = self._stacks.most_common()
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in stacks)
+
+    def speedscope(self) -> dict:
+        """speedscope.app file (sampled profile, weights in seconds)."""
+        with self._lock:
+            stacks = self._stacks.most_common()
+        frames, index = [], {}
+        samples, weights = [], []
+        for stack, count in stacks:
+            sample = []
+            for label in stack:
+                if label not in index:
+                    index[label] = len(frames)
+                    frames.append({"name": label})
+                sample.append(index[label])
+            samples.append(sample)
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": "sql-agent",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": "sql-agent",
+            "exporter": "app.profiler",
+        }
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "interval": self.interval,
+                "window_seconds_left": max(0.0, self._window_until - time.monotonic()),
+                "active_invocations": sum(self._targets.values()),
+                "sampling": self._thread is not None,
+                "invocations": self.invocations,
+                "samples": self.samples,
+                "distinct_stacks": len(self._stacks),
+            }
+
+
+profiler = SamplingProfiler(
+    interval=float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000,
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+)
+
+
+# ---------------------------------------------------------------- admin routes
+
+def require_admin(x_admin_token: Optional[str] = Header(default=None)):
+    # callers must send ADMIN_TOKEN in the X-Admin-Token header; without ADMIN_TOKEN the routes stay closed
+    token = os.getenv("ADMIN_TOKEN")
+    if not token or not hmac.compare_digest(x_admin_token or "", token):
+        raise HTTPException(status_code=403, detail="admin token required")
+
+
+router = APIRouter(prefix="/admin/profiler", dependencies=[Depends(require_admin)])
+
+
+@router.get("")
+def profiler_status():
+    return profiler.status()
+
+
+@router.post("/start")
+def profiler_start(seconds: float = 30.0):
+    profiler.start(seconds)
+    return profiler.status()
+
+
+@router.post("/stop")
+def profiler_stop():
+    profiler.stop()
+    return profiler.status()
+
+
+@router.post("/sample-rate")
+def profiler_sample_rate(rate: float):
+    if not 0.0 <= rate <= 1.0:
+        raise HTTPException(status_code=422, detail="rate must be between 0 and 1")
+    profiler.sample_rate = rate
+    return profiler.status()
+
+
+@router.post("/reset")
+def profiler_reset():
+    profiler.reset()
+    return profiler.status()
+
+
+@router.get("/collapsed", response_class=PlainTextResponse)
+def profiler_collapsed():
+    return PlainTextResponse(profiler.collapsed(), headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+
+@router.get("/speedscope")
+def profiler_speedscope():
+    return JSONResponse(profiler.speedscope(), headers={"Content-Disposition": 'attachment; filename="profile.speedscope.json"'})
@@ -0,0 +1,293 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from typing import List, NamedTuple, Optional, Tuple
+
+import joblib
+import numpy as np
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.manifold import TSNE
+from sklearn.neighbors import KNeighborsTransformer, NearestNeighbors
+
+from app.db import get_connection
+from app.embedding_loader import column_type, iter_embeddings, load_embeddings
+from app.metrics import event
+
+PROJECTION_CACHE_DIR = os.getenv("PROJECTION_CACHE_DIR", ".projection_cache")
+# above this many rows PCA is fitted out of core, chunk by chunk
+INCREMENTAL_PCA_ROWS = int(os.getenv("INCREMENTAL_PCA_ROWS", "50000"))
+# refit once new/changed rows exceed this share of the fitted layout
+REFIT_FRACTION = float(os.getenv("PROJECTION_REFIT_FRACTION", "0.2"))
+TSNE_PCA_COMPONENTS = 50
+PLACEMENT_NEIGHBORS = 10
+
+
+class Projection(NamedTuple):
+    ids: np.ndarray
+    coords: np.ndarray
+    labels: Optional[List[str]]
+    status: str  # "cached", "incremental" or "refit"
+
+
+def fetch_digests(table_name, embedding_column, label_column=None, id_column="id", connection_factory=get_connection):
+    """
+    (ids, 16-byte md5 per embedding, labels) for every embedded row in id
+    order. Only the digests cross the wire, not the vectors.
+    """
+    with connection_factory() as conn:
+        binary = (column_type(conn, table_name, embedding_column) or "").startswith("vector")
+        value = f"vector_send({embedding_column})" if binary else f"{embedding_column}::text"
+        select = f"{id_column}, decode(md5({value}), 'hex')"
+        if label_column:
+            select += f", {label_column}"
+        cursor = conn.cursor(name=f"embedding_digests_{uuid.uuid4().hex[:8]}")
+        try:
+            cursor.execute(
+                f"SELECT {select} FROM {table_name} WHERE {embedding_column} IS NOT NULL ORDER BY {id_column}"
+            )
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    digests = np.array([bytes(row[1]) for row in rows], dtype="S16")
+    labels = [row[2] for row in rows] if label_column else None
+    return ids, digests, labels
+
+
+def table_hash(ids: np.ndarray, digests: np.ndarray) -> str:
+    return hashlib.sha256(ids.tobytes() + digests.tobytes()).hexdigest()
+
+
+def auto_perplexity(n_rows: int) -> float:
+    return float(min(30.0, max(2.0, (n_rows - 1) / 3)))
+
+
+def neighbor_graph(reference: np.ndarray, n_neighbors: int):
+    """Sparse kNN distance graph; pynndescent (approximate) when installed, exact otherwise."""
+    try:
+        from pynndescent import PyNNDescentTransformer
+        transformer = PyNNDescentTransformer(n_neighbors=n_neighbors, metric="euclidean")
+    except ImportError:
+        transformer = KNeighborsTransformer(n_neighbors=n_neighbors, mode="distance")
+    return transformer.fit_transform(reference)
+
+
+def tsne_layout(reference: np.ndarray, n_components: int, perplexity: Optional[float] = None) -> np.ndarray:
+    """
+    t-SNE on a precomputed kNN graph of PCA-reduced vectors: affinities only
+    cover the 3*perplexity nearest neighbours, so nothing is quadratic.
+    Initialised from the leading PCA axes, as sklearn's init="pca" does.
+    """
+    perplexity = perplexity or auto_perplexity(len(reference))
+    graph = neighbor_graph(reference, min(len(reference) - 1, int(3 * perplexity + 1)))
+    init = reference[:, :n_components] / (np.std(reference[:, 0]) or 1.0) * 1e-4
+    tsne = TSNE(
+        n_components=n_components,
+        perplexity=perplexity,
+        metric="precomputed",
+        init=init.astype(np.float32),
+        random_state=42,
+    )
+    return tsne.fit_transform(graph).astype(np.float32)
+
+
+def fit_projection(vectors: np.ndarray, method: str = "pca", n_components: int = 2, perplexity: Optional[float] = None):
+    """In-memory fit: (coords, reducer, reference) where reference is the PCA-50 space t-SNE ran in."""
+    if method == "pca":
+        reducer = PCA(n_components=n_components).fit(vectors)
+        return reducer.transform(vectors).astype(np.float32), reducer, None
+    reducer = PCA(n_components=min(TSNE_PCA_COMPONENTS, *vectors.shape)).fit(vectors)
+    reference = reducer.transform(vectors).astype(np.float32)
+    return tsne_layout(reference, n_components, perplexity), reducer, reference
+
+
+def _stream_pca(n_components: int, chunks) -> IncrementalPCA:
+    reducer = IncrementalPCA(n_components=n_components)
+    for _, chunk, _ in chunks():
+        # IncrementalPCA needs at least n_components rows per batch; only a short tail is skipped
+        if len(chunk) >= n_components:
+            reducer.partial_fit(chunk)
+    return reducer
+
+
+def _stream_transform(reducer, chunks) -> Tuple[np.ndarray, np.ndarray]:
+    ids, coords = [], []
+    for chunk_ids, chunk, _ in chunks():
+        ids.append(chunk_ids)
+        coords.append(reducer.transform(chunk).astype(np.float32))
+    return np.concatenate(ids), np.vstack(coords)
+
+
+def place_rows(reference: np.ndarray, coords: np.ndarray, new_reference: np.ndarray, k: int = PLACEMENT_NEIGHBORS) -> np.ndarray:
+    """Put new rows at the inverse-distance-weighted mean of their nearest laid-out neighbours."""
+    k = min(k, len(reference))
+    distances, neighbours = NearestNeighbors(n_neighbors=k).fit(reference).kneighbors(new_reference)
+    weights = 1.0 / (distances + 1e-6)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.einsum("nk,nkc->nc", weights, coords[neighbours]).astype(np.float32)
+
+
+class _Layout(NamedTuple):
+    ids: np.ndarray
+    digests: np.ndarray
+    coords: np.ndarray
+    reference: Optional[np.ndarray]
+    reducer: object
+    meta: dict
+
+
+def _paths(cache_dir: str, key: str) -> Tuple[str, str]:
+    return os.path.join(cache_dir, f"{key}.npz"), os.path.join(cache_dir, f"{key}.reducer.joblib")
+
+
+def _load_layout(cache_dir: str, key: str) -> Optional[_Layout]:
+    layout_path, reducer_path = _paths(cache_dir, key)
+    if not (os.path.exists(layout_path) and os.path.exists(reducer_path)):
+        return None
+    try:
+        with np.load(layout_path) as data:
+            reference = data["reference"] if "reference" in data.files else None
+            meta = json.loads(str(data["meta"]))
+            layout = (data["ids"], data["digests"], data["coords"], reference)
+        return _Layout(*layout, joblib.load(reducer_path), meta)
+    except Exception as e:
+        event("projection_cache_unreadable", level=logging.WARNING, path=layout_path, error=str(e))
+        return None
+
+
+def _save_layout(cache_dir: str, key: str, layout: _Layout):
+    os.makedirs(cache_dir, exist_ok=True)
+    layout_path, reducer_path = _paths(cache_dir, key)
+    arrays = {"ids": layout.ids, "digests": layout.digests, "coords": layout.coords, "meta": np.array(json.dumps(layout.meta))}
+    if layout.reference is not None:
+        arrays["reference"] = layout.reference
+    # each save writes its own temp files, so concurrent saves of one key
+    # never interleave and the last os.replace wins whole
+    temp_paths = []
+    try:
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as f:
+            temp_paths.append(f.name)
+            np.savez(f, **arrays)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as f:
+            temp_paths.append(f.name)
+            joblib.dump(layout.reducer, f)
+        os.replace(temp_paths[1], reducer_path)
+        os.replace(temp_paths[0], layout_path)
+    finally:
+        for path in temp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def _digests_for(layout_ids: np.ndarray, ids: np.ndarray, digests: np.ndarray) -> np.ndarray:
+    # rows that changed between the digest query and the load get an empty
+    # digest, so the next call treats them as changed
+    if not len(ids):
+        return np.zeros(len(layout_ids), dtype="S16")
+    position = np.clip(np.searchsorted(ids, layout_ids), 0, len(ids) - 1)
+    return np.where(ids[position] == layout_ids, digests[position], np.bytes_(b""))
+
+
+def project_embeddings(
+    table_name,
+    embedding_column,
+    label_column=None,
+    method="pca",
+    n_components=2,
+    perplexity=None,
+    cache_dir=PROJECTION_CACHE_DIR,
+    chunk_size=5000,
+    connection_factory=get_connection,
+) -> Projection:
+    """
+    Project a table's embeddings to `n_components` dimensions, reusing the
+    persisted layout where possible.
+
+    The per-row digests are always fetched and hashed. Then:
+    - if the table hash matches the cache, the stored coordinates are
+      returned (I/O only);
+    - if only a few rows are new or changed, only those rows are loaded
+      and placed into the existing layout (the PCA transform, or kNN
+      placement in the PCA-50 space for t-SNE), so existing points stay put;
+    - otherwise the reducer is refitted. Large tables use IncrementalPCA
+      over streamed chunks.
+    """
+    method = method.lower()
+    key = f"{table_name}-{embedding_column}-{method}{n_components}"
+    if method != "pca":
+        # t-SNE layouts depend on the perplexity; PCA ignores it
+        key += f"-p{perplexity:g}" if perplexity else "-pauto"
+    ids, digests, labels = fetch_digests(table_name, embedding_column, label_column, connection_factory=connection_factory)
+    current_hash = table_hash(ids, digests)
+    label_by_id = dict(zip(ids.tolist(), labels)) if labels is not None else None
+
+    def chunks(only_ids=None):
+        return iter_embeddings(
+            table_name, embedding_column, chunk_size=chunk_size, ids=only_ids, connection_factory=connection_factory
+        )
+
+    def result(layout_ids, coords, status):
+        layout_labels = [label_by_id.get(i) for i in layout_ids.tolist()] if label_by_id is not None else None
+        return Projection(layout_ids, coords, layout_labels, status)
+
+    cached = _load_layout(cache_dir, key)
+    if cached is not None and cached.meta.get("table_hash") == current_hash:
+        return result(cached.ids, cached.coords, "cached")
+
+    if cached is not None and len(cached.ids):
+        # rows whose id and digest both match the cached layout keep their coordinates
+        position = np.clip(np.searchsorted(cached.ids, ids), 0, len(cached.ids) - 1)
+        unchanged = (cached.ids[position] == ids) & (cached.digests[position] == digests)
+        new_ids = ids[~unchanged]
+        pending = len(new_ids) + cached.meta.get("projected_since_fit", 0)
+        if unchanged.any() and pending <= REFIT_FRACTION * cached.meta.get("fitted_rows", 0):
+            coords = cached.coords[position[unchanged]]
+            reference = cached.reference[position[unchanged]] if cached.reference is not None else None
+            layout_ids = ids[unchanged]
+            if len(new_ids):
+                fresh = load_embeddings(
+                    table_name, embedding_column, chunk_size=chunk_size, ids=new_ids, connection_factory=connection_factory
+                )
+                if method == "pca":
+                    fresh_coords = cached.reducer.transform(fresh.vectors).astype(np.float32)
+                else:
+                    fresh_reference = cached.reducer.transform(fresh.vectors).astype(np.float32)
+                    fresh_coords = place_rows(reference, coords, fresh_reference)
+                    reference = np.vstack([reference, fresh_reference])
+                order = np.argsort(np.concatenate([layout_ids, fresh.ids]), kind="stable")
+                layout_ids = np.concatenate([layout_ids, fresh.ids])[order]
+                coords = np.vstack([coords, fresh_coords])[order]
+                reference = reference[order] if reference is not None else None
+            meta = dict(cached.meta, table_hash=current_hash, projected_since_fit=pending, updated_at=time.time())
+            _save_layout(cache_dir, key, _Layout(layout_ids, _digests_for(layout_ids, ids, digests), coords, reference, cached.reducer, meta))
+            return result(layout_ids, coords, "incremental")
+
+    # full refit
+    reference = None
+    if len(ids) > INCREMENTAL_PCA_ROWS:
+        reducer = _stream_pca(n_components if method == "pca" else TSNE_PCA_COMPONENTS, chunks)
+        layout_ids, reduced = _stream_transform(reducer, chunks)
+        if method == "pca":
+            coords = reduced
+        else:
+            reference = reduced
+            coords = tsne_layout(reference, n_components, perplexity)
+    else:
+        data = load_embeddings(table_name, embedding_column, chunk_size=chunk_size, connection_factory=connection_factory)
+        layout_ids = data.ids
+        coords, reducer, reference = fit_projection(data.vectors, method, n_components, perplexity)
+
+    meta = {
+        "table_hash": current_hash,
+        "fitted_rows": int(len(layout_ids)),
+        "projected_since_fit": 0,
+        "method": method,
+        "fitted_at": time.time(),
+        "updated_at": time.time(),
+    }
+    _save_layout(cache_dir, key, _Layout(layout_ids, _digests_for(layout_ids, ids, digests), coords, reference, reducer, meta))
+    return result(layout_ids, coords, "refit")
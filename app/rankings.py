@@ -0,0 +1,475 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from app.catalog_index import catalog_index
+from app.db import NotificationListener, get_connection
+from app.embedding_cache import aget_embedding
+from app.llm import llm
+from app.metrics import event, registry
+from app.profiler import require_admin
+from app.vector_search import TOP_K, vector_index as default_vector_index
+
+RANKING_TOP_N = int(os.getenv("RANKING_TOP_N", "20"))
+RANKING_REFRESH_SECONDS = float(os.getenv("RANKING_REFRESH_SECONDS", "900"))
+RANKING_DEBOUNCE_SECONDS = float(os.getenv("RANKING_DEBOUNCE_SECONDS", "0.5"))
+# more pending changes than this and the worker reloads everything instead
+RANKING_MAX_PENDING = int(os.getenv("RANKING_MAX_PENDING", "5000"))
+# share of the combined score that comes from the rating; the rest is vector similarity
+RANKING_WEIGHT = float(os.getenv("RANKING_WEIGHT", "0.3"))
+RATING_SCALE = float(os.getenv("RATING_SCALE", "5"))
+# keep rankings current in the background (LISTEN plus periodic reloads) when the app starts;
+# off by default, like the embedding maintainer, since it needs the triggers installed
+RANKING_LIVE = os.getenv("RANKING_LIVE", "false").lower() == "true"
+NOTIFY_CHANNEL = "rating_changes"
+
+
+class RankedKind(NamedTuple):
+    # SELECT destination_id, travel_group_id, travel_theme_id, id, name, score
+    source: str
+    # table the ranked ids belong to (and the vector index table for it)
+    entity_table: str
+
+
+RANKED_KINDS: Dict[str, RankedKind] = {
+    "must_activity": RankedKind(
+        """
+        SELECT a.destination_id, r.travel_group_id, r.travel_theme_id, a.id, a.name, r.rating AS score
+        FROM must_activity_group_theme r JOIN must_travel_activity a ON a.id = r.must_travel_activity_id
+        """,
+        "must_travel_activity",
+    ),
+    "recommended_activity": RankedKind(
+        """
+        SELECT a.destination_id, r.travel_group_id, r.travel_theme_id, a.id, a.name, r.rating AS score
+        FROM recommend_activity_group_theme r JOIN recommended_activity a ON a.id = r.recommend_activity_id
+        """,
+        "recommended_activity",
+    ),
+    "location": RankedKind(
+        """
+        SELECT l.destination_id, r.travel_group_id, r.travel_theme_id, l.id, l.name, r.rating AS score
+        FROM location_group_theme r JOIN location l ON l.id = r.location_id
+        """,
+        "location",
+    ),
+    # hotels have no group/theme ratings: average the location's fit with the hotel's own rating
+    "hotel": RankedKind(
+        """
+        SELECT l.destination_id, r.travel_group_id, r.travel_theme_id, h.id, h.name, (r.rating + h.rating) / 2 AS score
+        FROM hotel h JOIN location l ON l.id = h.location_id JOIN location_group_theme r ON r.location_id = l.id
+        """,
+        "hotel",
+    ),
+}
+
+# table that sent a change -> (kind whose ids it carries, kinds to refresh, trigger argument, columns watched on UPDATE)
+WATCHED_TABLES = {
+    "must_activity_group_theme": ("must_activity", ("must_activity",), "must_travel_activity_id", None),
+    "recommend_activity_group_theme": ("recommended_activity", ("recommended_activity",), "recommend_activity_id", None),
+    "location_group_theme": ("location", ("location", "hotel"), "location_id", None),
+    "must_travel_activity": ("must_activity", ("must_activity",), "id", ("name", "destination_id")),
+    "recommended_activity": ("recommended_activity", ("recommended_activity",), "id", ("name", "destination_id")),
+    "location": ("location", ("location", "hotel"), "id", ("name", "destination_id")),
+    "hotel": ("hotel", ("hotel",), "id", ("name", "rating", "location_id")),
+}
+
+TRIGGER_FUNCTION_SQL = f"""
+    CREATE OR REPLACE FUNCTION notify_rating_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('{NOTIFY_CHANNEL}', TG_TABLE_NAME || ':' || (to_jsonb(OLD) ->> TG_ARGV[0]));
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('{NOTIFY_CHANNEL}', TG_TABLE_NAME || ':' || (to_jsonb(NEW) ->> TG_ARGV[0]));
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+Ranked = Tuple[int, str, float]
+Key = Tuple[int, int]  # (travel_group_id, travel_theme_id)
+
+
+class _Ranking:
+    """Every rated row for one (destination, group, theme), best first."""
+
+    __slots__ = ("rows", "scores")
+
+    def __init__(self, rows: List[Ranked]):
+        self.rows = sorted(rows, key=lambda row: (-row[2], row[0]))
+        self.scores = {row_id: score for row_id, _, score in rows}
+
+
+def install_triggers(connection_factory=get_connection):
+    """NOTIFY rating_changes from the rating tables and the rows they rank. Safe to rerun."""
+    with connection_factory() as conn:
+        cursor = conn.cursor()
+        cursor.execute(TRIGGER_FUNCTION_SQL)
+        for table, (_, _, argument, columns) in WATCHED_TABLES.items():
+            update = f"UPDATE OF {', '.join(columns)}" if columns else "UPDATE"
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_rating_change ON {table}")
+            cursor.execute(
+                f"""
+                CREATE TRIGGER {table}_rating_change
+                AFTER INSERT OR {update} OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION notify_rating_change('{argument}')
+                """
+            )
+        conn.commit()
+        cursor.close()
+
+
+class RankingIndex:
+    """
+    Precomputed rankings of activities, locations and hotels per
+    (destination, travel group, travel theme), held in process.
+
+    A full load reads each kind with one query. After that, changes are
+    applied per destination: the rating triggers NOTIFY the changed table
+    and row, the worker maps rows to their destinations (old and new), and
+    re-reads only those destinations. Notifications are debounced and
+    bounded; past RANKING_MAX_PENDING the worker reloads everything. A full
+    reload also runs every `refresh_seconds` as the polling fallback.
+    Like the other in-process indexes, a destination's rankings are
+    replaced as a whole, so readers never see a half-applied change.
+    """
+
+    def __init__(
+        self,
+        kinds: Dict[str, RankedKind] = RANKED_KINDS,
+        connection_factory=get_connection,
+        vector_index=default_vector_index,
+        refresh_seconds: float = RANKING_REFRESH_SECONDS,
+        debounce: float = RANKING_DEBOUNCE_SECONDS,
+        max_pending: int = RANKING_MAX_PENDING,
+    ):
+        self.kinds = dict(kinds)
+        self.connection_factory = connection_factory
+        self.vector_index = vector_index
+        self.refresh_seconds = refresh_seconds
+        self.debounce = debounce
+        self.max_pending = max_pending
+        self.loaded_at = None
+        self.stats = {"loads": 0, "destination_refreshes": 0, "notifications": 0, "overflows": 0}
+        # kind -> destination -> (group, theme) -> ranking
+        self._rankings: Dict[str, Dict[int, Dict[Key, _Ranking]]] = {}
+        # kind -> row id -> destinations it is ranked in
+        self._placement: Dict[str, Dict[int, Set[int]]] = {}
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Set[int]] = defaultdict(set)
+        self._pending_count = 0
+        self._overflow = False
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._listener: Optional[NotificationListener] = None
+
+    # ------------------------------------------------------------ loading
+
+    def _fetch(self, kind: str, destination_ids: Optional[List[int]] = None) -> List[tuple]:
+        sql = f"SELECT destination_id, travel_group_id, travel_theme_id, id, name, score FROM ({self.kinds[kind].source}) AS ranked"
+        params = ()
+        if destination_ids is not None:
+            sql += " WHERE destination_id = ANY(%s)"
+            params = (list(destination_ids),)
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    @staticmethod
+    def _build(rows: List[tuple]) -> Dict[int, Dict[Key, _Ranking]]:
+        grouped = defaultdict(lambda: defaultdict(list))
+        for destination_id, group_id, theme_id, row_id, name, score in rows:
+            grouped[destination_id][(group_id, theme_id)].append((row_id, name, float(score)))
+        return {
+            destination_id: {key: _Ranking(ranked) for key, ranked in keys.items()}
+            for destination_id, keys in grouped.items()
+        }
+
+    @staticmethod
+    def _placements(rankings: Dict[int, Dict[Key, _Ranking]]) -> Dict[int, Set[int]]:
+        placement = defaultdict(set)
+        for destination_id, keys in rankings.items():
+            for ranking in keys.values():
+                for row_id in ranking.scores:
+                    placement[row_id].add(destination_id)
+        return placement
+
+    def load(self):
+        rankings = {kind: self._build(self._fetch(kind)) for kind in self.kinds}
+        placement = {kind: self._placements(built) for kind, built in rankings.items()}
+        with self._lock:
+            self._rankings = rankings
+            self._placement = placement
+            self.loaded_at = time.time()
+        self.stats["loads"] += 1
+
+    def ensure_loaded(self):
+        if self.loaded_at is None:
+            self.load()
+
+    def refresh(self, kind: str, destination_ids: Iterable[int]):
+        """Re-read the rankings of `kind` for the given destinations only."""
+        destination_ids = sorted(set(destination_ids))
+        if not destination_ids:
+            return
+        fresh = self._build(self._fetch(kind, destination_ids))
+        with self._lock:
+            current = dict(self._rankings.get(kind, {}))
+            placement = self._placement.setdefault(kind, defaultdict(set))
+            for destination_id in destination_ids:
+                for ranking in current.pop(destination_id, {}).values():
+                    for row_id in ranking.scores:
+                        placement[row_id].discard(destination_id)
+                if destination_id in fresh:
+                    current[destination_id] = fresh[destination_id]
+            for row_id, destinations in self._placements(fresh).items():
+                placement[row_id].update(destinations)
+            self._rankings = {**self._rankings, kind: current}
+        self.stats["destination_refreshes"] += len(destination_ids)
+
+    def _destinations_of(self, kind: str, row_ids: List[int]) -> Set[int]:
+        """Destinations the rows are ranked in now (from the database) or were (from memory)."""
+        with self._lock:
+            placement = self._placement.get(kind, {})
+            destinations = {d for row_id in row_ids for d in placement.get(row_id, ())}
+        sql = f"SELECT DISTINCT destination_id FROM ({self.kinds[kind].source}) AS ranked WHERE id = ANY(%s)"
+        with self.connection_factory() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, (list(row_ids),))
+            destinations.update(row[0] for row in cursor.fetchall())
+            cursor.close()
+        return destinations
+
+    def apply(self, changes: Dict[str, Iterable[int]]):
+        """Refresh the destinations touched by changed rows, keyed by the table that changed."""
+        targets: Dict[str, Set[int]] = defaultdict(set)
+        for table, row_ids in changes.items():
+            if table not in WATCHED_TABLES:
+                continue
+            resolver, kinds, _, _ = WATCHED_TABLES[table]
+            destinations = self._destinations_of(resolver, list(row_ids))
+            for kind in kinds:
+                targets[kind].update(destinations)
+        for kind, destinations in targets.items():
+            self.refresh(kind, destinations)
+
+    # ------------------------------------------------------------ reading
+
+    def _ranking(self, kind: str, destination_id: int, group_id: int, theme_id: int) -> Optional[_Ranking]:
+        return self._rankings.get(kind, {}).get(destination_id, {}).get((group_id, theme_id))
+
+    def top(self, kind: str, destination_id: int, group_id: int, theme_id: int, n: int = RANKING_TOP_N) -> List[Ranked]:
+        """Best-rated (id, name, score) for a destination, group and theme."""
+        ranking = self._ranking(kind, destination_id, group_id, theme_id)
+        return ranking.rows[:n] if ranking else []
+
+    def combined(
+        self,
+        kind: str,
+        destination_id: int,
+        group_id: int,
+        theme_id: int,
+        query=None,
+        k: int = TOP_K,
+        weight: float = RANKING_WEIGHT,
+        candidates: int = 50,
+    ) -> List[dict]:
+        """
+        Merge vector similarity with the group/theme rating in memory:
+
+            score = (1 - weight) * similarity + weight * rating / RATING_SCALE
+
+        Candidates are the `candidates` nearest rows plus the `candidates`
+        best rated; unrated rows count as rating 0. Without a query, for
+        kinds the vector index does not hold, or while the in-process vector
+        index is not loaded (it is never loaded here), rows are ranked by rating.
+        """
+        ranking = self._ranking(kind, destination_id, group_id, theme_id)
+        rated = ranking.rows[:candidates] if ranking else []
+        ratings = ranking.scores if ranking else {}
+        names = {row_id: name for row_id, name, _ in rated}
+
+        table = self.kinds[kind].entity_table
+        index = self.vector_index
+        use_similarity = query is not None and self.has_similarity(kind)
+        similarities: Dict[int, float] = {}
+        if use_similarity:
+            for row_id, name, similarity in index.search(table, destination_id, query, k=candidates, threshold=-1.0):
+                similarities[row_id] = similarity
+                names.setdefault(row_id, name)
+            missing = [row_id for row_id in names if row_id not in similarities]
+            if missing:
+                similarities.update(index.similarities(table, destination_id, query, missing))
+
+        results = []
+        for row_id, name in names.items():
+            rating = ratings.get(row_id)
+            similarity = similarities.get(row_id)
+            normalized = (rating or 0.0) / RATING_SCALE
+            score = (1 - weight) * (similarity or 0.0) + weight * normalized if use_similarity else normalized
+            results.append({"id": row_id, "name": name, "score": score, "similarity": similarity, "rating": rating})
+        results.sort(key=lambda row: (-row["score"], row["id"]))
+        return results[:k]
+
+    def has_similarity(self, kind: str) -> bool:
+        """Whether combined() can score `kind` by similarity right now."""
+        index = self.vector_index
+        return index is not None and index.loaded_at is not None and self.kinds[kind].entity_table in index.tables
+
+    # ------------------------------------------------------------ background
+
+    def start(self, listen: bool = True):
+        """Load (in the worker) and keep the rankings current in daemon threads."""
+        if self._worker is not None:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._work, name="ranking-refresh", daemon=True)
+        self._worker.start()
+        if listen:
+            self._listener = NotificationListener(NOTIFY_CHANNEL, self._notified, on_reconnect=self._request_reload)
+            self._listener.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._changed.set()
+        if self._listener is not None:
+            self._listener.stop(timeout)
+            self._listener = None
+        if self._worker is not None:
+            self._worker.join(timeout)
+            self._worker = None
+
+    def _notified(self, payload: str):
+        table, _, row_id = payload.partition(":")
+        if not row_id.isdigit():
+            return
+        self.stats["notifications"] += 1
+        with self._lock:
+            if self._pending_count >= self.max_pending:
+                self._overflow = True
+            elif int(row_id) not in self._pending[table]:
+                self._pending[table].add(int(row_id))
+                self._pending_count += 1
+        self._changed.set()
+
+    def _request_reload(self):
+        with self._lock:
+            self._overflow = True
+        self._changed.set()
+
+    def _work(self):
+        next_load = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() >= next_load:
+                    self.load()
+                    next_load = time.monotonic() + self.refresh_seconds
+                if not self._changed.wait(timeout=max(0.0, min(1.0, next_load - time.monotonic()))):
+                    continue
+                self._stop.wait(self.debounce)
+                with self._lock:
+                    pending, overflow = self._pending, self._overflow
+                    self._pending, self._pending_count, self._overflow = defaultdict(set), 0, False
+                    self._changed.clear()
+                if overflow:
+                    self.stats["overflows"] += 1
+                    next_load = time.monotonic()
+                elif pending:
+                    self.apply(pending)
+            except Exception as e:
+                # the next full load repairs whatever this pass missed
+                event("ranking_refresh_failed", level=logging.WARNING, error=str(e))
+                self._stop.wait(5.0)
+
+    def status(self) -> dict:
+        with self._lock:
+            keys = sum(len(keys) for destinations in self._rankings.values() for keys in destinations.values())
+            pending = self._pending_count
+        return {
+            **self.stats,
+            "keys": keys,
+            "pending": pending,
+            "listening": self._listener is not None and self._listener.listening,
+            "loaded_at": self.loaded_at,
+        }
+
+
+ranking_index = RankingIndex()
+
+
+@registry.collector
+def _ranking_samples():
+    stats = ranking_index.status()
+    return [
+        ("ranking_keys", "gauge", "(destination, group, theme) rankings held in memory.", [({}, stats["keys"])]),
+        ("ranking_pending_changes", "gauge", "Changed rows waiting to be applied to the rankings.", [({}, stats["pending"])]),
+        ("ranking_destination_refreshes_total", "counter", "Incremental per-destination ranking refreshes.", [({}, stats["destination_refreshes"])]),
+        ("ranking_loads_total", "counter", "Full ranking reloads.", [({}, stats["loads"])]),
+    ]
+
+
+# ---------------------------------------------------------------- API routes
+
+router = APIRouter(prefix="/rankings", dependencies=[Depends(require_admin)])
+
+
+def _resolve(kind: str, destination: str, group: str, theme: str) -> Tuple[int, int, int]:
+    if kind not in ranking_index.kinds:
+        raise HTTPException(status_code=404, detail=f"unknown kind {kind}")
+    catalog_index.ensure_loaded()
+    ranking_index.ensure_loaded()
+    ids = (
+        catalog_index.lookup("destination", destination),
+        catalog_index.lookup("travel_group", group),
+        catalog_index.lookup("travel_theme", theme),
+    )
+    for label, value in zip(("destination", "group", "theme"), ids):
+        if value is None:
+            raise HTTPException(status_code=404, detail=f"unknown {label}")
+    return ids
+
+
+@router.get("/{kind}")
+def rankings_top(kind: str, destination: str, group: str, theme: str, n: int = 10):
+    destination_id, group_id, theme_id = _resolve(kind, destination, group, theme)
+    return [
+        {"id": row_id, "name": name, "score": score}
+        for row_id, name, score in ranking_index.top(kind, destination_id, group_id, theme_id, max(1, min(n, 100)))
+    ]
+
+
+@router.get("/{kind}/search")
+async def rankings_search(kind: str, q: str, destination: str, group: str, theme: str, k: int = TOP_K, weight: float = RANKING_WEIGHT):
+    destination_id, group_id, theme_id = await asyncio.to_thread(_resolve, kind, destination, group, theme)
+    # the embedding is a paid call; skip it when there is nothing to compare it against
+    embedding = None
+    if ranking_index.has_similarity(kind):
+        embedding = await aget_embedding(f"{q} in {destination}", "text-embedding-ada-002", llm)
+    return await asyncio.to_thread(
+        ranking_index.combined, kind, destination_id, group_id, theme_id, embedding, max(1, min(k, 50)), min(max(weight, 0.0), 1.0)
+    )
+
+
+if __name__ == "__main__":
+    # python -m app.rankings [install|load]
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if (sys.argv[1] if len(sys.argv) > 1 else "load") == "install":
+        install_triggers()
+    else:
+        start = time.perf_counter()
+        ranking_index.load()
+        print(f"loaded in {time.perf_counter() - start:.2f}s: {ranking_index.status()}")
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+
+import numpy as np
+
+from app.embedding_cache import normalize_text
+from app.metrics import event, registry
+
+
+def normalize_query(text: str) -> str:
+    return re.sub(r"[^\w\s]", "", normalize_text(text or "")).strip()
+
+
+def prompt_hash(system_prompt: str) -> str:
+    return hashlib.sha256(system_prompt.encode()).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("content", "latency", "vector")
+
+    def __init__(self, content: str, latency: float, vector: Optional[np.ndarray]):
+        self.content = content
+        self.latency = latency
+        self.vector = vector
+
+
+class ResponseCache:
+    """
+    Cache of router-agent replies for deterministic (temperature=0) turns.
+
+    An entry is keyed by the hash of the system prompt, which embeds the
+    itinerary and its version, the normalized recent-context window, and the
+    normalized user query. With `embed` and `semantic_threshold` set, an
+    exact miss falls back to the closest cached query with the same prompt
+    and context whose embedding similarity reaches the threshold.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 2048,
+        context_messages: int = 4,
+        semantic_threshold: Optional[float] = None,
+        embed: Optional[Callable[[str], Awaitable[np.ndarray]]] = None,
+    ):
+        self.max_entries = max_entries
+        self.context_messages = context_messages
+        self.semantic_threshold = semantic_threshold
+        self.embed = embed
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "invalidations": 0, "embed_failures": 0, "saved_seconds": 0.0}
+
+    def _keys(self, messages: List[dict]):
+        system = prompt_hash(messages[0]["content"])
+        context = [
+            f"{m['role']}:{normalize_query(m.get('content'))}"
+            for m in messages[1:-1][-self.context_messages:]
+        ]
+        bucket = (system, hashlib.sha256("\n".join(context).encode()).hexdigest())
+        return bucket, normalize_query(messages[-1]["content"])
+
+    def _hit(self, key, kind: str) -> str:
+        entry = self._entries[key]
+        self._entries.move_to_end(key)
+        self.stats[kind] += 1
+        self.stats["saved_seconds"] += entry.latency
+        return entry.content
+
+    async def _embed(self, query: str, during: str) -> Optional[np.ndarray]:
+        # the cache is an optimization: an embedding failure must not fail the turn
+        try:
+            vector = np.asarray(await self.embed(query), dtype=np.float32)
+        except Exception as e:
+            with self._lock:
+                self.stats["embed_failures"] += 1
+            event("response_cache_embed_failed", level=logging.WARNING, during=during, error=str(e))
+            return None
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    async def lookup(self, messages: List[dict]) -> Optional[str]:
+        bucket, query = self._keys(messages)
+        with self._lock:
+            if (bucket, query) in self._entries:
+                return self._hit((bucket, query), "exact_hits")
+            candidates = [
+                (key, entry.vector) for key, entry in self._entries.items()
+                if key[0] == bucket and entry.vector is not None
+            ]
+
+        if self.semantic_threshold is not None and self.embed is not None and candidates:
+            vector = await self._embed(query, "lookup")
+            scores = np.vstack([v for _, v in candidates]) @ vector if vector is not None else None
+            best = int(np.argmax(scores)) if scores is not None else None
+            if best is not None and scores[best] >= self.semantic_threshold:
+                with self._lock:
+                    if candidates[best][0] in self._entries:
+                        return self._hit(candidates[best][0], "semantic_hits")
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    async def store(self, messages: List[dict], content: str, latency: float):
+        bucket, query = self._keys(messages)
+        vector = None
+        if self.semantic_threshold is not None and self.embed is not None:
+            vector = await self._embed(query, "store")
+            if vector is None:
+                return
+        with self._lock:
+            self._entries[(bucket, query)] = _Entry(content, latency, vector)
+            self._entries.move_to_end((bucket, query))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, system_prompt: str):
+        """Drop every entry built on `system_prompt` (e.g. a superseded itinerary version)."""
+        system = prompt_hash(system_prompt)
+        with self._lock:
+            stale = [key for key in self._entries if key[0][0] == system]
+            for key in stale:
+                del self._entries[key]
+            self.stats["invalidations"] += len(stale)
+
+    def hit_rate(self) -> float:
+        hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "hit_rate": self.hit_rate()}
+
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "true").lower() in ("1", "true", "yes")
+_semantic_threshold = os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD")
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "2048")),
+    context_messages=int(os.getenv("RESPONSE_CACHE_CONTEXT", "4")),
+    semantic_threshold=float(_semantic_threshold) if _semantic_threshold else None,
+)
+
+
+@registry.collector
+def _response_cache_samples():
+    summary = response_cache.summary()
+    return [
+        ("response_cache_events_total", "counter", "Router reply cache hits, misses, invalidations and embedding failures.", [
+            ({"event": key}, summary[key]) for key in ("exact_hits", "semantic_hits", "misses", "invalidations", "embed_failures")
+        ]),
+        ("response_cache_saved_seconds_total", "counter", "Model latency avoided by cache hits.", [({}, summary["saved_seconds"])]),
+        ("response_cache_entries", "gauge", "Cached router replies.", [({}, summary["entries"])]),
+    ]
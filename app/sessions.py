@@ -0,0 +1,332 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def estimate_tokens(message: dict) -> int:
+    """Rough token count (~4 characters per token plus per-message overhead)."""
+    return len(message.get("content") or "") // 4 + 4
+
+
+def trim_to_budget(messages: List[dict], max_tokens: int, keep_last: int = 4) -> List[dict]:
+    """
+    Fit a message list into a token budget before it is sent to the model.
+
+    The most recent `keep_last` messages are always kept. Older messages are
+    dropped oldest-first and replaced by one short summary message listing
+    the earlier user requests, so the prompt stays roughly constant in size
+    however long the conversation runs.
+    """
+    total = sum(estimate_tokens(m) for m in messages)
+    if total <= max_tokens:
+        return list(messages)
+
+    dropped = []
+    kept = list(messages)
+    while len(kept) > keep_last and total > max_tokens:
+        message = kept.pop(0)
+        total -= estimate_tokens(message)
+        dropped.append(message)
+
+    requests = [m["content"][:120] for m in dropped if m["role"] == "user" and m.get("content")]
+    if requests:
+        summary = {
+            "role": "system",
+            "content": "Earlier in this conversation the user asked: " + "; ".join(requests[-10:]),
+        }
+        kept.insert(0, summary)
+    return kept
+
+
+class _Session:
+    __slots__ = ("messages", "history", "state", "state_bytes", "size_bytes", "last_access")
+
+    def __init__(self):
+        self.messages = []
+        self.history = []
+        self.state = {}
+        self.state_bytes = {}
+        self.size_bytes = 0
+        self.last_access = time.monotonic()
+
+
+class SessionBackend:
+    """
+    Interface for conversation storage. Appending a turn is the only write;
+    backends must not rewrite a session's whole history on each turn.
+
+    Coroutines use the a-prefixed methods. By default they run the blocking
+    method in a worker thread so database backends never stall the event loop.
+    """
+
+    def append(self, session_id: str, message: dict):
+        raise NotImplementedError
+
+    def messages(self, session_id: str) -> List[dict]:
+        raise NotImplementedError
+
+    def history(self, session_id: str) -> List[Tuple[str, str]]:
+        return [
+            (m["role"], m["content"])
+            for m in self.messages(session_id)
+            if m["role"] in ("user", "assistant") and m.get("content")
+        ]
+
+    def delete(self, session_id: Optional[str]):
+        raise NotImplementedError
+
+    def get_state(self, session_id: str, key: str):
+        """Per-session structured state (e.g. the current itinerary), or None."""
+        raise NotImplementedError
+
+    def set_state(self, session_id: str, key: str, value):
+        raise NotImplementedError
+
+    async def aappend(self, session_id: str, message: dict):
+        await asyncio.to_thread(self.append, session_id, message)
+
+    async def amessages(self, session_id: str) -> List[dict]:
+        return await asyncio.to_thread(self.messages, session_id)
+
+    async def ahistory(self, session_id: str) -> List[Tuple[str, str]]:
+        return await asyncio.to_thread(self.history, session_id)
+
+    async def adelete(self, session_id: Optional[str]):
+        await asyncio.to_thread(self.delete, session_id)
+
+    async def aget_state(self, session_id: str, key: str):
+        return await asyncio.to_thread(self.get_state, session_id, key)
+
+    async def aset_state(self, session_id: str, key: str, value):
+        await asyncio.to_thread(self.set_state, session_id, key, value)
+
+
+class SessionStore(SessionBackend):
+    """
+    In-memory conversation store with LRU/TTL eviction and a memory cap.
+
+    Each session keeps its raw messages and the (role, content) display
+    history side by side, so neither is rebuilt from scratch on every turn.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        ttl_seconds: float = 3600,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_messages: int = 200,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.total_bytes = 0
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, session_id: str) -> _Session:
+        session = self._sessions.get(session_id)
+        if session is None or time.monotonic() - session.last_access > self.ttl_seconds:
+            if session is not None:
+                self._remove(session_id)
+            session = self._sessions[session_id] = _Session()
+        session.last_access = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _remove(self, session_id: str):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.total_bytes -= session.size_bytes
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            expired = now - session.last_access > self.ttl_seconds
+            over_limit = len(self._sessions) > self.max_sessions or self.total_bytes > self.max_bytes
+            # never evict the session that was just touched
+            if not (expired or over_limit) or len(self._sessions) == 1:
+                break
+            self._remove(session_id)
+            self.evictions += 1
+
+    def append(self, session_id: str, message: dict):
+        size = len((message.get("content") or "").encode())
+        with self._lock:
+            session = self._get(session_id)
+            session.messages.append(message)
+            if message["role"] in ("user", "assistant") and message.get("content"):
+                session.history.append((message["role"], message["content"]))
+            session.size_bytes += size
+            self.total_bytes += size
+
+            while len(session.messages) > self.max_messages:
+                old = session.messages.pop(0)
+                if old["role"] in ("user", "assistant") and old.get("content"):
+                    session.history.pop(0)
+                old_size = len((old.get("content") or "").encode())
+                session.size_bytes -= old_size
+                self.total_bytes -= old_size
+
+            self._evict()
+
+    def messages(self, session_id: str) -> List[dict]:
+        with self._lock:
+            return list(self._get(session_id).messages)
+
+    def history(self, session_id: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return list(self._get(session_id).history)
+
+    def delete(self, session_id: Optional[str]):
+        with self._lock:
+            self._remove(session_id)
+
+    def get_state(self, session_id: str, key: str):
+        with self._lock:
+            return self._get(session_id).state.get(key)
+
+    def set_state(self, session_id: str, key: str, value):
+        # state (the itinerary and its versions) counts toward max_bytes like the messages do
+        size = len(json.dumps(value).encode())
+        with self._lock:
+            session = self._get(session_id)
+            session.state[key] = value
+            delta = size - session.state_bytes.get(key, 0)
+            session.state_bytes[key] = size
+            session.size_bytes += delta
+            self.total_bytes += delta
+            self._evict()
+
+    # in memory nothing blocks, so the async forms skip the thread hop
+    async def aappend(self, session_id: str, message: dict):
+        self.append(session_id, message)
+
+    async def amessages(self, session_id: str) -> List[dict]:
+        return self.messages(session_id)
+
+    async def ahistory(self, session_id: str) -> List[Tuple[str, str]]:
+        return self.history(session_id)
+
+    async def adelete(self, session_id: Optional[str]):
+        self.delete(session_id)
+
+    async def aget_state(self, session_id: str, key: str):
+        return self.get_state(session_id, key)
+
+    async def aset_state(self, session_id: str, key: str, value):
+        self.set_state(session_id, key, value)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SQLSessionBackend(SessionBackend):
+    """
+    Conversation store in a SQL table (one row per message), shared by every
+    worker process that points at the same database. Works with SQLite for a
+    single host and with the application Postgres pool for multiple nodes.
+    """
+
+    def __init__(self, engine, ttl_seconds: float = 3600, max_messages: int = 200, sweep_every: int = 500):
+        from app.db import SessionMessage, SessionState
+
+        self.engine = engine
+        self.table = SessionMessage.__table__
+        self.state_table = SessionState.__table__
+        self.ttl_seconds = ttl_seconds
+        self.max_messages = max_messages
+        self.sweep_every = sweep_every
+        self._appends = 0
+        self.table.create(engine, checkfirst=True)
+        self.state_table.create(engine, checkfirst=True)
+
+    def append(self, session_id: str, message: dict):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert().values(
+                session_id=session_id,
+                role=message["role"],
+                content=message.get("content") or "",
+                created_at=time.time(),
+            ))
+        self._appends += 1
+        if self._appends % self.sweep_every == 0:
+            self.expire()
+
+    def messages(self, session_id: str) -> List[dict]:
+        t = self.table
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(t.c.role, t.c.content)
+                .where(t.c.session_id == session_id)
+                .order_by(t.c.id.desc())
+                .limit(self.max_messages)
+            ).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def delete(self, session_id: Optional[str]):
+        with self.engine.begin() as conn:
+            conn.execute(self.table.delete().where(self.table.c.session_id == session_id))
+            conn.execute(self.state_table.delete().where(self.state_table.c.session_id == session_id))
+
+    def get_state(self, session_id: str, key: str):
+        t = self.state_table
+        with self.engine.connect() as conn:
+            value = conn.execute(
+                select(t.c.value).where(t.c.session_id == session_id, t.c.key == key)
+            ).scalar()
+        return json.loads(value) if value is not None else None
+
+    def set_state(self, session_id: str, key: str, value):
+        # one upsert, so concurrent writers of the same key cannot collide on the primary key
+        dialect = postgresql if self.engine.dialect.name == "postgresql" else sqlite
+        stmt = dialect.insert(self.state_table).values(session_id=session_id, key=key, value=json.dumps(value))
+        stmt = stmt.on_conflict_do_update(index_elements=["session_id", "key"], set_={"value": stmt.excluded.value})
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def expire(self):
+        """Delete sessions whose most recent message is older than the TTL."""
+        t = self.table
+        cutoff = time.time() - self.ttl_seconds
+        stale = (
+            select(t.c.session_id)
+            .group_by(t.c.session_id)
+            .having(func.max(t.c.created_at) < cutoff)
+        )
+        with self.engine.begin() as conn:
+            conn.execute(self.state_table.delete().where(self.state_table.c.session_id.in_(stale)))
+            conn.execute(t.delete().where(t.c.session_id.in_(stale)))
+
+
+def create_session_backend() -> SessionBackend:
+    """Build the backend selected by SESSION_BACKEND (memory, sqlite or postgres)."""
+    backend = os.getenv("SESSION_BACKEND", "memory").lower()
+    ttl_seconds = float(os.getenv("SESSION_TTL", "3600"))
+    max_messages = int(os.getenv("SESSION_MAX_MESSAGES", "200"))
+
+    if backend == "sqlite":
+        engine = create_engine(f"sqlite:///{os.getenv('SESSION_DB_PATH', 'sessions.db')}")
+        return SQLSessionBackend(engine, ttl_seconds, max_messages)
+    if backend == "postgres":
+        from app.db import engine
+
+        return SQLSessionBackend(engine, ttl_seconds, max_messages)
+    return SessionStore(
+        max_sessions=int(os.getenv("SESSION_MAX_COUNT", "1000")),
+        ttl_seconds=ttl_seconds,
+        max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024))),
+        max_messages=max_messages,
+    )
+
+
+session_store = create_session_backend()
@@ -0,0 +1,187 @@
+"""
+Local stand-in for the OpenAI API used by load, concurrency and fault tests.
+
+Serves /v1/chat/completions and /v1/embeddings with a configurable delay so the
+agent can be exercised without network access or API spend. A fraction of
+requests can be failed with a chosen status code or stalled, to exercise
+retries, timeouts and circuit breaking. Running the module starts the stub and
+measures agent throughput at increasing session counts.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+EMBEDDING_DIMENSIONS = 1536
+
+app = FastAPI()
+app.state.latency = float(os.getenv("STUB_LLM_LATENCY", "0.5"))
+app.state.token_latency = float(os.getenv("STUB_LLM_TOKEN_LATENCY", "0.02"))
+app.state.reply = "Here is a brief summary of your itinerary. What would you like to change?"
+app.state.error_rate = float(os.getenv("STUB_LLM_ERROR_RATE", "0"))
+app.state.error_status = int(os.getenv("STUB_LLM_ERROR_STATUS", "503"))
+app.state.stall_rate = float(os.getenv("STUB_LLM_STALL_RATE", "0"))
+app.state.stall_seconds = float(os.getenv("STUB_LLM_STALL_SECONDS", "30"))
+app.state.requests = 0
+
+
+async def _inject_faults():
+    """Fail or stall a configured fraction of requests; None means serve normally."""
+    app.state.requests += 1
+    roll = random.random()
+    if roll < app.state.error_rate:
+        return JSONResponse(
+            status_code=app.state.error_status,
+            content={"error": {"message": "injected fault", "type": "server_error"}},
+            headers={"retry-after": "0"} if app.state.error_status == 429 else None,
+        )
+    if roll < app.state.error_rate + app.state.stall_rate:
+        await asyncio.sleep(app.state.stall_seconds)
+    return None
+
+
+def _stub_embedding(text: str) -> list:
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(EMBEDDING_DIMENSIONS)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def _usage(prompt: str, completion: str = "") -> dict:
+    # rough 4-characters-per-token estimate, enough for metrics checks
+    prompt_tokens, completion_tokens = len(prompt) // 4, len(completion) // 4
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+async def _stream_completion(model: str, prompt: str, include_usage: bool):
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    for i, token in enumerate(app.state.reply.split(" ")):
+        await asyncio.sleep(app.state.token_latency)
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "delta": {"role": "assistant", "content": token if i == 0 else f" {token}"},
+                "finish_reason": None,
+            }],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    if include_usage:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [],
+            "usage": _usage(prompt, app.state.reply),
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    fault = await _inject_faults()
+    if fault is not None:
+        return fault
+    await asyncio.sleep(app.state.latency)
+    prompt = "".join(str(m.get("content") or "") for m in body.get("messages", []))
+    if body.get("stream"):
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(
+            _stream_completion(body.get("model", "stub"), prompt, include_usage), media_type="text/event-stream"
+        )
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": app.state.reply},
+            "finish_reason": "stop",
+        }],
+        "usage": _usage(prompt, app.state.reply),
+    }
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    fault = await _inject_faults()
+    if fault is not None:
+        return fault
+    await asyncio.sleep(app.state.latency)
+    return {
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": _stub_embedding(text)}
+            for i, text in enumerate(inputs)
+        ],
+        "model": body.get("model", "stub"),
+        "usage": _usage("".join(inputs)),
+    }
+
+
+def start_stub_server(port: int = 8765) -> uvicorn.Server:
+    """Start the stub in a daemon thread and return once it accepts requests."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+# Concurrency check: sessions/second through the async agent vs. the sync wrapper.
+if __name__ == "__main__":
+    port = int(os.getenv("STUB_LLM_PORT", "8765"))
+    server = start_stub_server(port)
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ.setdefault("DATABASE_URL", "postgresql://localhost/stub")
+    # every session sends the same turn; measure the model path, not the cache
+    os.environ.setdefault("RESPONSE_CACHE", "false")
+
+    from app import main as agent
+
+    itinerary = agent.json.dumps(agent.itineary)
+
+    start = time.perf_counter()
+    for i in range(4):
+        agent.generate_user_intentions("show me the itinerary", itinerary, f"sync-{i}")
+    sync_elapsed = time.perf_counter() - start
+    print(f"sync sequential: 4 sessions in {sync_elapsed:.2f}s ({4 / sync_elapsed:.1f} sessions/s)")
+
+    async def run_sessions(count: int) -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            agent.agenerate_user_intentions("show me the itinerary", itinerary, f"async-{count}-{i}")
+            for i in range(count)
+        ))
+        return time.perf_counter() - start
+
+    for count in (1, 4, 16, 64):
+        elapsed = asyncio.run(run_sessions(count))
+        print(f"async concurrent: {count} sessions in {elapsed:.2f}s ({count / elapsed:.1f} sessions/s)")
+
+    async def stream_session():
+        async for _ in agent.astream_user_intentions("show me the itinerary", itinerary, "stream-0"):
+            pass
+
+    asyncio.run(stream_session())
+    print("streaming latency:", agent.latency_summary())
+
+    server.should_exit = True
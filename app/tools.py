@@ -0,0 +1,151 @@
+import asyncio
+import inspect
+import json
+import logging
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from app.metrics import event, observe_stage, registry
+
+
+class ToolRegistry:
+    """
+    Maps tool names from the model's tool calls to local handlers.
+
+    Handlers take the session id plus the tool's JSON arguments as keyword
+    arguments and return the text to append to the conversation (or None to
+    append nothing). Sync handlers run in a worker thread. A tool may also
+    register a streaming form (an async generator of partial results) for
+    callers that show progress; it shares the tool's timeout and stats.
+    """
+
+    def __init__(self, default_timeout: float = 30.0):
+        self.default_timeout = default_timeout
+        self._handlers: Dict[str, Tuple[Callable[..., Awaitable[Optional[str]]], float]] = {}
+        self._streams: Dict[str, Callable[..., AsyncIterator[str]]] = {}
+        self._stats_lock = threading.Lock()
+        self.stats: Dict[str, dict] = {}
+
+    def register(self, name: str, timeout: Optional[float] = None):
+        def decorator(handler):
+            if inspect.iscoroutinefunction(handler):
+                wrapped = handler
+            else:
+                async def wrapped(*args, **kwargs):
+                    return await asyncio.to_thread(handler, *args, **kwargs)
+            self._handlers[name] = (wrapped, timeout or self.default_timeout)
+            return handler
+        return decorator
+
+    def register_stream(self, name: str):
+        """Streaming form of an already registered tool: an async generator whose last yield is the result."""
+        def decorator(handler):
+            self._streams[name] = handler
+            return handler
+        return decorator
+
+    def streams(self, name: str) -> bool:
+        return name in self._streams and name in self._handlers
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._handlers
+
+    def _record(self, name: str, seconds: float, outcome: str):
+        observe_stage(f"tool:{name}", seconds, outcome)
+        with self._stats_lock:
+            stats = self.stats.setdefault(
+                name, {"calls": 0, "total_seconds": 0.0, "max_seconds": 0.0, "errors": 0, "timeouts": 0}
+            )
+            stats["calls"] += 1
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            if outcome == "error":
+                stats["errors"] += 1
+            elif outcome == "timeout":
+                stats["timeouts"] += 1
+
+    async def call(self, session_id: str, name: str, arguments: str) -> Optional[str]:
+        if name not in self._handlers:
+            event("unknown_tool", level=logging.WARNING, tool=name)
+            return None
+        handler, timeout = self._handlers[name]
+
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            kwargs = json.loads(arguments) if arguments else {}
+            return await asyncio.wait_for(handler(session_id, **kwargs), timeout)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            return f"{name} timed out after {timeout:g}s"
+        except Exception as e:
+            outcome = "error"
+            event("tool_failed", level=logging.WARNING, tool=name, error=str(e))
+            return f"{name} failed: {e}"
+        finally:
+            self._record(name, time.perf_counter() - start, outcome)
+
+    async def stream(self, session_id: str, name: str, arguments: str) -> AsyncIterator[str]:
+        """
+        Streaming counterpart of call(): yields the handler's partial results.
+        The last value yielded is the text to append, or the timeout/error
+        message. The tool's timeout bounds the whole stream.
+        """
+        handler = self._streams[name]
+        timeout = self._handlers[name][1]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        start = time.perf_counter()
+        outcome = "ok"
+        iterator = None
+        try:
+            kwargs = json.loads(arguments) if arguments else {}
+            iterator = handler(session_id, **kwargs).__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(iterator.__anext__(), max(0.0, deadline - loop.time()))
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            yield f"{name} timed out after {timeout:g}s"
+        except Exception as e:
+            outcome = "error"
+            event("tool_failed", level=logging.WARNING, tool=name, error=str(e))
+            yield f"{name} failed: {e}"
+        finally:
+            self._record(name, time.perf_counter() - start, outcome)
+            if iterator is not None:
+                await iterator.aclose()
+
+    async def dispatch(self, session_id: str, calls: Sequence[Tuple[str, str]]) -> List[Optional[str]]:
+        """
+        Run (name, arguments) tool calls concurrently. Results come back in the
+        order of `calls`, whatever order the handlers finish in.
+        """
+        return await asyncio.gather(*(self.call(session_id, name, arguments) for name, arguments in calls))
+
+    def latency_summary(self) -> Dict[str, dict]:
+        with self._stats_lock:
+            return {
+                name: {**stats, "mean_seconds": stats["total_seconds"] / stats["calls"]}
+                for name, stats in self.stats.items()
+                if stats["calls"]
+            }
+
+
+tool_registry = ToolRegistry()
+
+
+@registry.collector
+def _tool_samples():
+    summary = tool_registry.latency_summary()
+    return [
+        ("tool_calls_total", "counter", "Tool handler calls by outcome.", [
+            ({"tool": name, "outcome": outcome}, stats[key])
+            for name, stats in summary.items()
+            for outcome, key in (("all", "calls"), ("error", "errors"), ("timeout", "timeouts"))
+        ]),
+    ]
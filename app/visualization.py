@@ -1,15 +1,32 @@
-import psycopg2
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import os
+import struct
+import time
 from dotenv import load_dotenv
 import ast
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse, Response
+from app.db import get_connection
+from app.embedding_loader import decode_vector_send, decode_vectors, load_embeddings
+from app.projection import fit_projection, project_embeddings
+from app.profiler import require_admin
 
 load_dotenv()
 
+# Above this many points the figure switches to WebGL traces and downsampling
+SVG_POINT_LIMIT = int(os.getenv("PLOT_SVG_POINT_LIMIT", "5000"))
+MAX_PLOT_POINTS = int(os.getenv("PLOT_MAX_POINTS", "50000"))
+DENSITY_BINS = int(os.getenv("PLOT_DENSITY_BINS", "200"))
+
+# Tables the API routes may plot, with the column shown as a point's label
+VISUALIZABLE_TABLES = {
+    "must_travel_activity": "name",
+    "recommended_activity": "name",
+}
+
 def parse_postgres_array(array_str):
     """
     Parse a PostgreSQL array string into a numpy array.
@@ -37,7 +54,12 @@ def visualize_embeddings(
     embedding_column,
     label_column=None,
     reduction_method='pca',
-    n_components=2
+    n_components=2,
+    limit=None,
+    sample=None,
+    cache=True,
+    render_mode='auto',
+    max_points=MAX_PLOT_POINTS
 ):
     """
     Visualize embeddings stored in PostgreSQL using dimensionality reduction.
@@ -49,44 +71,39 @@ def visualize_embeddings(
     - label_column: optional column name for color-coding points
     - reduction_method: 'pca' or 'tsne'
     - n_components: number of dimensions to reduce to (2 or 3)
+    - limit / sample: plot at most `limit` rows, or a random fraction `sample`
+    - cache: reuse the persisted layout for the full table (see app.projection)
+    - render_mode: 'svg' (one labelled point per row), 'webgl' (density
+      background plus at most `max_points` WebGL points carrying only ids),
+      or 'auto' to pick webgl above SVG_POINT_LIMIT rows
     """
-    # Connect to PostgreSQL
-    conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-    cursor = conn.cursor()
-    
-    # Fetch embeddings and labels
-    if label_column:
-        cursor.execute(f"SELECT {embedding_column}, {label_column} FROM {table_name}")
-        rows = cursor.fetchall()
-        embeddings = []
-        labels = []
-        for emb_str, label in rows:
-            try:
-                embeddings.append(parse_postgres_array(emb_str))
-                labels.append(label)
-            except ValueError as e:
-                print(f"Skipping malformed embedding: {e}")
+    if cache and limit is None and sample is None:
+        # coordinates come from the projection cache; only changed rows are loaded
+        projection = project_embeddings(
+            table_name, embedding_column, label_column,
+            method=reduction_method, n_components=n_components
+        )
+        ids = projection.ids
+        reduced_embeddings = projection.coords
+        labels = projection.labels
     else:
-        cursor.execute(f"SELECT {embedding_column} FROM {table_name}")
-        rows = cursor.fetchall()
-        embeddings = []
-        labels = None
-        for (emb_str,) in rows:
-            try:
-                embeddings.append(parse_postgres_array(emb_str))
-            except ValueError as e:
-                print(f"Skipping malformed embedding: {e}")
-    
-    # Convert embeddings to numpy array
-    X = np.array(embeddings)
-    
-    # Apply dimensionality reduction
-    if reduction_method.lower() == 'pca':
-        reducer = PCA(n_components=n_components)
-    else:  # t-SNE
-        reducer = TSNE(n_components=n_components, random_state=42, perplexity=2)
-    
-    reduced_embeddings = reducer.fit_transform(X)
+        # Stream the embeddings into a float32 matrix and fit from scratch
+        data = load_embeddings(table_name, embedding_column, label_column, limit=limit, sample=sample)
+        ids = data.ids
+        reduced_embeddings = fit_projection(data.vectors, reduction_method.lower(), n_components)[0]
+        labels = data.labels
+
+    if render_mode == 'auto':
+        render_mode = 'webgl' if len(ids) > SVG_POINT_LIMIT else 'svg'
+    if render_mode == 'webgl':
+        # labels stay on the server; look them up by id with lookup_labels
+        return scalable_figure(
+            ids, reduced_embeddings,
+            title=f'Embedding Visualization using {reduction_method.upper()} ({len(ids):,} points)',
+            max_points=max_points
+        )
+    if render_mode != 'svg':
+        raise ValueError(f"Unknown render_mode: {render_mode}")
     
     # Create DataFrame for plotting
     plot_data = pd.DataFrame(
@@ -116,14 +133,221 @@ def visualize_embeddings(
             title=f'Embedding Visualization using {reduction_method.upper()}'
         )
     
-    # Close database connection
-    cursor.close()
-    conn.close()
-    
     return fig
 
+def downsample(coords, max_points=MAX_PLOT_POINTS, grid=128, seed=0):
+    """
+    Level-of-detail sample: indices of at most `max_points` rows, spread over
+    a grid so sparse regions and outliers survive while dense clusters are
+    thinned. Returns sorted indices into `coords`.
+    """
+    n = len(coords)
+    if n <= max_points:
+        return np.arange(n)
+    lo, hi = coords[:, :2].min(axis=0), coords[:, :2].max(axis=0)
+    cells = np.clip(((coords[:, :2] - lo) / np.maximum(hi - lo, 1e-12) * grid).astype(np.int64), 0, grid - 1)
+    cell = cells[:, 0] * grid + cells[:, 1]
+    # random order within each cell, then rank each point inside its cell
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(n), cell))
+    sorted_cells = cell[order]
+    starts = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+    sizes = np.diff(np.r_[starts, n])
+    rank = np.arange(n) - np.repeat(starts, sizes)
+    # largest per-cell cap whose total stays within max_points
+    counts = np.sort(sizes)
+    kept = np.cumsum(counts) + counts * np.arange(len(counts) - 1, -1, -1)
+    full = np.searchsorted(kept, max_points, side='right')
+    base, used = (counts[full - 1], kept[full - 1]) if full else (0, 0)
+    cap = int(base + (max_points - used) // (len(counts) - full))
+    chosen = order[rank < max(cap, 1)]
+    if len(chosen) > max_points:
+        # more occupied cells than points allowed: one random point per random cell
+        chosen = rng.choice(chosen, max_points, replace=False)
+    return np.sort(chosen)
+
+def density_grid(coords, bins=DENSITY_BINS):
+    """2D histogram of all points: (counts, x_edges, y_edges)."""
+    counts, x_edges, y_edges = np.histogram2d(coords[:, 0], coords[:, 1], bins=bins)
+    return counts.astype(np.uint32), x_edges, y_edges
+
+def scalable_figure(ids, coords, title=None, max_points=MAX_PLOT_POINTS, bins=DENSITY_BINS):
+    """
+    Figure for large tables: a log-density heatmap of every point under a
+    downsampled Scattergl layer. Points carry their id as customdata, so the
+    client fetches labels on hover or click instead of receiving them all.
+    """
+    ids = np.asarray(ids)
+    coords = np.asarray(coords, dtype=np.float32)
+    keep = downsample(coords, max_points)
+    fig = go.Figure()
+    if coords.shape[1] == 3:
+        fig.add_trace(go.Scatter3d(
+            x=coords[keep, 0], y=coords[keep, 1], z=coords[keep, 2],
+            mode='markers', marker=dict(size=2, opacity=0.6),
+            customdata=ids[keep], hovertemplate='id %{customdata}<extra></extra>'
+        ))
+    else:
+        counts, x_edges, y_edges = density_grid(coords, bins)
+        fig.add_trace(go.Heatmap(
+            z=np.log1p(counts.T).astype(np.float32),
+            x=((x_edges[:-1] + x_edges[1:]) / 2).astype(np.float32),
+            y=((y_edges[:-1] + y_edges[1:]) / 2).astype(np.float32),
+            colorscale='Greys', showscale=False, hoverinfo='skip'
+        ))
+        fig.add_trace(go.Scattergl(
+            x=coords[keep, 0], y=coords[keep, 1],
+            mode='markers', marker=dict(size=3, opacity=0.5),
+            customdata=ids[keep], hovertemplate='id %{customdata}<extra></extra>'
+        ))
+    fig.update_layout(title=title, showlegend=False, meta={'total_points': len(ids), 'plotted_points': len(keep)})
+    return fig
+
+def encode_points(ids, coords):
+    """
+    Binary point payload: little-endian header (b"EMBP", uint32 rows,
+    uint32 dims), then int64 ids, then float32 coords row by row.
+    """
+    ids = np.ascontiguousarray(ids, dtype='<i8')
+    coords = np.ascontiguousarray(coords, dtype='<f4')
+    return struct.pack('<4sII', b'EMBP', len(ids), coords.shape[1]) + ids.tobytes() + coords.tobytes()
+
+def decode_points(payload):
+    """Inverse of encode_points: (ids, coords)."""
+    magic, rows, dims = struct.unpack_from('<4sII', payload)
+    if magic != b'EMBP':
+        raise ValueError("not an EMBP payload")
+    offset = struct.calcsize('<4sII')
+    ids = np.frombuffer(payload, dtype='<i8', count=rows, offset=offset)
+    coords = np.frombuffer(payload, dtype='<f4', count=rows * dims, offset=offset + rows * 8).reshape(rows, dims)
+    return ids, coords
+
+def lookup_labels(table_name, ids, label_column=None, connection_factory=get_connection):
+    """Labels for a handful of points, fetched when the client asks for them."""
+    label_column = label_column or VISUALIZABLE_TABLES[table_name]
+    with connection_factory() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, {label_column} FROM {table_name} WHERE id = ANY(%s)",
+                (list(map(int, ids)),)
+            )
+            return {str(row[0]): row[1] for row in cursor.fetchall()}
+
+# ---------------------------------------------------------------- API routes
+
+router = APIRouter(prefix="/visualization", dependencies=[Depends(require_admin)])
+
+def _projection(table_name, method, n_components):
+    if table_name not in VISUALIZABLE_TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table {table_name}")
+    if method not in ('pca', 'tsne') or n_components not in (2, 3):
+        raise HTTPException(status_code=422, detail="method must be pca or tsne, dims 2 or 3")
+    return project_embeddings(table_name, 'embedding', method=method, n_components=n_components)
+
+@router.get("/{table_name}/points")
+def visualization_points(
+    table_name: str,
+    method: str = 'pca',
+    dims: int = 2,
+    max_points: int = MAX_PLOT_POINTS,
+    bins: int = DENSITY_BINS,
+    format: str = 'json'
+):
+    """
+    Downsampled points for a client-side renderer. `format=binary` returns
+    the encode_points layout; JSON also carries the density grid (2D only).
+    """
+    projection = _projection(table_name, method, dims)
+    keep = downsample(projection.coords, max(1, max_points))
+    ids, coords = projection.ids[keep], projection.coords[keep].astype(np.float32)
+    headers = {"X-Total-Points": str(len(projection.ids)), "X-Projection-Status": projection.status}
+    if format == 'binary':
+        return Response(encode_points(ids, coords), media_type="application/octet-stream", headers=headers)
+    payload = {
+        "total": len(projection.ids),
+        "status": projection.status,
+        "ids": ids.tolist(),
+        "coords": np.round(coords, 4).tolist(),
+    }
+    if dims == 2:
+        counts, x_edges, y_edges = density_grid(projection.coords, max(1, min(bins, 1000)))
+        payload["density"] = {
+            "counts": counts.T.tolist(),
+            "x_range": [float(x_edges[0]), float(x_edges[-1])],
+            "y_range": [float(y_edges[0]), float(y_edges[-1])],
+        }
+    return JSONResponse(payload, headers=headers)
+
+@router.get("/{table_name}/figure")
+def visualization_figure(table_name: str, method: str = 'pca', dims: int = 2, max_points: int = MAX_PLOT_POINTS):
+    """Plotly figure JSON (arrays base64-encoded) for Plotly.newPlot on the client."""
+    projection = _projection(table_name, method, dims)
+    fig = scalable_figure(projection.ids, projection.coords, title=f"{table_name} ({method.upper()})", max_points=max(1, max_points))
+    return Response(fig.to_json(), media_type="application/json")
+
+@router.get("/{table_name}/labels")
+def visualization_labels(table_name: str, ids: str = Query(..., description="comma-separated ids, at most 500")):
+    if table_name not in VISUALIZABLE_TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table {table_name}")
+    try:
+        wanted = [int(value) for value in ids.split(",") if value.strip()][:500]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="ids must be integers")
+    return lookup_labels(table_name, wanted)
+
+def benchmark_decoding(rows=20000, dims=1536, chunk_size=5000):
+    """
+    Decode synthetic embeddings three ways: parse_postgres_array per row,
+    decode_vectors (text) and decode_vector_send (binary). Timings are
+    untraced; peak memory is measured separately on a slice.
+    """
+    import struct
+    import tracemalloc
+
+    rng = np.random.default_rng(0)
+    base = rng.standard_normal((min(rows, 500), dims)).astype(np.float32)
+    texts = ["[" + ",".join(repr(float(x)) for x in base[i % len(base)]) + "]" for i in range(rows)]
+    # the loader has the server strip the brackets
+    trimmed = [t[1:-1] for t in texts]
+    sent = [struct.pack(">hh", dims, 0) + base[i % len(base)].astype(">f4").tobytes() for i in range(rows)]
+
+    def old(n):
+        return np.array([parse_postgres_array(t) for t in texts[:n]])
+
+    def chunked(decode, values):
+        def run(n):
+            matrix = np.empty((n, dims), dtype=np.float32)
+            for start in range(0, n, chunk_size):
+                chunk = values[start:min(n, start + chunk_size)]
+                matrix[start:start + len(chunk)] = decode(chunk)
+            return matrix
+        return run
+
+    traced_rows = min(rows, 5000)
+    for label, fn in (
+        ("parse_postgres_array", old),
+        ("decode_vectors", chunked(decode_vectors, trimmed)),
+        ("decode_vector_send", chunked(decode_vector_send, sent)),
+    ):
+        start = time.perf_counter()
+        result = fn(rows)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        fn(traced_rows)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(
+            f"{label:22} {rows} x {dims}: {elapsed:.2f}s ({rows / elapsed:,.0f} rows/s), "
+            f"result {result.nbytes / 1e6:.0f} MB {result.dtype}, peak {peak / 1e6:.0f} MB per {traced_rows} rows"
+        )
+
+
 # Example usage:
 if __name__ == "__main__":
+    if os.getenv("BENCH_LOADER_ROWS"):
+        benchmark_decoding(int(os.getenv("BENCH_LOADER_ROWS")))
+        raise SystemExit
+
     db_params = {
         'dbname': 'your_database',
         'user': 'your_username',
@@ -0,0 +1,4 @@
+import os
+
+# app.db builds its engine at import time; nothing here connects to it
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/stub")
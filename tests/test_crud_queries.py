@@ -0,0 +1,116 @@
+"""
+Query-count checks for app.crud on an in-memory SQLite copy of the schema:
+the lazy walk grows with the data, the repository paths do not.
+"""
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from app.crud import (
+    DESTINATION_TREE,
+    bulk_insert,
+    bulk_update,
+    count_queries,
+    get_destination,
+    list_hotels,
+    list_locations,
+)
+from app.db import Base, Destination, Hotel, Location, Pair, Region
+
+DESTINATIONS, LOCATIONS, HOTELS = 20, 10, 5
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        (region_id,) = bulk_insert(db, Region, [{"region": "Asia"}])[0]
+        (pair_id,) = bulk_insert(db, Pair, [{"destination_pair": "Bali - Lombok"}])[0]
+        destination_ids = [row.id for row in bulk_insert(db, Destination, [
+            {"name": f"dest{i}", "code": f"D{i}", "region_id": region_id, "pair_id": pair_id} for i in range(DESTINATIONS)
+        ])]
+        location_ids = [row.id for row in bulk_insert(db, Location, [
+            {"name": f"loc{d}-{i}", "destination_id": d} for d in destination_ids for i in range(LOCATIONS)
+        ])]
+        bulk_insert(db, Hotel, [
+            {"name": f"hotel{location_id}-{i}", "location": "x", "location_id": location_id, "star": 3, "rating": 3.0}
+            for location_id in location_ids for i in range(HOTELS)
+        ])
+        db.commit()
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    with Session(engine) as session:
+        yield session
+        session.rollback()
+
+
+def _walk(destinations) -> int:
+    return sum(len(location.hotels) for destination in destinations for location in destination.locations)
+
+
+def test_bulk_insert_returns_rows_in_order(db):
+    rows = [{"name": f"r{i}", "code": f"R{i}", "region_id": 1, "pair_id": 1} for i in range(5)]
+    inserted = bulk_insert(db, Destination, rows, returning=("id", "name"))
+    assert [row.name for row in inserted] == [row["name"] for row in rows]
+    assert [row.id for row in inserted] == sorted(row.id for row in inserted)
+
+
+def test_lazy_walk_is_n_plus_one(engine, db):
+    with count_queries(engine) as queries:
+        assert _walk(db.scalars(select(Destination)).all()) == DESTINATIONS * LOCATIONS * HOTELS
+    assert queries.count == 1 + DESTINATIONS + DESTINATIONS * LOCATIONS
+
+
+def test_destination_tree_loads_in_three_queries(engine, db):
+    with count_queries(engine) as queries:
+        destinations = db.scalars(select(Destination).options(*DESTINATION_TREE)).unique().all()
+        assert _walk(destinations) == DESTINATIONS * LOCATIONS * HOTELS
+        assert all(destination.region.region == "Asia" for destination in destinations)
+    assert queries.count == 3, queries.statements
+
+
+def test_get_destination_tree(engine, db):
+    with count_queries(engine) as queries:
+        destination = get_destination(db, DESTINATIONS, tree=True)
+        assert _walk([destination]) == LOCATIONS * HOTELS
+        assert destination.pair.destination_pair == "Bali - Lombok"
+    assert queries.count == 3, queries.statements
+
+
+def test_keyset_pagination_one_query_per_page(engine, db):
+    with count_queries(engine) as queries:
+        after, names = None, []
+        while True:
+            page = list_locations(db, after=after, limit=64, columns=["name"])
+            names += [row.name for row in page.items]
+            if page.next_after is None:
+                break
+            after = page.next_after
+    assert len(names) == len(set(names)) == DESTINATIONS * LOCATIONS
+    assert queries.count == -(-DESTINATIONS * LOCATIONS // 64)
+
+
+def test_projection_returns_only_requested_columns(db):
+    page = list_hotels(db, destination_id=1, limit=3, columns=["rating"])
+    assert [tuple(row._fields) for row in page.items] == [("id", "rating")] * 3
+    assert page.next_after == page.items[-1].id
+
+
+def test_unknown_projection_column(db):
+    with pytest.raises(ValueError):
+        list_hotels(db, columns=["price"])
+
+
+def test_bulk_update_two_statements(engine, db):
+    total = DESTINATIONS * LOCATIONS * HOTELS
+    with count_queries(engine) as queries:
+        updated = bulk_update(db, Hotel, [{"id": i, "rating": 4.5} for i in range(1, total + 1)], returning=("id", "rating"))
+    assert len(updated) == total and all(row.rating == 4.5 for row in updated)
+    # executemany UPDATE plus one SELECT of the returned columns (one UPDATE ... FROM VALUES on PostgreSQL)
+    assert queries.count == 2, queries.statements
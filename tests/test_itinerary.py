@@ -0,0 +1,129 @@
+"""
+The local itinerary edit planners and JSON Patch application, on a copy of
+the sample Dubai package.
+"""
+import copy
+
+import pytest
+
+from app.itinerary import (
+    PatchError,
+    apply_edit,
+    apply_patch,
+    plan_add_free_day,
+    plan_remove_activity,
+    plan_remove_free_day,
+    plan_reorder_activities,
+)
+
+DUBAI = {
+    "packageName": "Dubai Standard Package",
+    "rating": 4.8,
+    "duration": "4 Nights & 5 Days",
+    "inclusions": {
+        "airfare": "Return Economy Airfare",
+        "accommodation": "4-star hotel for 4 nights",
+        "meals": "4 breakfasts at the hotel",
+        "transportation": {
+            "airportTransfers": "Return private airport transfers",
+            "cityTour": "Half Day Dubai City Tour with shared transfer",
+            "desertSafari": "Standard Desert Safari with shared transfer (Falcon Camp or Similar)",
+            "burjKhalifa": "At the Top Burj Khalifa (124 & 125 Floors - Non Prime Time) with shared transfer",
+            "creekCruise": "Dubai Creek Cruise with shared transfer",
+        },
+    },
+    "itinerary": [
+        {
+            "day": 1,
+            "title": "Arrival in Dubai",
+            "description": "Meet and greet at the airport, transfer to the hotel (standard check-in time is 3 PM). Day at leisure. Overnight at the hotel.",
+        },
+        {
+            "day": 2,
+            "title": "Dubai City Tour and Desert Safari",
+            "description": "Buffet breakfast at the hotel. Half-day Dubai City Tour with return shared transfer. Standard Desert Safari with return shared transfer. Overnight at the hotel.",
+        },
+        {
+            "day": 3,
+            "title": "Dubai Creek Cruise and Burj Khalifa",
+            "description": "Buffet breakfast at the hotel. Dubai Creek Cruise with shared transfer. Visit 'At the Top Burj Khalifa' (124 & 125 Floors - Non Prime Time) with return shared transfer. Overnight at the hotel.",
+        },
+        {
+            "day": 4,
+            "title": "Free Day for Exploration",
+            "description": "Buffet breakfast at the hotel. The day is free for you to customize as per your interest. Overnight at the hotel.",
+        },
+        {
+            "day": 5,
+            "title": "Departure from Dubai",
+            "description": "Buffet breakfast at the hotel. Departure transfer to Dubai airport. Return flight back to India.",
+        },
+    ],
+    "exclusions": ["Visa cost"],
+}
+
+
+@pytest.fixture
+def document():
+    return copy.deepcopy(DUBAI)
+
+
+def test_add_free_day_goes_before_departure(document):
+    updated = apply_edit(document, plan_add_free_day(document))
+    assert [day["day"] for day in updated["itinerary"]] == [1, 2, 3, 4, 5, 6]
+    assert updated["itinerary"][4]["title"] == "Free Day for Exploration"
+    assert updated["itinerary"][5]["title"] == "Departure from Dubai"
+    assert updated["duration"] == "5 Nights & 6 Days"
+
+
+def test_remove_free_day_renumbers_the_rest(document):
+    updated = apply_edit(document, plan_remove_free_day(document))
+    assert [day["title"] for day in updated["itinerary"]][-2:] == ["Dubai Creek Cruise and Burj Khalifa", "Departure from Dubai"]
+    assert [day["day"] for day in updated["itinerary"]] == [1, 2, 3, 4]
+    assert updated["duration"] == "3 Nights & 4 Days"
+
+
+def test_remove_free_day_without_one(document):
+    del document["itinerary"][3]
+    assert plan_remove_free_day(document) is None
+
+
+def test_remove_activity_edits_day_title_and_inclusion(document):
+    updated = apply_edit(document, plan_remove_activity(document, "desert safari"))
+    day = updated["itinerary"][1]
+    assert "Safari" not in day["description"]
+    assert "Half-day Dubai City Tour" in day["description"]
+    assert day["title"] == "Dubai City Tour"
+    assert "desertSafari" not in updated["inclusions"]["transportation"]
+    assert updated["itinerary"][2] == document["itinerary"][2]
+
+
+@pytest.mark.parametrize("activity", ["hotel", "airport transfer", "snorkelling"])
+def test_remove_activity_defers_when_no_single_day_names_it(document, activity):
+    assert plan_remove_activity(document, activity) is None
+
+
+def test_reorder_activity_moves_sentence_and_title(document):
+    updated = apply_edit(document, plan_reorder_activities(document, "Dubai Creek Cruise", "first"))
+    first, third = updated["itinerary"][0], updated["itinerary"][2]
+    assert first["description"].endswith("Dubai Creek Cruise with shared transfer. Overnight at the hotel.")
+    assert first["title"] == "Arrival in Dubai and Dubai Creek Cruise"
+    assert "Creek Cruise" not in third["description"]
+    assert third["title"] == "Burj Khalifa"
+
+
+@pytest.mark.parametrize("day", ["day 3", "third", "day 9", "someday"])
+def test_reorder_activity_defers_when_nothing_would_move(document, day):
+    assert plan_reorder_activities(document, "Dubai Creek Cruise", day) is None
+
+
+def test_apply_patch_rejects_invalid_path(document):
+    with pytest.raises(PatchError):
+        apply_patch(document, [{"op": "replace", "path": "/itinerary/12/title", "value": "x"}])
+    with pytest.raises(PatchError):
+        apply_patch(document, [{"op": "remove", "path": "itinerary"}])
+
+
+def test_apply_edit_leaves_the_original_untouched(document):
+    apply_edit(document, [{"op": "move", "from": "/itinerary/3", "path": "/itinerary/1"}])
+    assert document == DUBAI